@@ -1,16 +1,76 @@
+import time
+import_start = time.perf_counter()
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 import uvicorn
 import os
-from environments import Settings
+import logging
+from environments import Settings, Database, config_cache, shared_state, presence, dynsec_mirror
+from environments import metrics, profiling
+from environments.compression import CompressionMiddleware
+from secutils import AdmissionMiddleware, TokenBucketLimiter, token_subject
 from routes.devices_router import router as devices_router
 from routes.users_router import router as users_router
 from routes.apps_router import router as apps_router
 from routes.config_router import router as config_router
+from routes.admin_router import router as admin_router
+from routes.mgmt_router import router as mgmt_router
+from dynsec.mqtt_conn import mqtt_start, mqtt_stop
+from dynsec.event_shadow import shadow_start
+from dynsec.reconcile import reconcile_start
+
+import_seconds = time.perf_counter() - import_start
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+startup_seconds = metrics.Gauge('io7_startup_seconds', 'Time spent in the startup phases', ('phase',))
+startup_seconds.labels('import').set(import_seconds)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the connections and the caches are set up here rather than at import time,
+    # so importing the modules is side effect free and each worker process does its own setup
+    start = time.perf_counter()
+    config_cache.load()
+    config_cache.start_watch(settings.CONFIG_WATCH_INTERVAL)
+    dynsec_mirror.ensure_loaded()   # from DynSecPath, before the first request tags the lists with its generation
+    shadow_start()
+    shared_state.start()    # with WORKERS > 1 or SHARED_STATE, follows the table changes of the other workers
+    presence.start(settings.PRESENCE_SNAPSHOT_INTERVAL)
+    reconcile_start()       # with RECONCILE_INTERVAL, the report is served at /admin/reconcile/last
+    mqtt_start()            # connects in the background, retrying with a backoff
+    startup_seconds.labels('lifespan').set(time.perf_counter() - start)
+    logger.info(f'Startup done, import {import_seconds:.3f}s, lifespan {time.perf_counter() - start:.3f}s')
+    yield
+    mqtt_stop()
+    shared_state.stop()
+    # write the pending changes of the write-behind tables before exiting
+    Database.flush_all()
 
 origins = ['*']
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+def request_class(method: str, path: str, query_string: bytes) -> str:
+    # the route classes of the rate limits, the reconciliation and the broken lists parse all of dynsec
+    if path.rstrip('/') in ('/admin/reconcile', '/admin/reconcile/repair') or b'broken=true' in query_string.lower():
+        return 'expensive'
+    return 'read' if method in ('GET', 'HEAD', 'OPTIONS') else 'write'
+
+# added first, so it is inside CORS and the refusals carry the CORS headers. Off unless configured
+if settings.RATE_LIMIT > 0 or settings.MAX_CONCURRENCY > 0 or settings.MAX_EXPENSIVE_CONCURRENCY > 0:
+    app.add_middleware(
+        AdmissionMiddleware,
+        classify=request_class,
+        costs={'read': settings.RATE_COST_READ, 'write': settings.RATE_COST_WRITE, 'expensive': settings.RATE_COST_EXPENSIVE},
+        limiter=TokenBucketLimiter(settings.RATE_LIMIT, settings.RATE_BURST) if settings.RATE_LIMIT > 0 else None,
+        subject=token_subject,
+        max_concurrency=settings.MAX_CONCURRENCY,
+        max_class_concurrency={'expensive': settings.MAX_EXPENSIVE_CONCURRENCY},
+        exempt=('/', '/metrics', '/docs', '/redoc', '/openapi.json')
+    )
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -18,7 +78,30 @@ app.add_middleware(
     allow_methods=['*'],
     allow_headers=['*']
 )
-settings = Settings()
+if settings.COMPRESS_MIN_SIZE > 0:
+    app.add_middleware(CompressionMiddleware, minimum_size=settings.COMPRESS_MIN_SIZE,
+                       gzip_level=settings.COMPRESS_GZIP_LEVEL, brotli_quality=settings.COMPRESS_BROTLI_QUALITY)
+
+http_request_seconds = metrics.Histogram('io7_http_request_seconds', 'REST API latency per route',
+                                         ('method', 'route', 'status'))
+
+route_paths = {}
+
+def route_path(scope: dict) -> str:
+    # the route template(eg. /devices/{devId}) rather than the raw path, to keep the series bounded
+    if not route_paths:
+        route_paths.update({r.endpoint: r.path for r in app.routes if hasattr(r, 'endpoint')})
+    return route_paths.get(scope.get('endpoint'), 'unmatched')
+
+app.add_middleware(metrics.LatencyMiddleware, histogram=http_request_seconds, route_of=route_path)
+
+# opt-in with PROFILE_SAMPLE_RATE and/or PROFILE_SLOW_MS, the reports are served at /admin/profiles
+if profiling.enabled():
+    app.add_middleware(profiling.ProfileMiddleware)
+
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
 
 @app.get('/', include_in_schema=False)
 async def welcome(request: Request) -> dict:
@@ -31,10 +114,32 @@ app.include_router(apps_router, prefix='/app-ids')
 app.include_router(devices_router, prefix='/devices')
 app.include_router(users_router, prefix='/users')
 app.include_router(config_router, prefix='/config')
+app.include_router(admin_router, prefix='/admin')
+app.include_router(mgmt_router, prefix='/mgmt')
+
+def serve_http2():
+    # uvicorn speaks HTTP/1.1 only, hypercorn negotiates h2 with ALPN over SSL and accepts h2c without
+    from hypercorn.config import Config
+    from hypercorn.run import run
+    config = Config()
+    config.application_path = 'api:app'
+    config.bind = [f'{settings.HOST}:{settings.PORT}']
+    config.workers = settings.WORKERS
+    config.keep_alive_timeout = settings.KEEPALIVE_TIMEOUT
+    config.backlog = settings.BACKLOG
+    if settings.SSL_CERT and os.path.exists(settings.SSL_CERT) and os.path.exists(settings.SSL_KEY):
+        config.certfile, config.keyfile = settings.SSL_CERT, settings.SSL_KEY
+    run(config)
 
-if __name__ == '__main__':
+if __name__ == '__main__' and settings.HTTP2:
+    serve_http2()
+elif __name__ == '__main__':
+    options = {'port': settings.PORT, 'host': settings.HOST,
+               'timeout_keep_alive': settings.KEEPALIVE_TIMEOUT, 'backlog': settings.BACKLOG}
     if settings.SSL_CERT and os.path.exists(settings.SSL_CERT) and os.path.exists(settings.SSL_KEY):
-        uvicorn.run(app, port=settings.PORT, host=settings.HOST,
-                    ssl_keyfile=settings.SSL_KEY, ssl_certfile=settings.SSL_CERT)
+        options.update(ssl_keyfile=settings.SSL_KEY, ssl_certfile=settings.SSL_CERT)
+    if settings.WORKERS > 1:
+        # the workers import the app themselves, which needs the import string
+        uvicorn.run('api:app', workers=settings.WORKERS, **options)
     else:
-        uvicorn.run(app, port=settings.PORT, host=settings.HOST)
\ No newline at end of file
+        uvicorn.run(app, **options)
\ No newline at end of file
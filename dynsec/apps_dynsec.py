@@ -1,10 +1,9 @@
-import json
 import logging
 from typing import List
 from models import NewIOTApp, MemberDevice
-from dynsec.mqtt_conn import mqClient
+from dynsec.mqtt_conn import dynsec_publish
 from dynsec.topicBase import ACLBase
-from environments import Settings, dynsec_get_client_role
+from environments import Settings, dynsec_mirror
 
 settings = Settings()
 logger = logging.getLogger("uvicorn")
@@ -25,7 +24,7 @@ def add_dynsec_app(app: NewIOTApp):
                 }
             ]
         }
-        mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd));
+        dynsec_publish(dyn_cmd)
 
     dyn_cmd = {
         'commands': [
@@ -43,7 +42,7 @@ def add_dynsec_app(app: NewIOTApp):
         ]
     }
 
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd))
+    dynsec_publish(dyn_cmd)
     logger.info(f'Creating App ID "{app.appId}".')
 
 def delete_dynsec_app(appId: str):
@@ -55,7 +54,7 @@ def delete_dynsec_app(appId: str):
             }
         ]
     }
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd))
+    dynsec_publish(dyn_cmd)
     logger.info(f'Deleting App ID "{appId}".')
 
 def build_add_cmd(appId: str, devId: str, evt: bool, cmd: bool):
@@ -103,7 +102,7 @@ def add_dynsec_member(appId: str, members: List[MemberDevice]):
         "commands": commands
     }
 
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd))
+    dynsec_publish(dyn_cmd)
     logger.info(f'Adding members({members}) to App ID "{appId}".')
 
 def remove_dynsec_member(appId: str, members: list):
@@ -115,45 +114,60 @@ def remove_dynsec_member(appId: str, members: list):
         "commands": commands
     }
 
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd))
+    dynsec_publish(dyn_cmd)
     logger.info(f'Removing members({members}) to App ID "{appId}".')
 
-def update_dynsec_members(appId: str, members: List[MemberDevice]):
-    add_list = []
-    del_list = []
-
-    current = dynsec_get_client_role(appId).get('members')
-    for cur in current:
-        keep = next((m for m in members if m.devId == cur.get('devId')), None)
-        if keep:
-            if keep != cur:
-                del_list.append(cur.get('devId'))
-                add_list.append(keep)
-        else:
-            del_list.append(cur.get('devId'))
-    for m in members:
-        if next((c for c in current if c['devId'] == m.devId), None) is None:
-            add_list.append(m)
-
-    if len(del_list) > 0:
-        remove_dynsec_member(appId, del_list)
-
-    if len(add_list) > 0:
-        add_dynsec_member(appId, add_list)
-
-    # disconnect the appId to get the new list reflected
-    dyn_cmd = {
-        'commands': [
+def device_membership_commands(devIds: list) -> list:
+    # removes the devices from the app roles having them as members, from the member index of the mirror
+    commands = []
+    for devId in devIds:
+        for app in dynsec_mirror.device_apps(devId):
+            commands += build_del_cmd(app['appId'], devId)
+    return commands
+
+def current_members(appId: str) -> dict:
+    # devId -> (evt, cmd) from the ACLs of the app role, one mirror lookup
+    role = dynsec_mirror.get_role(f'$apps_{appId}') or {'acls': []}
+    members = {}
+    for acl in role['acls']:
+        topic = acl['topic'].split('/')
+        if len(topic) > 2 and topic[2] in ('evt', 'cmd'):
+            evt, cmd = members.get(topic[1], (False, False))
+            members[topic[1]] = (acl['allow'], cmd) if topic[2] == 'evt' else (evt, acl['allow'])
+    return members
+
+def update_dynsec_members(appId: str, members: List[MemberDevice], reconnect: bool = True) -> dict:
+    """
+    Replaces the members of the app with the given ones, sending only the differences
+    in one command array, the removals first.
+    The app is disconnected to drop its subscriptions to the removed/changed members.
+    With reconnect=False it is not, if the members are only added.
+    """
+    current = current_members(appId)
+    wanted = {m.devId: m for m in members}
+    del_list = [devId for devId, access in current.items()
+                if devId not in wanted or access != (wanted[devId].evt, wanted[devId].cmd)]
+    add_list = [m for devId, m in wanted.items() if current.get(devId) != (m.evt, m.cmd)]
+
+    commands = []
+    for devId in del_list:
+        commands += build_del_cmd(appId, devId)
+    for m in add_list:
+        commands += build_add_cmd(appId, m.devId, m.evt, m.cmd)
+    if del_list or (add_list and reconnect):
+        # disconnect the appId to get the new list reflected
+        commands += [
             {
                 'command': 'disableClient',
                 'username': appId
-            } ,
+            },
             {
                 'command': 'enableClient',
                 'username': appId
             }
         ]
-    }
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd))
+    if commands:
+        dynsec_publish({'commands': commands})
 
-    logger.info(f'Updateing member devices for App ID({appId}). Removed : {del_list}, Added : {add_list}')
\ No newline at end of file
+    logger.info(f'Updating member devices for App ID({appId}). Removed/changed : {len(del_list)}, Added/changed : {len(add_list)}')
+    return {'removed': len(del_list), 'added': len(add_list)}
@@ -7,17 +7,15 @@ settings = Settings()
 logger = logging.getLogger("uvicorn")
 logger.setLevel(settings.LOG_LEVEL)
 
-def reboot_device_action(device: str):
-    cmd = { }
-    mqClient.publish(f'iot3/{device}/mgmt/initiate/device/reboot', json.dumps(cmd))
-    logger.info(f'Rebooting the device "{device}".')
+# the management messages, as (topic, payload) for a device. Used by the single device actions
+# below and by the bulk management jobs, whose params are the keyword arguments here
+def reboot_message(device: str) -> tuple:
+    return f'iot3/{device}/mgmt/initiate/device/reboot', { }
 
-def reset_device_action(device: str):
-    cmd = { }
-    mqClient.publish(f'iot3/{device}/mgmt/initiate/device/factory_reset', json.dumps(cmd))
-    logger.info(f'Factory Resetting the device "{device}".')
+def reset_message(device: str) -> tuple:
+    return f'iot3/{device}/mgmt/initiate/device/factory_reset', { }
 
-def update_metadata_action(device: str, meta: dict):
+def update_metadata_message(device: str, meta: dict) -> tuple:
     cmd = {
         'd' : {
             'fields': [
@@ -28,10 +26,9 @@ def update_metadata_action(device: str, meta: dict):
             ]
         }
     }
-    mqClient.publish(f'iot3/{device}/mgmt/device/update', json.dumps(cmd))
-    logger.info(f'Updating Metadata on "{device}".')
+    return f'iot3/{device}/mgmt/device/update', cmd
 
-def upgrade_firmware_action(device: str, fw_url: str):
+def upgrade_firmware_message(device: str, fw_url: str) -> tuple:
     cmd = {
         'd' : {
             'upgrade': {
@@ -39,5 +36,31 @@ def upgrade_firmware_action(device: str, fw_url: str):
             }
         }
     }
-    mqClient.publish(f'iot3/{device}/mgmt/initiate/firmware/update', json.dumps(cmd))
-    logger.info(f'Upgrading Firmware on "{device}".')
\ No newline at end of file
+    return f'iot3/{device}/mgmt/initiate/firmware/update', cmd
+
+mgmt_messages = {
+    'reboot': reboot_message,
+    'reset': reset_message,
+    'updateMeta': update_metadata_message,
+    'upgrade': upgrade_firmware_message
+}
+
+def reboot_device_action(device: str):
+    topic, cmd = reboot_message(device)
+    mqClient.publish(topic, json.dumps(cmd))
+    logger.info(f'Rebooting the device "{device}".')
+
+def reset_device_action(device: str):
+    topic, cmd = reset_message(device)
+    mqClient.publish(topic, json.dumps(cmd))
+    logger.info(f'Factory Resetting the device "{device}".')
+
+def update_metadata_action(device: str, meta: dict):
+    topic, cmd = update_metadata_message(device, meta)
+    mqClient.publish(topic, json.dumps(cmd))
+    logger.info(f'Updating Metadata on "{device}".')
+
+def upgrade_firmware_action(device: str, fw_url: str):
+    topic, cmd = upgrade_firmware_message(device, fw_url)
+    mqClient.publish(topic, json.dumps(cmd))
+    logger.info(f'Upgrading Firmware on "{device}".')
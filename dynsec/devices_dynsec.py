@@ -1,41 +1,48 @@
-import json
 import logging
 from models import NewDevice, Device
 from dynsec.topicBase import ACLBase
-from dynsec.mqtt_conn import mqClient
-from environments import Settings
+from dynsec.mqtt_conn import dynsec_publish
+from dynsec.apps_dynsec import device_membership_commands
+from environments import Settings, gateway_index
 
 settings = Settings()
 logger = logging.getLogger("uvicorn")
 logger.setLevel(settings.LOG_LEVEL)
 
+DELETE_BATCH = 1000     # commands per dynsec message of a cascaded delete
+
+def create_role_command(devId: str, type: str) -> dict:
+    acl = ACLBase(devId)
+    command = {
+        'command': 'createRole',
+        'rolename': acl.get_id(),
+        'acls': [
+                acl.subTopic('cmdTopic'),
+                acl.subTopic('updateTopic'),
+                acl.subTopic('rebootTopic'),
+                acl.subTopic('resetTopic'),
+                acl.subTopic('upgradeTopic'),
+                acl.pubTopic('logTopic'),
+                acl.pubTopic('metaTopic'),
+                acl.pubTopic('evtTopic')
+        ]
+    }
+
+    if type == 'gateway':
+        command['acls'].append(acl.pubTopic('gw_query'))
+        command['acls'].append(acl.pubTopic('gw_add'))
+        command['acls'].append(acl.subTopic('gw_list'))
+    return command
+
 def add_dynsec_device(device: NewDevice):
     acl = ACLBase(device.devId)
     dyn_cmd = {
         'commands': [
-            {
-                'command': 'createRole',
-                'rolename': acl.get_id(),
-                'acls': [
-                        acl.subTopic('cmdTopic'),
-                        acl.subTopic('updateTopic'),
-                        acl.subTopic('rebootTopic'),
-                        acl.subTopic('resetTopic'),
-                        acl.subTopic('upgradeTopic'),
-                        acl.pubTopic('logTopic'),
-                        acl.pubTopic('metaTopic'),
-                        acl.pubTopic('evtTopic')
-                ]
-            }
+            create_role_command(device.devId, device.type)
         ]
     }
 
-    if device.type == 'gateway':
-        dyn_cmd['commands'][0]['acls'].append(acl.pubTopic('gw_query'))
-        dyn_cmd['commands'][0]['acls'].append(acl.pubTopic('gw_add'))
-        dyn_cmd['commands'][0]['acls'].append(acl.subTopic('gw_list'))
-
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd));
+    dynsec_publish(dyn_cmd)
 
     if device.type == 'edge':
         dyn_cmd = {
@@ -66,8 +73,14 @@ def add_dynsec_device(device: NewDevice):
         }
         logger.info(f'Creating Client "{acl.get_id()}".')
         
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd))
+    dynsec_publish(dyn_cmd)
 
+def add_dynsec_edges(gateway: str, edges: list):
+    # the roles of the edges and their assignment to the gateway client in one command array
+    commands = [create_role_command(edge, 'edge') for edge in edges]
+    commands += [{'command': 'addClientRole', 'username': gateway, 'rolename': edge} for edge in edges]
+    dynsec_publish({'commands': commands})
+    logger.info(f'Creating {len(edges)} Edge Clients of "{gateway}".')
 
 def delete_dynsec_device(device: str):
     dyn_cmd = {
@@ -78,5 +91,25 @@ def delete_dynsec_device(device: str):
             }
         ]
     }
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(dyn_cmd))
+    dynsec_publish(dyn_cmd)
     logger.info(f'Deleting Device "{device}".')
+
+def plan_device_delete(device: dict) -> dict:
+    """
+    Works out everything deleting the device affects from the indexed state, without scanning
+    the registry or dynsec: the edges of a gateway(gateway_index), the clients and the roles of
+    the devices, and their member ACLs in the restricted app roles(the mirror's member index).
+    """
+    devId = device['devId']
+    edges = gateway_index.get_edges(devId) if device.get('type') == 'gateway' else []
+    devIds = [devId] + edges
+    commands = device_membership_commands(devIds)
+    if device.get('type') != 'edge':
+        commands.append({'command': 'deleteClient', 'username': devId})
+    commands += [{'command': 'deleteRole', 'rolename': d} for d in devIds]
+    return {'devIds': devIds, 'edges': edges, 'commands': commands}
+
+def execute_device_delete(plan: dict):
+    for i in range(0, len(plan['commands']), DELETE_BATCH):
+        dynsec_publish({'commands': plan['commands'][i:i + DELETE_BATCH]})
+    logger.info(f'Deleting Device "{plan["devIds"][0]}" with {len(plan["edges"])} edges, {len(plan["commands"])} dynsec commands.')
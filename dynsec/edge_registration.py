@@ -0,0 +1,85 @@
+import json
+import threading
+import logging
+from datetime import datetime, timezone
+from environments import Settings, Database, gateway_index
+from models import Device, IOTApp
+from dynsec.mqtt_conn import mqClient
+from dynsec.devices_dynsec import add_dynsec_edges
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+device_db = Database(Device.Settings.name)
+apps_db = Database(IOTApp.Settings.name)
+
+class EdgeRegistrar:
+    """
+    Registers the edge devices requested on `iot3/<gw>/gateway/add`.
+
+    The requests of a gateway are collected for GATEWAY_ADD_WINDOW seconds(or up to GATEWAY_ADD_MAX edges),
+    then the new edges are validated together, stored with one write and created in dynsec
+    with one command array, and the resulting edge list is published on `iot3/<gw>/gateway/list`.
+    So a gateway joining with hundreds of edges costs a few table writes instead of one per edge.
+    """
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.pending = {}       # gateway -> {devId: None}
+        self.timers = {}        # gateway -> threading.Timer
+
+    def add(self, gateway: str, devIds: list):
+        with self.lock:
+            pending = self.pending.setdefault(gateway, {})
+            pending.update(dict.fromkeys(devIds))
+            flush_now = self.window <= 0 or len(pending) >= self.max_batch
+            if not flush_now and gateway not in self.timers:
+                timer = threading.Timer(self.window, self.flush, args=(gateway,))
+                timer.daemon = True
+                self.timers[gateway] = timer
+                timer.start()
+        if flush_now:
+            self.flush(gateway)
+
+    def flush(self, gateway: str):
+        with self.lock:
+            timer = self.timers.pop(gateway, None)
+            if timer:
+                timer.cancel()
+            devIds = list(self.pending.pop(gateway, {}))
+        if devIds:
+            try:
+                self.register(gateway, devIds)
+            except Exception as e:
+                logger.error(f'Registering the edges of {gateway} failed: {e}')
+
+    def register(self, gateway: str, devIds: list):
+        gw = device_db.getOne(device_db.qry.devId == gateway)
+        if not gw or gw['type'] != 'gateway':
+            logger.error(f'Invalid Gateway({gateway})')
+            return
+        devIds = [d for d in devIds if isinstance(d, str) and d and not d.startswith('$') and d != 'admin']
+        # one scan of each table for the whole batch
+        taken = set(d['devId'] for d in device_db.get(device_db.qry.devId.one_of(devIds)))
+        taken |= set(a['appId'] for a in apps_db.get(apps_db.qry.appId.one_of(devIds)))
+        for devId in taken:
+            logger.error(f"The Id({devId}) is already registered for Device/Gateway/AppId.")
+        createdDate = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        edges = [Device(devId=d, type='edge', createdBy=gateway) for d in devIds if d not in taken]
+        if edges:
+            for edge in edges:
+                edge.createdDate = createdDate
+            device_db.upsert_many(edges)
+            for edge in edges:
+                gateway_index.set_device(edge.dict())
+            add_dynsec_edges(gateway, [edge.devId for edge in edges])
+        mqClient.publish(f'iot3/{gateway}/gateway/list', gateway_index.reply(gateway))
+
+edge_registrar = EdgeRegistrar(settings.GATEWAY_ADD_WINDOW, settings.GATEWAY_ADD_MAX)
+
+def requested_edges(payload: bytes) -> list:
+    # {"d":{"devId":"edge1"}}, {"d":{"devId":["edge1","edge2"]}} or {"d":{"devIds":["edge1","edge2"]}}
+    obj = json.loads(payload)['d']
+    devIds = obj.get('devIds', obj.get('devId'))
+    return devIds if isinstance(devIds, list) else [devIds]
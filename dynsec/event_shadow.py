@@ -1,10 +1,13 @@
 import json
 from concurrent.futures import ThreadPoolExecutor
 import redis
+from redis.retry import Retry
+from redis.backoff import ExponentialBackoff
 import requests
 import time
 import logging
-from environments import Settings, get_config, get_fieldset, is_monitored
+from environments import Settings, config_cache, get_fieldset, is_monitored
+from environments.metrics import Counter, Gauge, Histogram
 import urllib3
 from urllib3.exceptions import InsecureRequestWarning
 # Suppress only the insecure TLS warning from urllib3
@@ -15,16 +18,35 @@ logger = logging.getLogger("uvicorn")
 logger.setLevel(settings.LOG_LEVEL)
 
 executor = ThreadPoolExecutor(max_workers=30)
-redisClient = redis.Redis(
-    host=getattr(settings, 'REDIS_HOST', 'redis'),
-    port=getattr(settings, 'REDIS_PORT', 6379), db=0)
+redisClient = None          # created by shadow_start()
+shadow_queue_depth = Gauge('io7_shadow_queue_depth', 'Device events waiting for the shadow workers',
+                           callback=lambda: executor._work_queue.qsize())
+shadow_seconds = Histogram('io7_shadow_event_seconds', 'Time to shadow and log a device event')
+redis_write_seconds = Histogram('io7_redis_write_seconds', 'Redis shadow write latency')
+redis_errors = Counter('io7_redis_errors_total', 'Failed Redis shadow writes')
+influx_write_seconds = Histogram('io7_influx_write_seconds', 'InfluxDB write latency')
+influx_errors = Counter('io7_influx_errors_total', 'Failed InfluxDB writes')
+
+def shadow_start():
+    global redisClient
+    # redis-py connects on the first command and reconnects with a backoff on the connection errors
+    redisClient = redis.Redis(
+        host=getattr(settings, 'REDIS_HOST', 'redis'),
+        port=getattr(settings, 'REDIS_PORT', 6379), db=0,
+        retry=Retry(ExponentialBackoff(cap=10, base=0.1), 3),
+        retry_on_error=[redis.exceptions.ConnectionError, redis.exceptions.TimeoutError])
 
 influxdb_host=getattr(settings, 'INFLUXDB_HOST', 'influxdb')
 influxdb_port=getattr(settings, 'INFLUXDB_PORT', 8086)
 influxdb_proto=getattr(settings, 'INFLUXDB_PROTOCOL', 'http')
 influxdb_url = f'{influxdb_proto}://{influxdb_host}:{influxdb_port}/write?db=bucket01'
-influxdb_token=get_config('influxdb_token')
-influxdb_header = {"Authorization": f"Token {influxdb_token}"}
+influxdb_header = {}
+
+def set_influxdb_header(config: dict):
+    # called again whenever the configuration is reloaded, so a new token is picked up
+    influxdb_header["Authorization"] = f"Token {config.get('influxdb_token')}"
+
+config_cache.subscribe(set_influxdb_header)
 
 def isNumber(n):
     try:
@@ -42,9 +64,22 @@ def add_field_set(msg_json):
     return field_set
 
 def shadow_event_thread(device, msg):
+    start = time.perf_counter()
+    try:
+        shadow_and_log(device, msg)
+    finally:
+        shadow_seconds.observe(time.perf_counter() - start)
+
+def shadow_and_log(device, msg):
     msg_json = json.loads(msg.payload)
     msg_json['t'] = int(time.time()*1000)
-    redisClient.set(device, json.dumps(msg_json))
+    start = time.perf_counter()
+    try:
+        redisClient.set(device, json.dumps(msg_json))
+    except Exception as e:
+        redis_errors.inc()
+        logger.debug(f"Redis write error for {device}: {e}")
+    redis_write_seconds.observe(time.perf_counter() - start)
 
     if is_monitored(device) is False:      # retrun if the device is not listed for logging
         return
@@ -56,7 +91,15 @@ def shadow_event_thread(device, msg):
     if len(line_data) == 0:     # no data to log, just return
         return
     line_data=f"alldevices,device={device} " + line_data
-    rc = requests.post(url=influxdb_url, data=line_data, headers=influxdb_header, verify=False)
+    start = time.perf_counter()
+    try:
+        rc = requests.post(url=influxdb_url, data=line_data, headers=influxdb_header, verify=False)
+        if rc.status_code >= 300:
+            influx_errors.inc()
+    except Exception as e:
+        influx_errors.inc()
+        logger.debug(f"InfluxDB write error for {device}: {e}")
+    influx_write_seconds.observe(time.perf_counter() - start)
     #logger.debug(f"Logging : {device} => {line_data}")
 
 def shadow_event(device, msg):
@@ -0,0 +1,173 @@
+import collections
+import json
+import threading
+import time
+import uuid
+import logging
+from datetime import datetime, timezone
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+from environments import Settings, device_registry, gateway_index
+from models import DeviceSelector
+from dynsec.mqtt_conn import mqClient
+from dynsec.devices_actions import mgmt_messages
+from dynsec import mgmt_state
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+def select_devices(selector: DeviceSelector) -> list:
+    # the devIds matching all the given criteria, in the registration order
+    devices = device_registry.all().values()
+    if selector.devIds is not None:
+        wanted = set(selector.devIds)
+        devices = [d for d in devices if d.devId in wanted]
+    if selector.type:
+        devices = [d for d in devices if d.type == selector.type]
+    if selector.gateway:
+        members = set(gateway_index.get_edges(selector.gateway)) | {selector.gateway}
+        devices = [d for d in devices if d.devId in members]
+    if selector.createdBy:
+        devices = [d for d in devices if d.createdBy == selector.createdBy]
+    return [d.devId for d in devices]
+
+class MgmtJob:
+    """
+    Publishes a management message to each of the selected devices on its own thread.
+
+    The messages go out at most `rate` per second, with qos 1, and at most `window` of them
+    may be waiting for the broker's ack, so a fleet wide action does not flood the broker.
+    A message not acked within MGMT_ACK_TIMEOUT is counted as failed. While the client is
+    disconnected the job waits for the reconnection.
+    """
+    def __init__(self, action: str, params: dict, devIds: list, rate: float, window: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.action = action
+        self.params = params
+        self.devIds = devIds
+        self.rate = rate
+        self.window = max(1, window)
+        self.state = 'queued'
+        self.created = datetime.now(timezone.utc)
+        self.started = self.finished = None
+        self.published = self.acked = self.failed = 0
+        self.errors = collections.deque(maxlen=20)
+        self.inflight = collections.deque()     # (MQTTMessageInfo, devId, sent time)
+        self.cancelled = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'io7-mgmt-{self.id}', daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self) -> dict:
+        return {
+            'jobId': self.id,
+            'action': self.action,
+            'state': self.state,
+            'total': len(self.devIds),
+            'published': self.published,
+            'acked': self.acked,
+            'failed': self.failed,
+            'inflight': len(self.inflight),
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+            'errors': list(self.errors)
+        }
+
+    def run(self):
+        self.state = 'running'
+        self.started = datetime.now(timezone.utc)
+        interval = 1 / self.rate if self.rate > 0 else 0
+        next_send = time.monotonic()
+        try:
+            for devId in self.devIds:
+                while not self.cancelled.is_set() and (len(self.inflight) >= self.window or not mqClient.is_connected()):
+                    self.settle(wait=1)
+                if self.cancelled.is_set():
+                    break
+                delay = next_send - time.monotonic()
+                if delay > 0 and self.cancelled.wait(delay):
+                    break
+                next_send = max(next_send, time.monotonic()) + interval
+                self.send(devId)
+                self.settle(wait=0)
+            while self.inflight and not self.cancelled.is_set():
+                self.settle(wait=1)
+            self.state = 'cancelled' if self.cancelled.is_set() else 'done'
+        except Exception as e:
+            self.state = 'failed'
+            self.errors.append(str(e))
+            logger.error(f'Management job {self.id} failed: {e}')
+        self.finished = datetime.now(timezone.utc)
+        logger.info(f'Management job {self.id}({self.action}) {self.state}: {self.acked} acked, {self.failed} failed')
+
+    def send(self, devId: str):
+        topic, cmd = mgmt_messages[self.action](devId, **self.params)
+        info = mqClient.publish(topic, json.dumps(cmd), qos=1)
+        self.published += 1
+        if info.rc == MQTT_ERR_SUCCESS:
+            self.inflight.append((info, devId, time.monotonic()))
+        else:
+            self.fail(devId, f'publish rc {info.rc}')
+
+    def settle(self, wait: float):
+        # drops the acked messages from the window, waiting up to `wait` seconds for the oldest one
+        if self.inflight and wait > 0:
+            self.inflight[0][0].wait_for_publish(timeout=wait)
+        elif wait > 0:
+            time.sleep(wait)
+        while self.inflight:
+            info, devId, sent = self.inflight[0]
+            if info.is_published():
+                self.acked += 1
+            elif time.monotonic() - sent > settings.MGMT_ACK_TIMEOUT:
+                self.fail(devId, 'no ack from the broker')
+            else:
+                break
+            self.inflight.popleft()
+
+    def fail(self, devId: str, reason: str):
+        self.failed += 1
+        self.errors.append(f'{devId}: {reason}')
+
+
+jobs = collections.OrderedDict()
+jobs_lock = threading.Lock()
+
+def start_job(action: str, params: dict, devIds: list) -> MgmtJob:
+    job = MgmtJob(action, params, devIds, settings.MGMT_RATE, settings.MGMT_WINDOW)
+    with jobs_lock:
+        jobs[job.id] = job
+        finished = [j for j in jobs.values() if j.finished]
+        for old in finished[:max(0, len(finished) - settings.MGMT_JOBS_KEEP)]:
+            del jobs[old.id]
+    job.start()
+    mgmt_state.start()
+    return job
+
+def job_progress(jobId: str) -> dict:
+    # with several workers, the job may be running on another one. It may read Redis, call it with run_io
+    job = jobs.get(jobId)
+    return job.progress() if job else mgmt_state.remote_progress('jobs', jobId)
+
+def cancel_job(jobId: str) -> dict:
+    job = jobs.get(jobId)
+    if job:
+        job.cancel()
+        return job.progress()
+    progress = mgmt_state.remote_progress('jobs', jobId)
+    if progress:
+        mgmt_state.forward('jobs', jobId, 'cancel')
+    return progress
+
+def list_jobs() -> list:
+    with jobs_lock:
+        local = [job.progress() for job in reversed(jobs.values())]
+    return mgmt_state.merged_progress('jobs', local)
+
+mgmt_state.register('jobs', jobs, jobs_lock, lambda job, action: job.cancel() if action == 'cancel' else None)
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+import logging
+from environments import Settings, shared_state
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+# The management jobs and the rollouts across the workers(WORKERS > 1 or SHARED_STATE).
+# A job or a rollout runs on the worker that started it, since it needs that worker's MQTT client.
+# The worker writes the progress of its ones to the Redis hash io7:mgmt:<kind> every second,
+# so the other workers can answer the progress requests, and forwards them the cancel/resume requests
+# on the change channel.
+registries = {}         # kind -> (id -> job/rollout, its lock, control(item, action))
+written = {}            # kind -> ids written by this worker
+finished = set()        # (kind, id) of the finished ones written, they don't change anymore
+syncer = None
+
+def progress_key(kind: str) -> str:
+    return f'io7:mgmt:{kind}'
+
+def register(kind: str, items: dict, lock, control):
+    registries[kind] = (items, lock, control)
+    written[kind] = set()
+    shared_state.handlers[f'mgmt_{kind}'] = lambda data: on_request(kind, data)
+
+def on_request(kind: str, data: dict):
+    # a cancel/resume forwarded by another worker, only the owner has the item
+    items, lock, control = registries[kind]
+    item = items.get(data['id'])
+    if item:
+        logger.info(f'Management {kind} {data["id"]}: {data["action"]} forwarded by another worker')
+        control(item, data['action'])
+
+def forward(kind: str, id: str, action: str):
+    shared_state.publish(f'mgmt_{kind}', {'id': id, 'action': action})
+
+def start():
+    # called when a job/rollout is started, the progress is shared only with the other workers
+    global syncer
+    if shared_state.redis_client is not None and syncer is None:
+        syncer = threading.Thread(target=sync_loop, name='io7-mgmt-sync', daemon=True)
+        syncer.start()
+
+def sync_loop():
+    while shared_state.redis_client is not None:
+        try:
+            sync()
+        except Exception as e:
+            logger.warning(f'Sharing the management progress failed: {e}')
+        time.sleep(1)
+
+def sync():
+    pipe = shared_state.redis_client.pipeline()
+    done = []
+    for kind, (items, lock, _) in registries.items():
+        with lock:
+            current = list(items.values())
+        progress = {}
+        for item in current:
+            if (kind, item.id) not in finished:
+                progress[item.id] = json.dumps(item.progress())
+                if item.finished:
+                    done.append((kind, item.id))
+        if progress:
+            pipe.hset(progress_key(kind), mapping=progress)
+        dropped = written[kind] - {item.id for item in current}     # the old ones trimmed from the registry
+        if dropped:
+            pipe.hdel(progress_key(kind), *dropped)
+        written[kind] = written[kind] - dropped | set(progress)
+        finished.difference_update((kind, id) for id in dropped)
+    pipe.execute()
+    finished.update(done)
+
+def remote_progress(kind: str, id: str) -> dict:
+    # the progress written by the worker running it, None without the shared state. It reads Redis, call it with run_io
+    if shared_state.redis_client is None:
+        return None
+    try:
+        value = shared_state.redis_client.hget(progress_key(kind), id)
+    except Exception as e:
+        logger.warning(f'Reading the management progress failed: {e}')
+        return None
+    return json.loads(value) if value else None
+
+def merged_progress(kind: str, local: list) -> list:
+    # the local progresses and the other workers' ones, the newest first. It reads Redis, call it with run_io
+    if shared_state.redis_client is None:
+        return local
+    try:
+        values = shared_state.redis_client.hvals(progress_key(kind))
+    except Exception as e:
+        logger.warning(f'Reading the management progress failed: {e}')
+        return local
+    ids = {p.get('jobId') or p.get('rolloutId') for p in local}
+    remote = [p for p in map(json.loads, values) if (p.get('jobId') or p.get('rolloutId')) not in ids]
+    return sorted(local + remote, key=lambda p: p['created'], reverse=True)
@@ -1,26 +1,47 @@
-from datetime import datetime
+import threading
 import time
 import logging
-import threading
 import os
 import json
-import asyncio
 import paho.mqtt.client as mqtt
-from environments import Settings, Database, dynsec_role_exists, dynsec_get_admin
-from models import Device, NewDevice
+from environments import Settings, dynsec_role_exists, dynsec_get_admin, shared_state, gateway_index, presence, dynsec_mirror
+from environments.metrics import Counter, Histogram
+from environments.profiling import record_span
 from .event_shadow import shadow_event
 
 settings = Settings()
 logger = logging.getLogger("uvicorn")
 logger.setLevel(settings.LOG_LEVEL)
-device_db = Database(Device.Settings.name)
 
 server = settings.MQTT_HOST
 port = settings.MQTT_PORT
 username = settings.DynSecUser
 password = settings.DynSecPass
 
+mqtt_messages = Counter('io7_mqtt_messages_total', 'MQTT messages handled per topic class', ('topic',))
+mqtt_handle_seconds = Histogram('io7_mqtt_handle_seconds', 'MQTT message handling time per topic class', ('topic',))
+# bound once, so the event hot path only does the increments
+mqtt_counters = {t: (mqtt_messages.labels(t), mqtt_handle_seconds.labels(t)) for t in ['gateway_add', 'gateway_query', 'evt', 'connection', 'mgmt', 'dynsec', 'other']}
+
+DYNSEC_TOPIC = '$CONTROL/dynamic-security/v1'
+dynsec_lock = threading.Lock()
+
+def dynsec_publish(dyn_cmd: dict):
+    # every dynsec command goes through here, so the mirror applies them in the order mosquitto gets them
+    with dynsec_lock:
+        dynsec_mirror.apply(dyn_cmd['commands'])
+        info = mqClient.publish(DYNSEC_TOPIC, json.dumps(dyn_cmd))
+    # after releasing the lock, so a slow Redis doesn't hold up the other dynsec writers
+    shared_state.publish_commands(dyn_cmd['commands'])
+    return info
+
+def dynsec_resync():
+    # the lists are answered after the commands sent before, see DynsecMirror
+    with dynsec_lock:
+        mqClient.publish(DYNSEC_TOPIC, json.dumps({'commands': dynsec_mirror.resync_commands()}))
+
 def mqtt_dynsec_setup():
+    # after a resync, so the checks see the broker's clients and roles rather than an empty mirror
     if not dynsec_role_exists('$apps'):
         from dynsec.roles_dynsec import add_apps_role
         add_apps_role()
@@ -33,60 +54,106 @@ def mqtt_dynsec_setup():
         else:
             logger.error('No admin user found in dynsec.json')
 
+dynsec_mirror.request_resync = dynsec_resync
+dynsec_mirror.on_synced = mqtt_dynsec_setup
+
 def on_message(client, userdata, msg):
+    start = time.perf_counter()
+    topic_class = handle_message(client, msg)
+    counter, histogram = mqtt_counters[topic_class]
+    counter.inc()
+    histogram.observe(time.perf_counter() - start)
+
+def handle_message(client, msg) -> str:
     # handle edge device registration and listing
-    from routes.devices_router import add_device
+    from dynsec.edge_registration import edge_registrar, requested_edges
     logger.debug("MQTT Message Received: " + msg.topic + " : " + str(msg.payload))
+    if msg.topic == '$CONTROL/dynamic-security/v1/response':
+        dynsec_mirror.on_response(msg.payload)
+        return 'dynsec'
     topic = msg.topic.split('/')
     if topic[3] == 'add':
-        obj=json.loads(msg.payload)['d']
-        edgeDevice = NewDevice(
-            devId =obj['devId'],
-            password ='',
-            createdBy = topic[1], 
-            createdDate = datetime.utcnow(),
-            type = 'edge'
-        )
-        asyncio.run(add_device(edgeDevice))
+        try:
+            edge_registrar.add(topic[1], requested_edges(msg.payload))     # batched, see EdgeRegistrar
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error(f'Invalid gateway/add request from {topic[1]}: {e}')
+        return 'gateway_add'
     elif topic[3] == 'query':
-        edges = device_db.get(device_db.qry.createdBy == topic[1])
-        edges = [edge['devId'] for edge in edges]
-        edges.append(topic[1])
-        client.publish(f"iot3/{topic[1]}/gateway/list", json.dumps(edges))
-    elif topic[2] == 'evt' and topic[3] != 'connection':    # shadowing/logging the device event
-        shadow_event(topic[1], msg)
+        # {"d":{"since": <version>}} asks for the changes since the version the gateway has
+        try:
+            since = json.loads(msg.payload)['d'].get('since')
+            since = int(since) if since is not None else None
+        except (ValueError, TypeError, KeyError, AttributeError):
+            since = None
+        client.publish(f"iot3/{topic[1]}/gateway/list", gateway_index.reply(topic[1], since))
+        return 'gateway_query'
+    elif topic[2] == 'evt':
+        if topic[3] == 'connection':                        # online/offline, tracked in presence
+            presence.connection_event(topic[1], msg.payload)
+            return 'connection'
+        presence.seen(topic[1])
+        shadow_event(topic[1], msg)                         # shadowing/logging the device event
+        return 'evt'
+    elif topic[2] == 'mgmt' and topic[3] == 'device':       # status/meta reports, the firmware rollouts wait for them
+        from dynsec.rollouts import device_report
+        device_report(topic[1], topic[4], msg.payload)
+        return 'mgmt'
+    return 'other'
         
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         logger.info("MQTT Connected with RC : " + str(rc))
-        mqtt_dynsec_setup()
         client.subscribe('$CONTROL/dynamic-security/v1/response')
-        client.subscribe('iot3/+/gateway/add')
-        client.subscribe('iot3/+/gateway/query')
-        client.subscribe('iot3/+/evt/#')
+        dynsec_resync()         # the changes made while we were away, mqtt_dynsec_setup() runs on the response
+        client.subscribe(device_topic('iot3/+/gateway/add'))
+        client.subscribe(device_topic('iot3/+/gateway/query'))
+        client.subscribe(device_topic('iot3/+/evt/#'))
+        # not shared, the rollout waiting for a device runs on one of the workers. They are rare and cheap to ignore
+        client.subscribe('iot3/+/mgmt/device/status')
+        client.subscribe('iot3/+/mgmt/device/meta')
     else:
         logger.warn("MQTT Connected with RC : " + str(rc))
 
-mqClient = mqtt.Client(client_id='api-server')
-mqClient.username_pw_set(username, password)
-if settings.MQTT_SSL_CERT and os.path.exists(settings.MQTT_SSL_CERT):
-    import ssl
-    mqClient.tls_set(settings.MQTT_SSL_CERT, tls_version=ssl.PROTOCOL_TLSv1_2)
-    mqClient.tls_insecure_set(True)
+class MQTTClient(mqtt.Client):
+    def publish(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().publish(*args, **kwargs)
+        finally:
+            record_span('mqtt.publish', time.perf_counter() - start)
+
+def device_topic(topic: str) -> str:
+    # with several workers/replicas, the device traffic is load balanced by a shared subscription
+    # so each message is handled once. The dynsec responses are still delivered to every worker.
+    return f'$share/io7-api/{topic}' if shared_state.enabled() else topic
 
-def mqConnSetup():
+def on_connect_fail(client, userdata):
+    logger.error("MQTT Client Error: connection to " + f"{server}:{port}" + " failed, retrying")
+
+# the client is created here since the other modules publish through it,
+# but it is connected by mqtt_start() from the lifespan of the app
+mqClient = MQTTClient(client_id='api-server')
+
+def mqtt_start():
     logger.info('MQTT Connection Setup')
-    try:
-        mqClient.connect(server, port, 60)
-        mqClient.on_connect = on_connect
-        mqClient.on_message = on_message
-        mqClient.loop_start()
-    except Exception as e:
-        logger.error("MQTT Client Error: " + str(e))
-        # if mqtt is not ready, retry after 60 seconds
-        time.sleep(60)
-        mqConnSetup()    
-
-t = threading.Thread(target=mqConnSetup)
-t.start()
+    if shared_state.enabled():
+        # the broker drops the older connection of the same client id
+        mqClient.reinitialise(client_id=f'api-server-{shared_state.process_id()}')
+    mqClient.username_pw_set(username, password)
+    if settings.MQTT_SSL_CERT and os.path.exists(settings.MQTT_SSL_CERT):
+        import ssl
+        mqClient.tls_set(settings.MQTT_SSL_CERT, tls_version=ssl.PROTOCOL_TLSv1_2)
+        mqClient.tls_insecure_set(True)
+    mqClient.on_connect = on_connect
+    mqClient.on_connect_fail = on_connect_fail
+    mqClient.on_message = on_message
+    # the network thread of paho retries the connection, also the first one,
+    # waiting 1, 2, 4, ... up to MQTT_RECONNECT_MAX seconds between the attempts
+    mqClient.reconnect_delay_set(min_delay=1, max_delay=settings.MQTT_RECONNECT_MAX)
+    mqClient.connect_async(server, port, 60)
+    mqClient.loop_start()
+
+def mqtt_stop():
+    mqClient.disconnect()
+    mqClient.loop_stop()
  
\ No newline at end of file
@@ -0,0 +1,153 @@
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+from environments import Settings, Database, dynsec_mirror, gateway_index, device_registry, app_registry
+from models import Device, IOTApp, Mismatch, ReconcileReport
+from dynsec.mqtt_conn import dynsec_publish
+from dynsec.devices_dynsec import create_role_command
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+device_db = Database(Device.Settings.name)
+apps_db = Database(IOTApp.Settings.name)
+
+SYSTEM_ROLES = {'admin', '$apps', '$io7_adm'}
+last_report = None
+
+def reconcile(repair: bool = False) -> ReconcileReport:
+    """
+    Compares the TinyDB registry with dynsec(the mirror) in one pass with set operations.
+
+    - devices/gateways: the client and its own role on the dynsec side
+    - edges: the role of the edge and its binding to the gateway client
+    - apps: the client with $apps or $apps_<appId>, and the $apps_<appId> role of the restricted ones
+    - roles: the roles no client uses(reported only)
+
+    With repair, what can be restored from the other side is fixed with one dynsec command array
+    and one write per table. The clients missing in dynsec need the password, so they are only reported.
+    """
+    global last_report
+    start = time.perf_counter()
+    started = datetime.now(timezone.utc)
+    db_devices = device_registry.all()
+    db_apps = app_registry.all()
+    clients = {c['username']: c for c in dynsec_mirror.all_clients()}
+    roles = set(dynsec_mirror.roles)
+
+    def first_role(client):
+        return client['roles'][0]['rolename'] if client.get('roles') else None
+    dyn_devices = {u for u, c in clients.items() if first_role(c) == u and u not in SYSTEM_ROLES}
+    dyn_apps = {u for u, c in clients.items() if (first_role(c) or '').startswith('$apps')}
+    db_edges = {d: record for d, record in db_devices.items() if record.type == 'edge'}
+    db_nonedges = set(db_devices) - set(db_edges)
+    # edge roles bound to the device clients, eg. gateway -> {edge, ...}
+    bindings = {u: {r['rolename'] for r in clients[u]['roles'][1:]} - SYSTEM_ROLES for u in dyn_devices}
+    dyn_edges = {edge: gw for gw, edges in bindings.items() for edge in edges}
+
+    mismatches = []
+    add = lambda *args: mismatches.append(Mismatch(kind=args[0], id=args[1], issue=args[2], toFix=args[3],
+                                                   repairable=args[4], detail=args[5] if len(args) > 5 else None))
+    for devId in sorted(db_nonedges - dyn_devices):
+        add('device', devId, 'missing_in_dynsec', 'dynsec', False, 'needs the password, PATCH /devices/{devId}/update')
+    for devId in sorted(dyn_devices - db_nonedges - set(db_apps)):
+        add('device', devId, 'missing_in_tinydb', 'tinydb', True)
+    for devId in sorted((db_nonedges & dyn_devices) - roles):
+        add('device', devId, 'missing_role', 'dynsec', True)
+    for edge in sorted(db_edges):
+        gw = db_edges[edge].createdBy
+        if edge not in roles:
+            add('edge', edge, 'missing_role', 'dynsec', True)
+        if dyn_edges.get(edge) != gw:
+            add('edge', edge, 'missing_gateway_binding', 'dynsec', gw in clients, f'gateway {gw}')
+    for edge in sorted(set(dyn_edges) - set(db_edges)):
+        add('edge', edge, 'missing_in_tinydb', 'tinydb', edge not in db_devices, f'gateway {dyn_edges[edge]}')
+    for appId in sorted(set(db_apps) - dyn_apps):
+        add('app', appId, 'missing_in_dynsec', 'dynsec', False, 'needs the password, PATCH /app-ids/{appId}/update')
+    for appId in sorted(dyn_apps - set(db_apps) - set(db_devices)):
+        add('app', appId, 'missing_in_tinydb', 'tinydb', True)
+    for appId in sorted(set(db_apps) & dyn_apps):
+        role = first_role(clients[appId])
+        if role != '$apps' and role not in roles:
+            add('app', appId, 'missing_role', 'dynsec', True, role)
+        if (role != '$apps') != db_apps[appId].restricted:
+            add('app', appId, 'restricted_mismatch', 'tinydb', True, f'dynsec role {role}')
+    used = {r['rolename'] for c in clients.values() for r in c.get('roles', [])}
+    for role in sorted(roles - used - SYSTEM_ROLES):
+        add('role', role, 'unused_role', 'dynsec', False, 'no client has the role')
+
+    report = ReconcileReport(
+        started=started,
+        runtime_ms=0,
+        counts={'tinydb_devices': len(db_devices), 'tinydb_apps': len(db_apps), 'dynsec_clients': len(clients),
+                'dynsec_roles': len(roles), 'mismatches': len(mismatches)},
+        mismatches=mismatches,
+        repair=repair
+    )
+    if repair:
+        apply_repairs(report, db_devices, clients)
+    report.runtime_ms = round((time.perf_counter() - start) * 1000, 3)
+    last_report = report
+    return report
+
+def apply_repairs(report: ReconcileReport, db_devices: dict, clients: dict):
+    commands = []
+    new_devices = []
+    new_apps = []
+    now = datetime.now(timezone.utc)
+    for m in report.mismatches:
+        if not m.repairable:
+            continue
+        if m.issue == 'missing_role' and m.kind in ('device', 'edge'):
+            devType = db_devices[m.id].type
+            commands.append(create_role_command(m.id, devType))
+        elif m.issue == 'missing_role' and m.kind == 'app':
+            commands.append({'command': 'createRole', 'rolename': m.detail, 'acls': []})
+        elif m.issue == 'missing_gateway_binding':
+            commands.append({'command': 'addClientRole', 'username': db_devices[m.id].createdBy, 'rolename': m.id})
+        elif m.issue == 'missing_in_tinydb' and m.kind == 'device':
+            roles = dynsec_mirror.get_role(m.id) or {'acls': []}
+            gateway = any(a['topic'].endswith('/gateway/query') for a in roles['acls'])
+            new_devices.append(Device(devId=m.id, type='gateway' if gateway else 'device', createdDate=now))
+        elif m.issue == 'missing_in_tinydb' and m.kind == 'edge':
+            new_devices.append(Device(devId=m.id, type='edge', createdBy=m.detail.split(' ', 1)[1], createdDate=now))
+        elif m.issue == 'missing_in_tinydb' and m.kind == 'app':
+            role = clients[m.id]['roles'][0]['rolename']
+            new_apps.append(IOTApp(appId=m.id, restricted=role != '$apps', createdDate=now))
+        elif m.issue == 'restricted_mismatch':
+            app = apps_db.getOne(apps_db.qry.appId == m.id)
+            app['restricted'] = not app.get('restricted')
+            new_apps.append(IOTApp(**app))
+        else:
+            continue
+        report.repaired += 1
+    for obj in new_devices + new_apps:
+        obj.createdDate = obj.createdDate.strftime('%Y-%m-%d %H:%M:%S')     # stored as a string like the routers do
+    if commands:
+        dynsec_publish({'commands': commands})
+        report.dynsec_commands = len(commands)
+    if new_devices:
+        device_db.upsert_many(new_devices)
+        for device in new_devices:
+            gateway_index.set_device(device.dict())
+        report.tinydb_writes += 1
+    if new_apps:
+        apps_db.upsert_many(new_apps)
+        report.tinydb_writes += 1
+    logger.info(f'Reconciliation repaired {report.repaired} mismatches with {len(commands)} dynsec commands')
+
+def reconcile_loop(interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            report = reconcile(repair=settings.RECONCILE_REPAIR)
+            if report.mismatches:
+                logger.warning(f'Reconciliation found {len(report.mismatches)} mismatches in {report.runtime_ms}ms')
+        except Exception as e:
+            logger.error(f'Reconciliation failed: {e}')
+
+def reconcile_start():
+    if settings.RECONCILE_INTERVAL > 0:
+        threading.Thread(target=reconcile_loop, args=(settings.RECONCILE_INTERVAL,),
+                         name='io7-reconcile', daemon=True).start()
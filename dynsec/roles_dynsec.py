@@ -1,7 +1,6 @@
-import json
 import logging
 from dynsec.topicBase import ACLBase
-from dynsec.mqtt_conn import mqClient
+from dynsec.mqtt_conn import dynsec_publish
 from environments import Settings
 
 settings = Settings()
@@ -24,7 +23,7 @@ def add_apps_role():
         ]
     }
 
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(cmd));
+    dynsec_publish(cmd)
     logger.info('Creating App Role $apps.')
     
 def add_io7_adm_role():
@@ -43,7 +42,7 @@ def add_io7_adm_role():
         ]
     }
 
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(cmd));
+    dynsec_publish(cmd)
     logger.info('Creating Gateway Admin Role $io7_adm.')
     
 def assign_role(device: str, role: str):
@@ -57,7 +56,7 @@ def assign_role(device: str, role: str):
             }
         ]
     }
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(cmd));
+    dynsec_publish(cmd)
     logger.info(f'Assigning Role {role} to device/app {device}.')
 
 def delete_dynsec_role(role: str):
@@ -72,5 +71,5 @@ def delete_dynsec_role(role: str):
 	        }
 	    ]
     }
-    mqClient.publish('$CONTROL/dynamic-security/v1', json.dumps(cmd))
+    dynsec_publish(cmd)
     logger.info(f'Deleting Role "{role}".')
\ No newline at end of file
@@ -0,0 +1,268 @@
+import collections
+import json
+import math
+import threading
+import time
+import uuid
+import logging
+from datetime import datetime, timezone
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+from environments import Settings
+from dynsec.mqtt_conn import mqClient
+from dynsec.devices_actions import upgrade_firmware_message
+from dynsec import mgmt_state
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+UPGRADE_SUCCEEDED = {'success', 'succeeded', 'done', 'complete', 'completed', 'upgraded', 'ok'}
+UPGRADE_FAILED = {'fail', 'failed', 'failure', 'error'}
+
+def upgrade_result(kind: str, payload: bytes, fw_version: str) -> bool:
+    """
+    Reads the upgrade result from a device report, True for success, False for failure
+    and None if the report doesn't tell.
+    - meta: success when the reported devFwVer(in d or d.metadata) is fw_version
+    - status: {"d": {"status": "<result>"}} or {"d": {"result": "<result>"}}, where the result is one of
+      UPGRADE_SUCCEEDED(eg. "upgraded") or UPGRADE_FAILED(eg. "failed"), case insensitive.
+      The other fields and the other values(eg. "downloading") don't tell.
+    """
+    try:
+        d = json.loads(payload).get('d') or {}
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(d, dict):
+        return None
+    if kind == 'meta':
+        if not fw_version:
+            return None
+        metadata = d.get('metadata') if isinstance(d.get('metadata'), dict) else {}
+        version = d.get('devFwVer') or metadata.get('devFwVer')
+        return True if version == fw_version else None
+    for field in ('status', 'result'):
+        value = d.get(field)
+        if isinstance(value, str):
+            value = value.strip().lower()
+            if value in UPGRADE_SUCCEEDED:
+                return True
+            if value in UPGRADE_FAILED:
+                return False
+    return None
+
+class Rollout:
+    """
+    Upgrades the firmware of the selected devices in waves, eg. [1, 10, 100] upgrades 1% of them first,
+    then up to 10%, then the rest.
+
+    At most max_inflight devices are upgrading at once, since the devices download the firmware
+    as soon as they get the request. A device is done when it reports the result on
+    `mgmt/device/status` or reports fw_version on `mgmt/device/meta`, and failed on an error report
+    or after ack_timeout seconds. When the failed fraction of the finished devices exceeds
+    failure_threshold, the rollout halts; it can be resumed after checking the failures.
+    """
+    def __init__(self, devIds: list, fw_url: str, fw_version: str, waves: list,
+                 max_inflight: int, failure_threshold: float, ack_timeout: float):
+        self.id = uuid.uuid4().hex[:12]
+        self.devIds = devIds
+        self.fw_url = fw_url
+        self.fw_version = fw_version
+        self.waves = sorted(min(100.0, max(0.0, w)) for w in waves) or [100.0]
+        if self.waves[-1] < 100:
+            self.waves.append(100.0)
+        self.max_inflight = max(1, max_inflight)
+        self.failure_threshold = failure_threshold
+        self.ack_timeout = ack_timeout
+        self.state = 'queued'
+        self.reason = None
+        self.wave = 0
+        self.next = 0                           # index of the next device to upgrade
+        self.inflight = {}                      # devId -> time the upgrade was requested
+        self.succeeded = 0
+        self.failed = collections.OrderedDict() # devId -> reason
+        self.baseline = (0, 0)                  # (succeeded, failed) accepted when resumed
+        self.created = datetime.now(timezone.utc)
+        self.finished = None
+        self.stopped = threading.Event()
+        self.lock = threading.Condition()
+        self.thread = None
+
+    def progress(self) -> dict:
+        with self.lock:
+            return {
+                'rolloutId': self.id,
+                'state': self.state,
+                'reason': self.reason,
+                'fw_url': self.fw_url,
+                'fw_version': self.fw_version,
+                'waves': self.waves,
+                'wave': self.wave,
+                'total': len(self.devIds),
+                'requested': self.next,
+                'inflight': len(self.inflight),
+                'succeeded': self.succeeded,
+                'failed': len(self.failed),
+                'failures': [{'devId': d, 'reason': r} for d, r in list(self.failed.items())[-20:]],
+                'created': self.created.isoformat(),
+                'finished': self.finished.isoformat() if self.finished else None
+            }
+
+    def start(self):
+        if self.thread:
+            self.thread.join()      # the stopped thread exits within a second, so not called on the event loop
+        self.stopped.clear()
+        self.state = 'running'
+        self.reason = None
+        self.thread = threading.Thread(target=self.run, name=f'io7-rollout-{self.id}', daemon=True)
+        self.thread.start()
+
+    def stop(self, state: str, reason: str = None):
+        with self.lock:
+            self.state = state
+            self.reason = reason
+            self.stopped.set()
+            self.lock.notify_all()
+
+    def report(self, devId: str, kind: str, payload: bytes):
+        # called from the MQTT thread with the status/meta messages of the in-flight devices
+        result = upgrade_result(kind, payload, self.fw_version)
+        if result is not None:
+            with self.lock:
+                if self.inflight.pop(devId, None) is not None:
+                    if result:
+                        self.succeeded += 1
+                    else:
+                        self.failed[devId] = f'{kind} report'
+                    self.lock.notify_all()
+
+    def failure_rate(self) -> float:
+        succeeded = self.succeeded - self.baseline[0]
+        failed = len(self.failed) - self.baseline[1]
+        return failed / (succeeded + failed) if succeeded + failed else 0
+
+    def expire(self):
+        # called with the lock held
+        now = time.monotonic()
+        for devId, sent in list(self.inflight.items()):
+            if now - sent > self.ack_timeout:
+                del self.inflight[devId]
+                self.failed[devId] = 'timeout'
+
+    def run(self):
+        interval = 1 / settings.MGMT_RATE if settings.MGMT_RATE > 0 else 0
+        try:
+            while self.wave < len(self.waves) and not self.stopped.is_set():
+                target = math.ceil(len(self.devIds) * self.waves[self.wave] / 100)
+                logger.info(f'Rollout {self.id} wave {self.wave + 1}/{len(self.waves)}: up to {target} devices')
+                while self.next < target and not self.stopped.is_set():
+                    with self.lock:
+                        while not self.stopped.is_set() and (len(self.inflight) >= self.max_inflight
+                                                             or not mqClient.is_connected()):
+                            self.lock.wait(1)
+                            self.expire()
+                        if self.stopped.is_set():
+                            break
+                        devId = self.devIds[self.next]
+                        self.inflight[devId] = time.monotonic()
+                        self.next += 1
+                    topic, cmd = upgrade_firmware_message(devId, self.fw_url)
+                    info = mqClient.publish(topic, json.dumps(cmd), qos=1)
+                    if info.rc != MQTT_ERR_SUCCESS:
+                        # not sent(eg. disconnected), so the device is requested again rather than timed out
+                        with self.lock:
+                            self.inflight.pop(devId, None)
+                            self.next -= 1
+                        logger.debug(f'Rollout {self.id}: upgrade request to {devId} not sent(rc {info.rc}), retrying')
+                        self.stopped.wait(1)
+                        continue
+                    if self.check_failures():
+                        return
+                    self.stopped.wait(interval)
+                # the wave is finished when all of its devices reported or timed out
+                with self.lock:
+                    while self.inflight and not self.stopped.is_set():
+                        self.lock.wait(1)
+                        self.expire()
+                if self.check_failures():
+                    return
+                self.wave += 1
+            with self.lock:
+                if not self.stopped.is_set():
+                    self.state = 'done'
+        except Exception as e:
+            self.stop('failed', str(e))
+            logger.error(f'Rollout {self.id} failed: {e}')
+        finally:
+            if self.state != 'running':
+                self.finished = datetime.now(timezone.utc)
+            logger.info(f'Rollout {self.id} {self.state}: {self.succeeded} succeeded, {len(self.failed)} failed')
+
+    def check_failures(self) -> bool:
+        with self.lock:
+            self.expire()
+            if self.failure_rate() > self.failure_threshold:
+                self.stop('halted', f'failure rate {self.failure_rate():.0%} exceeds {self.failure_threshold:.0%}')
+                return True
+        return False
+
+    def resume(self):
+        with self.lock:
+            # the failures so far are accepted, so the threshold applies to the rest
+            self.baseline = (self.succeeded, len(self.failed))
+            self.finished = None
+        self.start()
+
+
+rollouts = collections.OrderedDict()
+rollouts_lock = threading.Lock()
+
+def start_rollout(devIds: list, fw_url: str, fw_version: str, waves: list,
+                  max_inflight: int = None, failure_threshold: float = None, ack_timeout: float = None) -> Rollout:
+    rollout = Rollout(devIds, fw_url, fw_version, waves,
+                      max_inflight or settings.ROLLOUT_MAX_INFLIGHT,
+                      failure_threshold if failure_threshold is not None else settings.ROLLOUT_FAILURE_THRESHOLD,
+                      ack_timeout or settings.ROLLOUT_ACK_TIMEOUT)
+    with rollouts_lock:
+        rollouts[rollout.id] = rollout
+        finished = [r for r in rollouts.values() if r.finished]
+        for old in finished[:max(0, len(finished) - settings.MGMT_JOBS_KEEP)]:
+            del rollouts[old.id]
+    rollout.start()
+    mgmt_state.start()
+    return rollout
+
+def control(rollout: Rollout, action: str):
+    if action == 'cancel' and rollout.state == 'running':
+        rollout.stop('cancelled')
+    elif action == 'resume' and rollout.state in ('halted', 'cancelled'):
+        rollout.resume()
+
+# with several workers, the rollout may be running on another one, so these may read Redis, call them with run_io
+def rollout_progress(rolloutId: str) -> dict:
+    rollout = rollouts.get(rolloutId)
+    return rollout.progress() if rollout else mgmt_state.remote_progress('rollouts', rolloutId)
+
+def request_rollout(rolloutId: str, action: str) -> dict:
+    # cancel or resume, forwarded to the worker running the rollout if it's not this one
+    rollout = rollouts.get(rolloutId)
+    if rollout:
+        control(rollout, action)
+        return rollout.progress()
+    progress = mgmt_state.remote_progress('rollouts', rolloutId)
+    if progress:
+        mgmt_state.forward('rollouts', rolloutId, action)
+    return progress
+
+def list_rollouts() -> list:
+    with rollouts_lock:
+        local = [rollout.progress() for rollout in reversed(rollouts.values())]
+    return mgmt_state.merged_progress('rollouts', local)
+
+mgmt_state.register('rollouts', rollouts, rollouts_lock, control)
+
+def device_report(devId: str, kind: str, payload: bytes):
+    # `iot3/<devId>/mgmt/device/status|meta`, only the running rollouts waiting for the device care.
+    # Every worker gets these reports(not a shared subscription), so they reach the worker running the rollout
+    for rollout in list(rollouts.values()):
+        if devId in rollout.inflight:
+            rollout.report(devId, kind, payload)
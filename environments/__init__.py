@@ -1,5 +1,9 @@
 from environments.settings import Settings
-from environments.database import Database
+from environments.io_executor import run_io
+from environments import profiling
+from environments.database import Database, AsyncDatabase
+from environments import shared_state
+from environments.dynsec_mirror import dynsec_mirror
 from environments.dynsec_db import (
     dynsec_role_exists,
     dynsec_get_admin,
@@ -7,6 +11,7 @@ from environments.dynsec_db import (
     dynsec_get_client,
     dynsec_get_appId,
     dynsec_get_device,
+    dynsec_get_device_apps,
     dynsec_all_devices,
     dynsec_all_appIds
 )
@@ -16,5 +21,10 @@ from environments.config_utils import (
     get_fieldset,
     set_fieldset,
     set_monitored,
-    config_db
-)
\ No newline at end of file
+    config_db,
+    config_cache
+)
+from environments.registry import DeviceRecord, AppRecord, device_registry, app_registry
+from environments.gateway_index import gateway_index
+from environments.responses import FastJSONResponse, ResponseCache, etag, not_modified
+from environments.presence import presence
\ No newline at end of file
@@ -0,0 +1,108 @@
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:         # gzip only
+    brotli = None
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        # the streamed parts are flushed, so the client gets them as they come
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class BrotliEncoder:
+    name = 'br'
+
+    def __init__(self, quality: int):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self.compressor.process(data) + (self.compressor.finish() if final else self.compressor.flush())
+
+def accepted_encodings(accept_encoding: str) -> set:
+    # the codings of Accept-Encoding, except the ones with q=0
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+class CompressionMiddleware:
+    """
+    Compresses the responses with brotli(br, if the brotli package is installed) or gzip,
+    whichever the client accepts, preferring br.
+
+    The responses smaller than minimum_size and the ones already encoded are sent as they are.
+    The streamed responses are compressed part by part, each part flushed, so they stay streamed.
+    """
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = max(1, minimum_size)
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'http':
+            accepted = accepted_encodings(Headers(scope=scope).get('accept-encoding', ''))
+            if brotli is not None and 'br' in accepted:
+                make_encoder = lambda: BrotliEncoder(self.brotli_quality)
+            elif 'gzip' in accepted:
+                make_encoder = lambda: GzipEncoder(self.gzip_level)
+            else:
+                make_encoder = None
+            if make_encoder:
+                await CompressionResponder(self.app, make_encoder, self.minimum_size)(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+class CompressionResponder:
+    def __init__(self, app: ASGIApp, make_encoder, minimum_size: int):
+        self.app = app
+        self.make_encoder = make_encoder
+        self.minimum_size = minimum_size
+        self.send = None
+        self.start = None           # held until the first body part tells whether to compress
+        self.encoder = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        if message['type'] == 'http.response.start':
+            self.start = message
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self.send(message)
+            return
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.encoder is None:
+            headers = MutableHeaders(raw=self.start['headers'])
+            if 'content-encoding' in headers or (len(body) < self.minimum_size and not more_body):
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send(message)
+                return
+            self.encoder = self.make_encoder()
+            body = self.encoder.compress(body, final=not more_body)
+            headers['Content-Encoding'] = self.encoder.name
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['Content-Length']
+            else:
+                headers['Content-Length'] = str(len(body))
+            await self.send(self.start)
+        else:
+            body = self.encoder.compress(body, final=not more_body)
+        await self.send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
@@ -1,6 +1,9 @@
 from environments import Database, Settings
 from models import ConfigVar
 
+import os
+import threading
+import time
 import logging
 settings = Settings()
 logger = logging.getLogger("uvicorn")
@@ -8,26 +11,92 @@ logger.setLevel(settings.LOG_LEVEL)
 
 config_db = Database('config_var')
 
+class ConfigCache:
+    """
+    In-memory copy of the configuration variables.
+
+    The reads are served from memory. The cache is reloaded when the table is written
+    through config_db, or when the table file is changed outside of this process
+    (eg. by another replica or an editor) which the watcher detects by the file mtime.
+    After a reload, the subscribers are called with the new values,
+    so they can rebuild what they precompute from the configuration.
+    """
+    def __init__(self, db: Database):
+        self.db = db
+        self.values = {}
+        self.callbacks = []
+        self.mtime = None
+        self.watcher = None
+        db.subscribe(self.on_change)
+
+    def load(self):
+        self.values = {var['key']: var['value'] for var in self.db.getAll()}
+        for callback in list(self.callbacks):
+            try:
+                callback(self.values)
+            except Exception as e:
+                logger.error(f'Config change callback failed: {e}')
+
+    def on_change(self, table: str, external: bool):
+        if not external:
+            self.mtime = self.file_mtime()     # our own write, the watcher needs not reload it again
+        self.load()
+
+    def get(self, key: str) -> str:
+        return self.values.get(key)
+
+    def subscribe(self, callback):
+        # callback(values) is called now and after every reload
+        self.callbacks.append(callback)
+        callback(self.values)
+
+    def file_mtime(self):
+        try:
+            return os.stat(self.db.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                mtime = self.file_mtime()
+                if mtime != self.mtime:
+                    logger.info('Configuration file changed, reloading')
+                    self.db.reload()
+                    self.mtime = mtime      # after the reload, so a failed one is retried on the next tick
+            except Exception:               # eg. a half written file, the watcher goes on
+                logger.exception('Configuration reload failed')
+
+    def start_watch(self, interval: float):
+        if interval > 0 and self.watcher is None:
+            self.mtime = self.file_mtime()
+            self.watcher = threading.Thread(target=self.watch, args=(interval,), name='io7-config-watch', daemon=True)
+            self.watcher.start()
+
+config_cache = ConfigCache(config_db)
+
 # utility function for configuratin variables
 def get_config(key : str) -> str:
-    if value:= config_db.getOne(config_db.qry.key == key):
-        if value['key'] == key:
-            return value['value']
-    return None
+    return config_cache.get(key)
 
 # utility functions for logging to influxdb
-def initFieldSets():
-    fieldsets = get_config("monitored_fieldsets")
-    if fieldsets:
-        return [f.strip() for f in fieldsets.split(',')]
-    else:
-        return []
-
 influxLogParams = {
-    "fieldsets" :  initFieldSets(),
-    "monitored" : get_config("monitored_devices") or ''
+    "fieldsets" :  [],
+    "monitored" : set()
 }
 
+def initInfluxLogParams(config: dict):
+    fieldsets = config.get("monitored_fieldsets")
+    influxLogParams["fieldsets"] = [f.strip() for f in fieldsets.split(',')] if fieldsets else []
+    monitored = config.get("monitored_devices") or ''
+    if monitored.strip() == '*':
+        influxLogParams["monitored"] = '*'
+    else:
+        influxLogParams["monitored"] = set(d.strip() for d in monitored.split(',') if d.strip() != '')
+
+config_cache.subscribe(initInfluxLogParams)      # config_cache.load() is called at the startup
+
 def is_monitored(device: str) -> bool:
     if influxLogParams["monitored"] == "*" or device in influxLogParams["monitored"]:
         return True
@@ -44,7 +113,6 @@ def set_fieldset(fields: str) -> list:
     """
     try:
         fieldsets = list(set([f.strip() for f in fields.split(',') if f.strip() != '' and ' ' not in f.strip()]))
-        influxLogParams["fieldsets"] = fieldsets
         config_db.insert(ConfigVar(key='monitored_fieldsets', value=', '.join(fieldsets)))
         return fieldsets
     except Exception as e:
@@ -60,12 +128,10 @@ def set_monitored(devices: str) -> list:
     try:
         if devices == '*':
             config_db.insert(ConfigVar(key='monitored_devices', value='*'))
-            influxLogParams['monitored'] = '*'
             return ['*']
         else:
             monitored = list(set([d.strip() for d in devices.split(',') if d.strip() != '' and ' ' not in d.strip()]))
-            influxLogParams['monitored'] = monitored
             config_db.insert(ConfigVar(key='monitored_devices', value=', '.join(monitored)))
             return monitored
     except Exception as e:
-        return []
\ No newline at end of file
+        return []
@@ -1,52 +1,309 @@
 from typing import List
+from contextlib import contextmanager
 
+import atexit
+import fcntl
+import functools
+import threading
+import time
+import uuid
 from pydantic import BaseModel
 from tinydb import TinyDB, Query
 from tinydb.queries import QueryLike
 from environments import Settings
+from environments.io_executor import run_io
+from environments.storage import WriteBehindStorage, AtomicJSONStorage
+from environments.metrics import Histogram
+from environments.profiling import record_span
 import os
+import logging
 
 settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+db_op_seconds = Histogram('io7_tinydb_operation_seconds', 'TinyDB operation time per table', ('table', 'op'))
+
+def timed(op: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                db_op_seconds.labels(self.table_name, op).observe(elapsed)
+                record_span(f'Database.{op}({self.table_name})', elapsed)
+        return wrapper
+    return decorator
+
+def shared_files() -> bool:
+    return settings.WORKERS > 1 or settings.SHARED_STATE
+
+def key_field(obj: BaseModel) -> str:
+    # the attribute that identifies the document of the object type
+    for key in ['email', 'devId', 'appId', 'key']:
+        if hasattr(obj, key):
+            return key
+    raise ValueError(f'No key field for {type(obj).__name__}')
 
 class Database:
     instances = {}
+    flusher = None
+    epoch = uuid.uuid4().hex[:8]        # tells the versions of this process apart from the other workers'/runs'
     def __init__(self, table):
         self.qry = Query()
 
     def __new__(cls, table):
         if table not in Database.instances:
             obj = super().__new__(cls)
-            os.path.exists(settings.DATABASE_DIR) or os.makedirs(settings.DATABASE_DIR)
-            obj.db = TinyDB(f'{settings.DATABASE_DIR}/{table}.json')
+            # TinyDB is not thread safe and shares one file handle per table,
+            # so every operation on the table is serialised with this lock
+            obj.lock = threading.RLock()
+            obj.table_name = table
+            obj.path = f'{settings.DATABASE_DIR}/{table}.json'
+            obj.listeners = []
+            obj._db = None
+            obj.version = 0             # incremented on every change of the table
+            obj.entity_versions = {}    # key value -> the version of its last change
+            obj.floor = 0               # the version of the last change whose documents are not known
             Database.instances[table] = obj
             return obj
         else:
             return Database.instances[table]
 
+    @property
+    def db(self) -> TinyDB:
+        # the table file is opened on the first use, so importing the modules has no side effects
+        if self._db is None:
+            with self.lock:
+                if self._db is None:
+                    os.path.exists(settings.DATABASE_DIR) or os.makedirs(settings.DATABASE_DIR)
+                    if settings.DB_WRITE_BEHIND and not shared_files():
+                        self._db = TinyDB(self.path, storage=WriteBehindStorage,
+                                          lock=self.lock, flush_threshold=settings.DB_FLUSH_THRESHOLD)
+                        Database.start_flusher()
+                    else:
+                        if settings.DB_WRITE_BEHIND:
+                            logger.warning('DB_WRITE_BEHIND is ignored, since the files are shared by several processes')
+                        self._db = TinyDB(self.path, storage=AtomicJSONStorage)
+                        if shared_files():
+                            # the other processes change the file, so the query results can't be cached
+                            self._db.table(self._db.default_table_name, cache_size=0)
+        return self._db
+
+    @contextmanager
+    def file_lock(self, exclusive: bool):
+        """
+        Inter-process lock of the table file in the shared state mode,
+        since a write is a read-modify-write of the whole file, which the others must not interleave with.
+        The writers also forget the cached next document id, which another process may have used.
+        """
+        if not shared_files():
+            yield
+            return
+        table = self.db.table(self.db.default_table_name)        # opens the table and creates the directory
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                if exclusive:
+                    table._next_id = None
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @classmethod
+    def start_flusher(cls):
+        if cls.flusher is None:
+            cls.flusher = threading.Thread(target=cls.flush_loop, name='io7-db-flusher', daemon=True)
+            cls.flusher.start()
+            atexit.register(cls.flush_all)
+
+    @classmethod
+    def flush_loop(cls):
+        while True:
+            time.sleep(settings.DB_FLUSH_INTERVAL)
+            cls.flush_all()
+
+    @classmethod
+    def flush_all(cls):
+        # writes the pending changes of the write-behind tables, no-op for the plain json tables
+        for obj in list(cls.instances.values()):
+            flush = obj._db and getattr(obj._db.storage, 'flush', None)
+            if flush:
+                flush()
+
+    def subscribe(self, callback, keys: bool = False):
+        """
+        registers callback(table, external) which is called after the table has changed.
+        external is False for the writes through this object and True when the table
+        is reloaded since it was changed outside of this process.
+        With keys=True it is called as callback(table, external, keys), keys being the key values
+        of the changed documents or None if they are not known
+        """
+        self.listeners.append((callback, keys))
+
+    def notify(self, external: bool = False, keys: list = None):
+        # keys: the key values of the changed documents, None if they are not known(eg. a delete by a query)
+        with self.lock:
+            self.version += 1
+            if keys is None:
+                self.floor = self.version
+            else:
+                for key in keys:
+                    self.entity_versions[key] = self.version
+        for callback, with_keys in list(self.listeners):
+            try:
+                callback(self.table_name, external, keys) if with_keys else callback(self.table_name, external)
+            except Exception as e:
+                logger.error(f'Table({self.table_name}) change listener failed: {e}')
+
+    def reload(self):
+        # drops what TinyDB and the storage have in memory and re-reads the table file
+        with self.lock:
+            reload = getattr(self.db.storage, 'reload', None)
+            if reload and not reload():
+                return
+            table = self.db.table(self.db.default_table_name)
+            table.clear_cache()
+            table._next_id = None
+        self.notify(external=True)
+
+    def tag(self, key: str = None) -> str:
+        """
+        the version of the table, or of the document with the key value, for the ETags.
+        It changes whenever the table(the document) may have changed, without reading the table
+        """
+        version = self.version if key is None else max(self.entity_versions.get(key, 0), self.floor)
+        return f'{self.table_name}.{Database.epoch}.{version}'
+
+    @timed('insert')
     def insert(self, obj: BaseModel) -> str:
         # insert() does not ensure uniqueness of the document 
         # if you introduce a new object type, 
-        # then you need to add the corresponding upsert statement
-        if hasattr(obj, 'email'):
-            return self.db.upsert(obj.dict(), self.qry.email == obj.email)
-        elif hasattr(obj, 'devId'):
-            return self.db.upsert(obj.dict(), self.qry.devId == obj.devId)
-        elif hasattr(obj, 'appId'):
-            return self.db.upsert(obj.dict(), self.qry.appId == obj.appId)
-        elif hasattr(obj, 'key'):
-            return self.db.upsert(obj.dict(), self.qry.key == obj.key)
+        # then you need to add the corresponding key in key_field()
+        key = key_field(obj)
+        with self.lock, self.file_lock(exclusive=True):
+            doc_ids = self.db.upsert(obj.dict(), self.qry[key] == getattr(obj, key))
+        self.notify(keys=[getattr(obj, key)])
+        return doc_ids
+
+    @timed('upsert_many')
+    def upsert_many(self, objs: List[BaseModel]) -> List[int]:
+        """
+        insert() for multiple objects, applied in memory and persisted with a single write
+        """
+        return self.batch(objs, replace=False)
+
+    @timed('replace_all')
+    def replace_all(self, objs: List[BaseModel]) -> List[int]:
+        """
+        replaces the whole table with the objects, applied in memory and persisted with a single write
+        so the table is either the old or the new one even if the process dies
+        """
+        return self.batch(objs, replace=True)
 
+    def batch(self, objs: List[BaseModel], replace: bool) -> List[int]:
+        doc_ids = []
+        if not objs and not replace:
+            return doc_ids
+        def updater(docs: dict):
+            if replace:
+                docs.clear()
+            index = {}
+            if objs:
+                key = key_field(objs[0])
+                index = {doc.get(key): doc_id for doc_id, doc in docs.items()}
+            next_id = max(docs.keys(), default=0) + 1
+            for obj in objs:
+                value = getattr(obj, key)
+                if value in index:
+                    docs[index[value]].update(obj.dict())
+                else:
+                    index[value] = next_id
+                    docs[next_id] = obj.dict()
+                    next_id += 1
+                doc_ids.append(index[value])
+
+        with self.lock, self.file_lock(exclusive=True):
+            table = self.db.table(self.db.default_table_name)
+            table._update_table(updater)      # one read and one write of the table
+            table._next_id = None             # the ids are assigned above, so let TinyDB recompute
+        self.notify(keys=None if replace or not objs else [getattr(obj, key_field(obj)) for obj in objs])
+        return doc_ids
+
+    @timed('getOne')
     def getOne(self, cond: QueryLike) -> BaseModel:
-        obj = self.db.search(cond)
+        with self.lock, self.file_lock(exclusive=False):
+            obj = self.db.search(cond)
         obj = obj[0] if len(obj) > 0 else None
         return obj
 
+    @timed('get')
     def get(self, cond: QueryLike) -> BaseModel:
-        obj = self.db.search(cond)
+        with self.lock, self.file_lock(exclusive=False):
+            obj = self.db.search(cond)
         return obj
 
+    @timed('getAll')
     def getAll(self) -> List[BaseModel]:
-        return self.db.all()
+        with self.lock, self.file_lock(exclusive=False):
+            return self.db.all()
 
+    @timed('delete')
     def delete(self, cond: QueryLike) -> str:         # return doc_id of deleted object
-        return self.db.remove(cond)
\ No newline at end of file
+        with self.lock, self.file_lock(exclusive=True):
+            doc_ids = self.db.remove(cond)
+        doc_ids and self.notify()
+        return doc_ids
+
+    @timed('delete_many')
+    def delete_many(self, key: str, values: List[str]) -> List[int]:
+        """
+        deletes the documents whose `key` is one of `values` with a single scan and write
+        """
+        if not values:
+            return []
+        with self.lock, self.file_lock(exclusive=True):
+            doc_ids = self.db.remove(self.qry[key].one_of(list(values)))
+        doc_ids and self.notify(keys=values)
+        return doc_ids
+
+
+class AsyncDatabase:
+    """
+    asyncio facade of Database for the route handlers.
+    The methods are the same as Database, but they run on the io executor.
+    The writes on a table are serialised by the table lock of Database.
+    """
+    def __init__(self, table):
+        self.sync = Database(table)
+        self.qry = self.sync.qry
+
+    async def insert(self, obj: BaseModel) -> str:
+        return await run_io(self.sync.insert, obj)
+
+    def tag(self, key: str = None) -> str:
+        return self.sync.tag(key)     # in memory, no need for the executor
+
+    async def getOne(self, cond: QueryLike) -> BaseModel:
+        return await run_io(self.sync.getOne, cond)
+
+    async def get(self, cond: QueryLike) -> BaseModel:
+        return await run_io(self.sync.get, cond)
+
+    async def getAll(self) -> List[BaseModel]:
+        return await run_io(self.sync.getAll)
+
+    async def delete(self, cond: QueryLike) -> str:
+        return await run_io(self.sync.delete, cond)
+
+    async def upsert_many(self, objs: List[BaseModel]) -> List[int]:
+        return await run_io(self.sync.upsert_many, objs)
+
+    async def replace_all(self, objs: List[BaseModel]) -> List[int]:
+        return await run_io(self.sync.replace_all, objs)
+
+    async def delete_many(self, key: str, values: List[str]) -> List[int]:
+        return await run_io(self.sync.delete_many, key, values)
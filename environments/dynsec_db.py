@@ -1,41 +1,49 @@
 from environments import Settings
+from environments.metrics import Histogram, Gauge
+from environments.profiling import record_span
+from environments.dynsec_mirror import dynsec_mirror
 import json
+import time
 
 settings = Settings()
 dynsec_file = settings.DynSecPath
 
+dynsec_load_seconds = Histogram('io7_dynsec_load_seconds', 'Time to read and parse the dynsec json file')
+dynsec_file_bytes = Gauge('io7_dynsec_file_bytes', 'Size of the dynsec json file at the last load')
+
 def load_dynsec():
+    start = time.perf_counter()
     try:
         with open(dynsec_file, "r") as file:
-            dynsec_json = json.load(file)
-        return dynsec_json
+            content = file.read()
+        dynsec_json = json.loads(content)
     except json.JSONDecodeError as e:
+        # mosquitto may be rewriting the file, so try once more
         with open(dynsec_file, "r") as file:
-            dynsec_json = json.load(file)
-        return dynsec_json
+            content = file.read()
+        dynsec_json = json.loads(content)
+    elapsed = time.perf_counter() - start
+    dynsec_load_seconds.observe(elapsed)
+    record_span('load_dynsec', elapsed)
+    dynsec_file_bytes.set(len(content))
+    return dynsec_json
 
+# the lookups are served by the in-memory mirror, load_dynsec() reads the file itself
 def dynsec_role_exists(roleId: str) -> bool:
-    roles = load_dynsec()['roles']
-    for role in roles:
-        if role['rolename'] == roleId:
-            return True
-    return False
+    return dynsec_mirror.role_exists(roleId)
 
 def dynsec_get_admin() -> str:
-    clients = load_dynsec()['clients']
-    for client in clients:
+    for client in dynsec_mirror.all_clients():
         for role in client['roles']:
             if role['rolename'] == 'admin':
                 return client['username']
     return None
 
 def dynsec_get_client(client_id):
-    dynsec_json = load_dynsec()
-    return next((c for c in dynsec_json.get("clients",[]) if c.get("username") == client_id), None)
+    return dynsec_mirror.get_client(client_id)
 
 def dynsec_get_role(role_id):
-    dynsec_json = load_dynsec()
-    return next((r for r in dynsec_json.get("roles",[]) if r.get("rolename") == role_id), None)
+    return dynsec_mirror.get_role(role_id)
 
 def dynsec_get_client_roleId(clientId):
     if c_id := dynsec_get_client(clientId):
@@ -81,10 +89,12 @@ def dynsec_get_appId(app_id):
             return dynsec_get_client(app_id)
     return None
 
+def dynsec_get_device_apps(dev_id):
+    # the restricted apps having dev_id as a member, from the member index of the mirror
+    return dynsec_mirror.device_apps(dev_id)
+
 def dynsec_all_devices():
-    dynsec_json = load_dynsec()
-    return [c.get('username') for c in dynsec_json.get("clients",[]) if c.get("username") == c.get("roles")[0].get("rolename")]
+    return [c.get('username') for c in dynsec_mirror.all_clients() if c.get("roles") and c.get("username") == c.get("roles")[0].get("rolename")]
 
 def dynsec_all_appIds():
-    dynsec_json = load_dynsec()
-    return [c.get('username') for c in dynsec_json.get("clients",[]) if c.get("roles")[0].get("rolename").startswith('$apps')]
\ No newline at end of file
+    return [c.get('username') for c in dynsec_mirror.all_clients() if c.get("roles") and c.get("roles")[0].get("rolename").startswith('$apps')]
\ No newline at end of file
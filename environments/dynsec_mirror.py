@@ -0,0 +1,272 @@
+import copy
+import json
+import os
+import threading
+import uuid
+import logging
+from environments.settings import Settings
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+class DynsecMirror:
+    """
+    In-memory model of the Mosquitto dynamic security clients and roles.
+
+    It is seeded from DynSecPath if the file is mounted, or from the listClients/listRoles responses
+    otherwise. After that, every command the server publishes(dynsec_publish()) is applied here as well,
+    so the lookups are dict lookups and see the changes right after they are sent, without waiting for
+    Mosquitto to rewrite the file.
+
+    Mosquitto handles the commands in order, so a resync(listClients/listRoles) response reflects all the
+    commands sent before it. The commands sent while a resync is pending are replayed on the new snapshot.
+    A failed command(other than 'already exists'/'not found', where the mirror is already right)
+    triggers a resync.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clients = {}           # username -> {'username', 'roles': [{'rolename', 'priority'}], ...}
+        self.roles = {}             # rolename -> {'rolename', 'acls': [...]}
+        self.acl_keys = {}          # rolename -> {(acltype, topic)}, built on the first ACL change of the role
+        self.members = {}           # devId -> {appId: {'evt': allow, 'cmd': allow}} from the $apps_<appId> roles
+        self.loaded = False
+        self.generation = 0         # incremented on every change, for the caches built on the mirror
+        self.resync_id = 0
+        self.instance = uuid.uuid4().hex[:12]  # in the resync correlation, the workers share the response topic
+        self.pending = None         # the resync in progress: {'clients': ..., 'roles': ..., 'replay': [...]}
+        self.request_resync = None  # set by the MQTT side, sends the resync commands
+        self.on_synced = None       # set by the MQTT side, called after a resync response is applied
+        self.waiting = False        # no DynSecPath file, the mirror is seeded by the broker resync
+
+    def seed_file(self, path: str) -> bool:
+        try:
+            with open(path, 'r') as file:
+                dynsec_json = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.info(f'Dynsec file {path} is not readable({e}), the mirror waits for the broker')
+            return False
+        self.replace(dynsec_json.get('clients', []), dynsec_json.get('roles', []))
+        return True
+
+    def ensure_loaded(self):
+        if self.loaded or self.waiting:
+            return
+        if settings.DynSecPath and os.path.exists(settings.DynSecPath):
+            with self.lock:
+                if not self.loaded:
+                    self.seed_file(settings.DynSecPath)
+        else:
+            self.waiting = True
+            logger.info('No dynsec file, the mirror waits for the broker resync')
+
+    def replace(self, clients: list, roles: list, replay: list = ()):
+        state_clients = {c['username']: self.client_entry(c) for c in clients}
+        state_roles = {r['rolename']: {'rolename': r['rolename'], 'acls': list(r.get('acls', []))} for r in roles}
+        with self.lock:
+            self.clients, self.roles = state_clients, state_roles
+            self.acl_keys = {}
+            self.members = {}
+            for role in state_roles.values():
+                self.index_acls(role['rolename'], role['acls'])
+            for command in replay:
+                self.apply_command(command)
+            self.loaded = True
+            self.generation += 1
+
+    @staticmethod
+    def client_entry(client: dict) -> dict:
+        # the password hash is not kept
+        entry = {k: v for k, v in client.items() if k not in ('password', 'salt', 'iterations', 'encoded_password')}
+        entry['roles'] = [dict(r) for r in client.get('roles', [])]
+        return entry
+
+    # the commands we publish
+    def apply(self, commands: list):
+        self.ensure_loaded()        # seeded first, so the seed doesn't drop the commands
+        with self.lock:
+            if self.pending is not None:
+                self.pending['replay'] += commands
+            self.generation += 1
+            removals = []
+            for command in commands:
+                try:
+                    # the consecutive removeRoleACLs of a role are applied with one pass over its ACLs
+                    if removals and (command.get('command') != 'removeRoleACL' or command['rolename'] != removals[0]['rolename']):
+                        self.remove_acls(removals)
+                        removals = []
+                    if command.get('command') == 'removeRoleACL':
+                        removals.append(command)
+                    else:
+                        self.apply_command(command)
+                except Exception as e:
+                    logger.error(f'Dynsec mirror could not apply {command.get("command")}: {e}')
+            if removals:
+                self.remove_acls(removals)
+
+    def apply_command(self, command: dict):
+        name = command.get('command')
+        if name == 'createClient':
+            if command['username'] not in self.clients:
+                self.clients[command['username']] = self.client_entry(command)
+        elif name == 'deleteClient':
+            self.clients.pop(command['username'], None)
+        elif name == 'modifyClient':
+            client = self.clients.get(command['username'])
+            if client and 'roles' in command:
+                client['roles'] = [dict(r) for r in command['roles']]
+        elif name == 'addClientRole':
+            client = self.clients.get(command['username'])
+            if client and not any(r['rolename'] == command['rolename'] for r in client['roles']):
+                role = {'rolename': command['rolename']}
+                if 'priority' in command:
+                    role['priority'] = command['priority']
+                client['roles'].append(role)
+        elif name == 'removeClientRole':
+            client = self.clients.get(command['username'])
+            if client:
+                client['roles'] = [r for r in client['roles'] if r['rolename'] != command['rolename']]
+        elif name == 'createRole':
+            if command['rolename'] not in self.roles:
+                self.roles[command['rolename']] = {'rolename': command['rolename'], 'acls': list(command.get('acls', []))}
+                self.acl_keys.pop(command['rolename'], None)
+                self.index_acls(command['rolename'], command.get('acls', []))
+        elif name == 'deleteRole':
+            self.acl_keys.pop(command['rolename'], None)
+            if (role := self.roles.pop(command['rolename'], None)) is not None:
+                self.index_acls(command['rolename'], role['acls'], add=False)
+                # mosquitto removes the role from the clients too
+                for client in self.clients.values():
+                    if any(r['rolename'] == command['rolename'] for r in client['roles']):
+                        client['roles'] = [r for r in client['roles'] if r['rolename'] != command['rolename']]
+        elif name == 'modifyRole':
+            role = self.roles.get(command['rolename'])
+            if role and 'acls' in command:
+                self.index_acls(command['rolename'], role['acls'], add=False)
+                role['acls'] = list(command['acls'])
+                self.acl_keys.pop(command['rolename'], None)
+                self.index_acls(command['rolename'], role['acls'])
+        elif name == 'addRoleACL':
+            role = self.roles.get(command['rolename'])
+            keys = self.role_acl_keys(command['rolename'])
+            if role and (command['acltype'], command['topic']) not in keys:
+                role['acls'].append({k: command[k] for k in ('acltype', 'topic', 'priority', 'allow') if k in command})
+                keys.add((command['acltype'], command['topic']))
+                self.index_acls(command['rolename'], role['acls'][-1:])
+        elif name == 'removeRoleACL':
+            self.remove_acls([command])
+
+    def role_acl_keys(self, rolename: str) -> set:
+        keys = self.acl_keys.get(rolename)
+        if keys is None:
+            role = self.roles.get(rolename) or {'acls': []}
+            keys = self.acl_keys[rolename] = {(a['acltype'], a['topic']) for a in role['acls']}
+        return keys
+
+    def remove_acls(self, commands: list):
+        # removeRoleACL commands of the same role
+        role = self.roles.get(commands[0]['rolename'])
+        keys = self.role_acl_keys(commands[0]['rolename'])
+        removed = {(c['acltype'], c['topic']) for c in commands} & keys
+        if role and removed:
+            self.index_acls(role['rolename'], [a for a in role['acls'] if (a['acltype'], a['topic']) in removed], add=False)
+            role['acls'] = [a for a in role['acls'] if (a['acltype'], a['topic']) not in removed]
+            keys -= removed
+
+    def index_acls(self, rolename: str, acls: list, add: bool = True):
+        # the member index, iot3/<devId>/evt/# and iot3/<devId>/cmd/# of the restricted apps' roles
+        if not rolename.startswith('$apps_'):
+            return
+        appId = rolename[len('$apps_'):]
+        for acl in acls:
+            topic = acl.get('topic', '').split('/')
+            if len(topic) < 3 or topic[2] not in ('evt', 'cmd'):
+                continue
+            apps = self.members.setdefault(topic[1], {})
+            if add:
+                apps.setdefault(appId, {})[topic[2]] = acl.get('allow', False)
+            elif appId in apps:
+                apps[appId].pop(topic[2], None)
+                if not apps[appId]:
+                    del apps[appId]
+            if not apps:
+                del self.members[topic[1]]
+
+    # the resync through the broker
+    def resync_commands(self) -> list:
+        with self.lock:
+            self.resync_id += 1
+            self.pending = {'clients': None, 'roles': None, 'replay': []}
+            correlation = self.resync_correlation()
+            return [
+                {'command': 'listClients', 'verbose': True, 'count': -1, 'correlationData': correlation},
+                {'command': 'listRoles', 'verbose': True, 'count': -1, 'correlationData': correlation}
+            ]
+
+    def resync_correlation(self) -> str:
+        return f'io7-resync-{self.instance}-{self.resync_id}'
+
+    def on_response(self, payload: bytes):
+        # `$CONTROL/dynamic-security/v1/response`
+        try:
+            responses = json.loads(payload).get('responses', [])
+        except (ValueError, AttributeError):
+            return
+        resync = synced = False
+        with self.lock:
+            for response in responses:
+                command = response.get('command')
+                correlation = response.get('correlationData')
+                if correlation and correlation.startswith('io7-resync-') and correlation != self.resync_correlation():
+                    continue        # another worker's resync, or an older one of ours
+                if correlation and correlation == self.resync_correlation() and self.pending is not None:
+                    if response.get('error'):
+                        logger.error(f'Dynsec {command} failed: {response["error"]}')
+                        self.pending = None
+                    elif command == 'listClients':
+                        self.pending['clients'] = response.get('data', {}).get('clients', [])
+                    elif command == 'listRoles':
+                        self.pending['roles'] = response.get('data', {}).get('roles', [])
+                    if self.pending and self.pending['clients'] is not None and self.pending['roles'] is not None:
+                        pending, self.pending = self.pending, None
+                        self.replace(pending['clients'], pending['roles'], pending['replay'])
+                        synced = True
+                        logger.info(f'Dynsec mirror synced, {len(self.clients)} clients and {len(self.roles)} roles')
+                elif response.get('error'):
+                    error = response['error'].lower()
+                    if 'already exists' not in error and 'not found' not in error:
+                        logger.warning(f'Dynsec {command} failed: {response["error"]}, resyncing the mirror')
+                        resync = True
+        # outside of the lock, the callbacks publish dynsec commands
+        if synced and self.on_synced:
+            self.on_synced()
+        if resync and self.request_resync:
+            self.request_resync()
+
+    # the lookups, the returned objects are copies so the callers can modify them
+    def get_client(self, username: str) -> dict:
+        self.ensure_loaded()
+        client = self.clients.get(username)
+        return copy.deepcopy(client) if client else None
+
+    def get_role(self, rolename: str) -> dict:
+        self.ensure_loaded()
+        role = self.roles.get(rolename)
+        return copy.deepcopy(role) if role else None
+
+    def role_exists(self, rolename: str) -> bool:
+        self.ensure_loaded()
+        return rolename in self.roles
+
+    def device_apps(self, devId: str) -> list:
+        self.ensure_loaded()
+        with self.lock:
+            return [{'appId': appId, 'evt': access.get('evt', False), 'cmd': access.get('cmd', False)}
+                    for appId, access in self.members.get(devId, {}).items()]
+
+    def all_clients(self) -> list:
+        self.ensure_loaded()
+        with self.lock:
+            return list(self.clients.values())
+
+dynsec_mirror = DynsecMirror()
@@ -0,0 +1,160 @@
+import collections
+import json
+import random
+import threading
+import logging
+from environments.settings import Settings
+from environments.registry import Registry, device_registry
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+class GatewayIndex:
+    """
+    gateway -> edge devices index for the `iot3/<gw>/gateway/query` replies.
+
+    It is built from the device registry on the first use, and kept up to date by the device
+    add/update/delete paths through set_device() and remove(). When the table is reloaded because
+    it was changed outside of this process, it is rebuilt and the differences are logged as changes.
+
+    Every change of a gateway's edge list gets a new version number and is kept in a short per gateway log,
+    so a gateway that already has the list can ask for the changes since its version.
+    With several workers the queries are load balanced($share), so a gateway may ask a different
+    process than the one that gave it the version. The version numbers carry a random per process epoch
+    in the high bits(epoch << 32 | counter), and a since of another epoch, another worker's or a previous
+    run's, is answered with the full list rather than a delta of an unrelated log.
+    They stay below 2**53, so they are exact in JSON for any client.
+    The serialized replies are cached per gateway, so a burst of queries after a broker restart
+    costs a dict lookup each.
+    """
+    def __init__(self, registry: Registry, log_size: int = 100):
+        self.registry = registry
+        self.lock = threading.RLock()
+        self.log_size = log_size
+        self.loaded = False
+        self.epoch = random.randrange(1, 1 << 21)
+        self.version = self.epoch << 32
+        self.edges = {}         # gateway -> {edge: None}, a dict to keep the registration order
+        self.owner = {}         # edge -> gateway
+        self.versions = {}      # gateway -> version of its edge list
+        self.floor = {}         # gateway -> the oldest version the log can answer a delta from
+        self.log = {}           # gateway -> deque of (version, added, removed)
+        self.replies = {}       # gateway -> serialized full list
+        registry.db.subscribe(self.on_change)
+
+    def on_change(self, table: str, external: bool):
+        if external:
+            with self.lock:
+                self.loaded = False     # rebuilt on the next query
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            edges = {}
+            for record in self.registry.all().values():
+                if record.type == 'gateway':
+                    edges.setdefault(record.devId, {})
+                elif record.type == 'edge':
+                    edges.setdefault(record.createdBy, {})[record.devId] = None
+            old_edges, self.edges = self.edges, edges
+            self.owner = {edge: gw for gw, gw_edges in edges.items() for edge in gw_edges}
+            for gw in set(old_edges) | set(edges):
+                old, new = old_edges.get(gw, {}), edges.get(gw, {})
+                added = [e for e in new if e not in old]
+                removed = [e for e in old if e not in new]
+                if added or removed or gw not in self.versions:
+                    self.changed(gw, added, removed)
+            self.loaded = True
+
+    def changed(self, gw: str, added: list, removed: list):
+        # called with the lock held
+        self.version += 1
+        if gw not in self.log:
+            self.log[gw] = collections.deque(maxlen=self.log_size)
+            self.floor[gw] = self.version
+        elif len(self.log[gw]) == self.log_size:
+            self.floor[gw] = self.log[gw][0][0]    # the oldest entry is about to be dropped
+        self.log[gw].append((self.version, added, removed))
+        self.versions[gw] = self.version
+        self.replies.pop(gw, None)
+
+    def set_device(self, device: dict):
+        # after a device is inserted or updated
+        with self.lock:
+            if not self.loaded:
+                return          # will be built from the table
+            devId = device['devId']
+            old_gw = self.owner.get(devId)
+            new_gw = device['createdBy'] if device.get('type') == 'edge' else None
+            if old_gw == new_gw:
+                if device.get('type') == 'gateway' and devId not in self.edges:
+                    self.edges[devId] = {}
+                    self.changed(devId, [], [])
+                return
+            if old_gw:
+                del self.edges[old_gw][devId]
+                del self.owner[devId]
+                self.changed(old_gw, [], [devId])
+            if new_gw:
+                self.edges.setdefault(new_gw, {})[devId] = None
+                self.owner[devId] = new_gw
+                self.changed(new_gw, [devId], [])
+
+    def remove(self, devIds: list):
+        # after the devices are deleted, gateways included
+        with self.lock:
+            if not self.loaded:
+                return
+            removed = {}
+            for devId in devIds:
+                gw = self.owner.pop(devId, None)
+                if gw:
+                    self.edges[gw].pop(devId, None)
+                    removed.setdefault(gw, []).append(devId)
+            for gw, edges in removed.items():
+                self.changed(gw, [], edges)
+            for devId in devIds:
+                if devId in self.edges:
+                    for edge in self.edges.pop(devId):
+                        self.owner.pop(edge, None)
+                    for table in (self.versions, self.floor, self.log, self.replies):
+                        table.pop(devId, None)
+
+    def get_edges(self, gw: str) -> list:
+        self.ensure_loaded()
+        with self.lock:
+            return list(self.edges.get(gw, {}))
+
+    def reply(self, gw: str, since: int = None) -> str:
+        """
+        The payload for `iot3/<gw>/gateway/list`.
+        Without since, it's the json list of the edges followed by the gateway itself as before.
+        With since, it's {"version": v, "devices": [...]} or, if the log goes back to since,
+        {"version": v, "since": since, "added": [...], "removed": [...]}.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            if since is None:
+                reply = self.replies.get(gw)
+                if reply is None:
+                    reply = self.replies[gw] = json.dumps(list(self.edges.get(gw, {})) + [gw])
+                return reply
+            version = self.versions.get(gw, self.version)
+            if gw not in self.log or since >> 32 != self.epoch or since < self.floor[gw] or since > version:
+                return json.dumps({'version': version, 'devices': list(self.edges.get(gw, {})) + [gw]})
+            added, removed = {}, {}
+            for entry_version, entry_added, entry_removed in self.log[gw]:
+                if entry_version > since:
+                    for devId in entry_added:
+                        removed.pop(devId, None)
+                        added[devId] = None
+                    for devId in entry_removed:
+                        added.pop(devId, None)
+                        removed[devId] = None
+            return json.dumps({'version': version, 'since': since, 'added': list(added), 'removed': list(removed)})
+
+gateway_index = GatewayIndex(device_registry)
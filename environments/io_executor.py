@@ -0,0 +1,18 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from environments.settings import Settings
+from environments.profiling import profiled
+
+settings = Settings()
+
+# blocking TinyDB and dynsec file work from the route handlers runs here,
+# so a slow disk doesn't stall the event loop
+io_executor = ThreadPoolExecutor(max_workers=settings.IO_WORKERS, thread_name_prefix='io7-io')
+
+async def run_io(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # run in a copy of the caller's context, so the request profile sees the spans(and the cProfile stats) of the blocking work
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(io_executor, functools.partial(context.run, profiled, func, *args, **kwargs))
@@ -0,0 +1,179 @@
+from bisect import bisect_left
+import math
+import time
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Minimal Prometheus metrics, rendered in the text exposition format by render().
+# The children of the labelled metrics are cached, so the hot path
+# pre-binds them with labels() once and observe()/inc() is a list index and an addition.
+# The updates are not locked, which may lose an increment under a thread switch; fine for metrics.
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+registry = []
+
+def escape_label(value) -> str:
+    # backslash, double quote and newline are escaped in the label values of the text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    kind = 'untyped'
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def header(self):
+        return [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+
+
+class CounterChild:
+    __slots__ = ('value',)
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    kind = 'counter'
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def render(self):
+        lines = self.header()
+        for values, child in list(self.children.items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, values)} {format_value(child.value)}')
+        return lines
+
+
+class GaugeChild:
+    __slots__ = ('value',)
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(Metric):
+    """
+    Gauge whose value is set, or read from `callback` at the scrape time
+    """
+    kind = 'gauge'
+    def __init__(self, name: str, doc: str, labels: tuple = (), callback=None):
+        super().__init__(name, doc, labels)
+        self.callback = callback
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def render(self):
+        lines = self.header()
+        if self.callback:
+            lines.append(f'{self.name} {format_value(self.callback())}')
+        for values, child in list(self.children.items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, values)} {format_value(child.value)}')
+        return lines
+
+
+class HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.bounds = sorted(buckets)
+
+    def new_child(self):
+        return HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = self.header()
+        for values, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + [math.inf], list(child.counts)):
+                cumulative += count
+                le = format_labels(self.label_names, values, f'le="{format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = format_labels(self.label_names, values)
+            lines.append(f'{self.name}_sum{labels} {format_value(child.sum)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class LatencyMiddleware:
+    """
+    Observes the time to the end of each HTTP response in `histogram`, labelled by
+    the method, route_of(scope) and the status code.
+    Plain ASGI, so the responses are not wrapped and the streamed ones stay streamed.
+    """
+    def __init__(self, app: ASGIApp, histogram: Histogram, route_of):
+        self.app = app
+        self.histogram = histogram
+        self.route_of = route_of
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_status(message: Message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # the router has put the endpoint in the scope by now
+            self.histogram.labels(scope['method'], self.route_of(scope), status_code).observe(time.perf_counter() - start)
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
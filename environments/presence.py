@@ -0,0 +1,200 @@
+import json
+import threading
+import time
+import logging
+import redis
+from environments.settings import Settings
+from environments.database import shared_files
+from environments.registry import Registry, device_registry
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+SNAPSHOT_KEY = 'io7:presence'
+
+class Presence:
+    """
+    Online/offline state of the devices from their `iot3/<devId>/evt/connection` events.
+
+    devId -> (online, last seen) is kept in memory, with the online devices also grouped
+    by the device type and by the gateway of the edges, so the listings are O(result)
+    and the counts are O(1). The type and the gateway of a device come from the device registry,
+    and only the changed devices are regrouped when it changes, all of them when it is rebuilt.
+
+    The changes are written to the Redis hash `io7:presence` periodically, and read back at the startup.
+    In the shared state mode every worker sees a part of the events, so the hash is also merged back
+    at every snapshot, the newer entry winning.
+    """
+    def __init__(self, registry: Registry):
+        self.registry = registry
+        self.lock = threading.RLock()
+        self.state = {}         # devId -> (online, last seen in epoch seconds)
+        self.online = {}        # 'type:<type>' or 'gateway:<gw>' -> set of online devIds, '*' for all
+        self.grouped = {}       # online devId -> the keys of self.online it is in
+        self.devices = None     # the registry records the groups are built from
+        self.regroup = True     # all the devices to be regrouped
+        self.changed = set()    # devIds to be regrouped, changed in the registry
+        self.dirty = set()      # devIds changed since the last snapshot
+        self.redis = None
+        self.snapshotter = None
+        registry.subscribe(self.on_devices)
+
+    def on_devices(self, devIds: list):
+        # from the registry on the writing thread, the regrouping is left to the next use
+        with self.lock:
+            if devIds is None:
+                self.regroup = True
+            else:
+                self.changed.update(devIds)
+
+    def ensure_devices(self):
+        # called with the lock held, regroups the online devices changed in the registry
+        self.devices = self.registry.all()
+        if self.regroup:
+            self.regroup = False
+            self.changed = set()
+            self.online = {}
+            self.grouped = {}
+            for devId, (online, last_seen) in self.state.items():
+                if online:
+                    self.group(devId)
+        elif self.changed:
+            changed, self.changed = self.changed, set()
+            for devId in changed:
+                if devId in self.grouped:
+                    self.ungroup(devId)
+                    self.group(devId)
+
+    def group(self, devId: str):
+        keys = self.grouped[devId] = self.keys(devId)
+        for key in keys:
+            self.online.setdefault(key, set()).add(devId)
+
+    def ungroup(self, devId: str):
+        for key in self.grouped.pop(devId, ()):
+            self.online[key].discard(devId)
+
+    def keys(self, devId: str) -> list:
+        record = self.devices.get(devId)
+        devType, gateway = (record.type, record.gateway) if record else ('unknown', None)
+        return ['*', f'type:{devType}', f'gateway:{gateway}'] if gateway else ['*', f'type:{devType}']
+
+    def update(self, devId: str, online: bool, last_seen: float = None):
+        with self.lock:
+            self.ensure_devices()
+            self.set_state(devId, online, last_seen or time.time())
+
+    def set_state(self, devId: str, online: bool, last_seen: float):
+        # called with the lock held
+        was_online = self.state.get(devId, (False, 0))[0]
+        self.state[devId] = (online, last_seen)
+        self.dirty.add(devId)
+        if online != was_online:
+            self.group(devId) if online else self.ungroup(devId)
+
+    def connection_event(self, devId: str, payload: bytes):
+        # {"d":{"status":"online"}} or {"d":{"status":"offline"}}, also as the will message
+        try:
+            status = json.loads(payload)['d']['status']
+        except (ValueError, KeyError, TypeError):
+            logger.debug(f'Invalid connection event from {devId}')
+            return
+        if status in ('online', 'offline'):
+            self.update(devId, status == 'online')
+
+    def seen(self, devId: str):
+        # any event of an online device refreshes its last seen time, a dict lookup on the event hot path.
+        # It runs on the MQTT thread, so under the lock like the snapshot iterating `dirty`
+        with self.lock:
+            entry = self.state.get(devId)
+            if entry and entry[0]:
+                self.state[devId] = (True, time.time())
+                self.dirty.add(devId)
+
+    def remove(self, devIds: list):
+        # after the devices are deleted
+        with self.lock:
+            for devId in devIds:
+                if self.state.pop(devId, None):
+                    self.dirty.add(devId)
+                    self.ungroup(devId)
+
+    def get_online(self, type: str = None, gateway: str = None) -> list:
+        with self.lock:
+            self.ensure_devices()
+            key = f'gateway:{gateway}' if gateway else f'type:{type}' if type else '*'
+            devIds = self.online.get(key, set())
+            if gateway and type:
+                devIds = devIds & self.online.get(f'type:{type}', set())
+            return [{'devId': devId, 'lastSeen': self.state[devId][1]} for devId in devIds]
+
+    def counts(self) -> dict:
+        with self.lock:
+            self.ensure_devices()
+            result = {'total': len(self.online.get('*', ())), 'type': {}, 'gateway': {}}
+            for key, devIds in self.online.items():
+                if key != '*' and devIds:
+                    kind, name = key.split(':', 1)
+                    result[kind][name] = len(devIds)
+            return result
+
+    def restore(self):
+        snapshot = self.redis.hgetall(SNAPSHOT_KEY)     # not under the lock, the table change callbacks take it
+        with self.lock:
+            self.ensure_devices()
+            for devId, value in snapshot.items():
+                devId = devId.decode()
+                online, last_seen = json.loads(value)
+                if devId not in self.devices:
+                    continue            # deleted meanwhile
+                if last_seen > self.state.get(devId, (False, 0))[1]:
+                    self.set_state(devId, online, last_seen)
+                    self.dirty.discard(devId)
+
+    def snapshot(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            changed = {devId: json.dumps(self.state[devId]) for devId in dirty if devId in self.state}
+            deleted = [devId for devId in dirty if devId not in self.state]
+        try:
+            pipe = self.redis.pipeline()
+            if changed:
+                pipe.hset(SNAPSHOT_KEY, mapping=changed)
+            if deleted:
+                pipe.hdel(SNAPSHOT_KEY, *deleted)
+            pipe.execute()
+            if shared_files():
+                self.restore()          # the other workers' changes
+        except Exception as e:
+            with self.lock:
+                self.dirty.update(changed)
+                self.dirty.update(deleted)
+            logger.warning(f'Presence snapshot failed: {e}')
+
+    def snapshot_loop(self, interval: float):
+        restored = False
+        while True:
+            if not restored:
+                try:
+                    self.restore()
+                    restored = True
+                except Exception as e:
+                    logger.warning(f'Presence restore failed: {e}')
+            time.sleep(interval)
+            if restored:
+                try:
+                    self.snapshot()
+                except Exception as e:      # the snapshots go on with the next interval
+                    logger.error(f'Presence snapshot failed: {e}')
+
+    def start(self, interval: float):
+        if interval > 0 and self.snapshotter is None:
+            self.redis = redis.Redis(
+                host=getattr(settings, 'REDIS_HOST', 'redis'),
+                port=getattr(settings, 'REDIS_PORT', 6379), db=0, socket_connect_timeout=2)
+            self.snapshotter = threading.Thread(target=self.snapshot_loop, args=(interval,),
+                                                name='io7-presence', daemon=True)
+            self.snapshotter.start()
+
+presence = Presence(device_registry)
@@ -0,0 +1,142 @@
+import collections
+import contextvars
+import cProfile
+import io
+import itertools
+import pstats
+import random
+import time
+from datetime import datetime, timezone
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from environments.settings import Settings
+
+settings = Settings()
+
+# the profile of the request being served, visible to the code running for it
+# (also on the io executor, since run_io() copies the context)
+current_profile = contextvars.ContextVar('io7_profile', default=None)
+
+reports = collections.deque(maxlen=settings.PROFILE_KEEP)
+report_ids = itertools.count(1)
+profiler_busy = False
+
+def enabled() -> bool:
+    return settings.PROFILE_SAMPLE_RATE > 0 or settings.PROFILE_SLOW_MS > 0
+
+def record_span(name: str, seconds: float):
+    # called on the hot paths, costs a context variable lookup when no request is profiled
+    profile = current_profile.get()
+    if profile is not None:
+        profile.spans.append((name, seconds))
+
+
+class RequestProfile:
+    """
+    Collects the spans of a request, and the cProfile stats if the request is sampled.
+    Only one request is cProfiled at a time, since cProfile hooks the event loop thread
+    and the concurrent requests would be mixed into the stats otherwise.
+    The blocking work of the request on the io executor(run_io()) is profiled on its thread
+    by profiled(), and merged into the stats of the report.
+    """
+    def __init__(self, method: str, path: str):
+        global profiler_busy
+        self.method = method
+        self.path = path
+        self.started = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.spans = []
+        self.profiler = None
+        self.io_profilers = []      # of the run_io() calls, appended from the executor threads
+        if random.random() < settings.PROFILE_SAMPLE_RATE and not profiler_busy:
+            profiler_busy = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.token = current_profile.set(self)
+
+    def finish(self, status_code: int):
+        global profiler_busy
+        duration = time.perf_counter() - self.start
+        current_profile.reset(self.token)
+        if self.profiler:
+            self.profiler.disable()
+            profiler_busy = False
+        slow = settings.PROFILE_SLOW_MS > 0 and duration * 1000 >= settings.PROFILE_SLOW_MS
+        if self.profiler or slow:
+            reports.append(self.report(status_code, duration, slow))
+
+    def report(self, status_code: int, duration: float, slow: bool) -> dict:
+        spans = {}
+        for name, seconds in self.spans:
+            span = spans.setdefault(name, {'count': 0, 'total_ms': 0.0})
+            span['count'] += 1
+            span['total_ms'] += seconds * 1000
+        for span in spans.values():
+            span['total_ms'] = round(span['total_ms'], 3)
+        report = {
+            'id': next(report_ids),
+            'method': self.method,
+            'path': self.path,
+            'status': status_code,
+            'started': self.started.isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'reason': 'sampled' if self.profiler else 'slow',
+            'spans': dict(sorted(spans.items(), key=lambda s: -s[1]['total_ms']))
+        }
+        if self.profiler:
+            out = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=out)
+            for profiler in self.io_profilers:
+                stats.add(profiler)
+            stats.sort_stats('cumulative').print_stats(settings.PROFILE_TOP)
+            report['profile'] = out.getvalue()
+            report['profiled'] = f'event loop and {len(self.io_profilers)} run_io calls'
+        return report
+
+
+class ProfileMiddleware:
+    """
+    Profiles each HTTP request with RequestProfile, to the end of its response.
+    Plain ASGI, so the route runs in the task of the request and sees its profile in current_profile.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile(scope['method'], scope['path'])
+        status_code = 500
+
+        async def send_status(message: Message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            profile.finish(status_code)
+
+
+def profiled(func, *args, **kwargs):
+    # run_io() runs the blocking work through this, so the stats of a sampled request include the executor threads
+    profile = current_profile.get()
+    if profile is None or profile.profiler is None:
+        return func(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:          # another profiler is active(Python 3.12+ allows one per interpreter)
+        return func(*args, **kwargs)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profile.io_profilers.append(profiler)
+
+def get_reports(limit: int = None) -> list:
+    # the newest first
+    result = list(reversed(reports))
+    return result[:limit] if limit else result
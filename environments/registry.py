@@ -0,0 +1,96 @@
+import sys
+import threading
+from environments.database import Database
+from models import Device, IOTApp
+
+class DeviceRecord:
+    """
+    The fields of a device row the caches and the indexes use, without the per-dict overhead.
+    The ids and the repeated values(type, createdBy) are interned, so the indexes built from
+    the records share one string object per id instead of holding their own copies.
+    """
+    __slots__ = ('devId', 'type', 'createdBy')
+
+    def __init__(self, devId: str, type: str = 'device', createdBy: str = 'admin'):
+        self.devId = sys.intern(devId)
+        self.type = sys.intern(type or 'device')
+        self.createdBy = sys.intern(createdBy or 'admin')
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> 'DeviceRecord':
+        return cls(doc['devId'], doc.get('type'), doc.get('createdBy'))
+
+    @property
+    def gateway(self) -> str:
+        # the gateway of an edge
+        return self.createdBy if self.type == 'edge' else None
+
+class AppRecord:
+    __slots__ = ('appId', 'restricted', 'createdBy')
+
+    def __init__(self, appId: str, restricted: bool = False, createdBy: str = 'admin'):
+        self.appId = sys.intern(appId)
+        self.restricted = bool(restricted)
+        self.createdBy = sys.intern(createdBy or 'admin')
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> 'AppRecord':
+        return cls(doc['appId'], doc.get('restricted'), doc.get('createdBy'))
+
+class Registry:
+    """
+    id -> record of a table, shared by the caches and the indexes(gateway_index, presence, reconcile, ...)
+    so they don't each keep the rows or scan the table as TinyDB Documents.
+
+    It is built on the first use. The writes with known keys patch only those records, the others
+    (a delete by a query, replace_all, a reload) have it rebuilt on the next use. The full rows
+    and the pydantic models are only built at the API boundary, from the table itself.
+    """
+    def __init__(self, db: Database, key: str, make_record):
+        self.db = db
+        self.key = key
+        self.make_record = make_record
+        self.lock = threading.Lock()
+        self.records = None
+        self.listeners = []
+        db.subscribe(self.on_change, keys=True)
+
+    def subscribe(self, callback):
+        # callback(ids) after the records changed, ids None if all of them may have changed
+        self.listeners.append(callback)
+
+    def on_change(self, table: str, external: bool, keys: list):
+        if external or keys is None:
+            with self.lock:
+                self.records = None
+        else:
+            with self.lock:
+                if self.records is not None:
+                    # read under the lock, so the patches of concurrent writes land in order
+                    docs = {doc[self.key]: doc for doc in self.db.get(self.db.qry[self.key].one_of(list(keys)))}
+                    records = dict(self.records)        # copied, the old dict may be iterated meanwhile
+                    for id in keys:
+                        doc = docs.get(id)
+                        if doc:
+                            records[id] = self.make_record(doc)
+                        else:
+                            records.pop(id, None)       # deleted
+                    self.records = records
+        for callback in list(self.listeners):
+            callback(None if external else keys)
+
+    def all(self) -> dict:
+        # the returned dict is replaced, not modified, on the changes, so it can be iterated without the lock
+        records = self.records
+        if records is None:
+            with self.lock:
+                records = self.records
+                if records is None:
+                    records = self.records = {doc[self.key]: self.make_record(doc) for doc in self.db.getAll()}
+        return records
+
+    def get(self, id: str):
+        return self.all().get(id)
+
+device_registry = Registry(Database(Device.Settings.name), 'devId', DeviceRecord.from_doc)
+app_registry = Registry(Database(IOTApp.Settings.name), 'appId', AppRecord.from_doc)
@@ -0,0 +1,78 @@
+import json
+import threading
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:         # falls back to the json module
+    orjson = None
+
+def json_default(obj):
+    # datetime/date(eg. the default createdDate of the models), orjson handles them itself
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default)
+    return json.dumps(content, default=json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def etag(*parts) -> str:
+    # a weak ETag from the versions the response depends on, eg. Database.tag() and the dynsec mirror generation
+    return 'W/"' + '-'.join(str(part) for part in parts) + '"'
+
+def not_modified(request: Request, tag: str) -> Response:
+    # 304 if If-None-Match has the current ETag, None otherwise
+    match = request.headers.get('if-none-match')
+    if not match:
+        return None
+    weak = lambda t: t.strip().removeprefix('W/')
+    if match.strip() == '*' or weak(tag) in [weak(t) for t in match.split(',')]:
+        return Response(status_code=304, headers={'ETag': tag})
+    return None
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response for the trusted internal data, eg. the registry rows, serialised with orjson if it's installed.
+    The content is not validated against the response_model of the route, which only documents the schema.
+    bytes are taken as already serialised, eg. from ResponseCache.
+    """
+    def render(self, content) -> bytes:
+        return content if isinstance(content, bytes) else dumps(content)
+
+class ResponseCache:
+    """
+    Serialised responses of a collection(eg. the device list) by the variant of the request.
+
+    The entries are dropped when the tables change, through the Database listeners,
+    and the state without listeners is checked with stamp(), eg. the generation of the dynsec mirror.
+    """
+    def __init__(self, dbs: list, stamp=lambda: None):
+        self.entries = {}       # key -> (stamp, bytes)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.stamp = stamp
+        for db in dbs:
+            db.subscribe(self.on_change)
+
+    def on_change(self, table: str, external: bool):
+        self.generation += 1
+        self.entries = {}
+
+    def get(self, key, build) -> bytes:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == self.stamp():
+            return entry[1]
+        with self.lock:
+            # the concurrent requests missing the cache wait for one build
+            stamp = self.stamp()
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+            generation = self.generation
+            body = dumps(build())
+            if generation == self.generation:
+                self.entries[key] = (stamp, body)   # not if the table changed while building
+            return body
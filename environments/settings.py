@@ -15,7 +15,15 @@ class Settings(BaseSettings):
     SSL_KEY: Optional[str] = None           # SSL Key Path
     SSL_CERT: Optional[str] = None          # SSL Cert Path
     PORT: int = 3001                        # API Server Port
+    WORKERS: int = 1                        # API Server worker processes, >1 turns on the shared state mode
+    SHARED_STATE: bool = False              # Share the state through Redis/files, for the replicas of a single worker
     HOST: str = '0.0.0.0'                   # API Server Host
+    HTTP2: bool = False                     # Serve with hypercorn, which speaks HTTP/2(h2 with SSL, h2c without)
+    KEEPALIVE_TIMEOUT: float = 5            # Seconds an idle keep-alive connection is kept open
+    BACKLOG: int = 2048                     # Max connections waiting to be accepted
+    COMPRESS_MIN_SIZE: int = 1024           # Responses from this size(bytes) are compressed(br/gzip), 0 to disable
+    COMPRESS_GZIP_LEVEL: int = 6            # gzip level(1-9)
+    COMPRESS_BROTLI_QUALITY: int = 4        # brotli quality(0-11), used if the brotli package is installed
     TEMPLATES = Jinja2Templates(directory="html/")  # Jinja2 Templates Directory
     DynSecUser: Optional[str] = None        # Mosquitto Dynamic Security User
     DynSecPass: Optional[str] = None        # Mosquitto Dynamic Security Password
@@ -23,8 +31,40 @@ class Settings(BaseSettings):
     MQTT_HOST: Optional[str] = "127.0.0.1"  # MQTT Host
     MQTT_PORT: Optional[int] = 1883         # MQTT Port
     MQTT_SSL_CERT: Optional[str] = None     # MQTT SSL Cert Path
+    MQTT_RECONNECT_MAX: int = 60            # Max seconds between MQTT (re)connect attempts, backing off from 1s
     INFLUXDB_PROTOCOL: Optional[str] = "http"   # INFLUXDB Access Protocol
     LOG_LEVEL: Optional[str] = "INFO"       # Log Level
+    BCRYPT_ROUNDS: int = 12                 # bcrypt cost, hashes with other costs are upgraded on login
+    HASH_WORKERS: int = 4                   # Max threads for password hashing
+    LOGIN_CONCURRENCY: int = 2              # Max concurrent logins per client IP and per email
+    RATE_LIMIT: float = 0                   # Tokens a second per JWT subject and per client IP, 0(default) disables the rate limits
+    RATE_BURST: float = 100                 # Tokens a client can spend at once
+    RATE_COST_READ: float = 1               # Tokens a read(GET) takes
+    RATE_COST_WRITE: float = 2              # Tokens a write(POST/PUT/PATCH/DELETE) takes
+    RATE_COST_EXPENSIVE: float = 20         # Tokens a reconciliation or a broken=true list takes
+    MAX_CONCURRENCY: int = 0                # Max in-flight requests, more are refused with 503, 0 for no limit
+    MAX_EXPENSIVE_CONCURRENCY: int = 0      # Max in-flight reconciliations and broken=true lists(503), 0 for no limit
+    IO_WORKERS: int = 8                     # Max threads for the blocking database/file I/O
+    DB_WRITE_BEHIND: bool = False           # Keep TinyDB tables in memory and write them in batches
+    DB_FLUSH_INTERVAL: float = 1.0          # Write-behind: max seconds of writes not on disk yet
+    DB_FLUSH_THRESHOLD: int = 100           # Write-behind: pending writes that trigger a flush right away
+    CONFIG_WATCH_INTERVAL: float = 5.0      # Seconds between checks of the config file for changes, 0 to disable
+    PROFILE_SAMPLE_RATE: float = 0.0        # Fraction of the requests profiled with cProfile, 0 to disable
+    PROFILE_SLOW_MS: float = 0              # Requests slower than this(ms) are reported with their spans, 0 to disable
+    PROFILE_KEEP: int = 50                  # Number of the latest profile reports kept
+    PROFILE_TOP: int = 30                   # Number of the functions listed in a cProfile report
+    GATEWAY_ADD_WINDOW: float = 0.2         # Seconds the gateway/add requests of a gateway are collected into one batch
+    GATEWAY_ADD_MAX: int = 500              # Edges per batch, a full batch is registered without waiting
+    MGMT_RATE: float = 50                   # Management messages per second published by a bulk job
+    MGMT_WINDOW: int = 100                  # Management messages of a job awaiting the broker's ack(qos 1)
+    MGMT_ACK_TIMEOUT: float = 30            # Seconds to wait for the broker's ack before counting the message failed
+    MGMT_JOBS_KEEP: int = 100               # Number of the finished bulk jobs kept for the status queries
+    ROLLOUT_MAX_INFLIGHT: int = 50          # Firmware upgrades of a rollout in progress at once
+    ROLLOUT_ACK_TIMEOUT: float = 600        # Seconds for a device to report the upgrade result before it's counted failed
+    ROLLOUT_FAILURE_THRESHOLD: float = 0.1  # Failed fraction of the finished upgrades that halts a rollout
+    PRESENCE_SNAPSHOT_INTERVAL: float = 30  # Seconds between the snapshots of the device presence to Redis, 0 to disable
+    RECONCILE_INTERVAL: float = 0           # Seconds between the TinyDB/dynsec reconciliations, 0 to run on demand only
+    RECONCILE_REPAIR: bool = False          # Repair the mismatches found by the periodic reconciliation
 
     class Config:
         env_file = "data/.env"
@@ -0,0 +1,105 @@
+import json
+import os
+import socket
+import threading
+import time
+import logging
+import redis
+from environments.settings import Settings
+from environments.database import Database
+from environments.dynsec_mirror import dynsec_mirror
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+# Multi-worker/multi-replica support.
+# Every process keeps its own in-memory state(TinyDB caches, config cache, indexes),
+# so the table changes are announced on a Redis channel and the other processes reload the table.
+CHANNEL = 'io7:changes'
+origin = f'{socket.gethostname()}:{os.getpid()}'
+redis_client = None
+listener = None
+handlers = {}           # message kind -> handler(data), for the publish() of the other processes
+
+def enabled() -> bool:
+    return settings.WORKERS > 1 or settings.SHARED_STATE
+
+def process_id() -> str:
+    # unique per worker process, eg. for the MQTT client id
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+def publish_change(table: str, external: bool):
+    if external or redis_client is None:
+        return          # reloaded because of someone else's change, nothing to announce
+    try:
+        redis_client.publish(CHANNEL, json.dumps({'table': table, 'origin': origin}))
+    except Exception as e:
+        logger.warning(f'Publishing the change of {table} failed: {e}')
+
+def publish_commands(commands: list):
+    # the dynsec commands, for the other workers' mirrors. The passwords are not needed there
+    if redis_client is None:
+        return
+    commands = [{k: v for k, v in c.items() if k != 'password'} for c in commands]
+    try:
+        redis_client.publish(CHANNEL, json.dumps({'dynsec': commands, 'origin': origin}))
+    except Exception as e:
+        logger.warning(f'Publishing the dynsec commands failed: {e}')
+
+def publish(kind: str, data):
+    # a message to the handler registered as handlers[kind] in the other processes
+    if redis_client is None:
+        return
+    try:
+        redis_client.publish(CHANNEL, json.dumps({kind: data, 'origin': origin}))
+    except Exception as e:
+        logger.warning(f'Publishing the {kind} message failed: {e}')
+
+def on_change_message(message):
+    try:
+        change = json.loads(message['data'])
+        if change.get('origin') == origin:
+            return
+        kind = next((k for k in handlers if k in change), None)
+        if kind:
+            handlers[kind](change[kind])
+        elif 'dynsec' in change:
+            dynsec_mirror.apply(change['dynsec'])
+        else:
+            logger.debug(f"Table {change['table']} changed by {change['origin']}, reloading")
+            Database(change['table']).reload()
+    except Exception as e:
+        logger.error(f'Handling the change notification failed: {e}')
+
+def listen():
+    # runs on its own thread, resubscribing after the connection errors so Redis may start later than us
+    delay = 1
+    while redis_client is not None:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            delay = 1
+            for message in pubsub.listen():
+                on_change_message(message)
+        except Exception as e:
+            logger.warning(f'Change notification channel error: {e}, retrying in {delay}s')
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+def start():
+    global redis_client, listener
+    if not enabled() or redis_client is not None:
+        return
+    redis_client = redis.Redis(
+        host=getattr(settings, 'REDIS_HOST', 'redis'),
+        port=getattr(settings, 'REDIS_PORT', 6379), db=0, socket_connect_timeout=2)
+    for db in list(Database.instances.values()):
+        db.subscribe(publish_change)
+    listener = threading.Thread(target=listen, name='io7-shared-state', daemon=True)
+    listener.start()
+    logger.info(f'Shared state enabled, process {origin}')
+
+def stop():
+    global redis_client
+    redis_client = None
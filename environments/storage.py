@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import logging
+from tinydb.storages import Storage, touch
+from environments.settings import Settings
+
+settings = Settings()
+logger = logging.getLogger("uvicorn")
+logger.setLevel(settings.LOG_LEVEL)
+
+def write_atomic(path: str, data):
+    # the table is written to a temp file, synced and renamed over the file,
+    # so the file is either the old or the new table even if the process dies meanwhile
+    dir_name, base_name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=f'.{base_name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777)     # mkstemp creates it with 0600
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.path.exists(tmp_path) and os.remove(tmp_path)
+        raise
+
+class AtomicJSONStorage(Storage):
+    """
+    The default TinyDB storage. It reads the file like JSONStorage, but writes it with write_atomic()
+    rather than rewriting it in place, where a crash in the middle leaves a torn or empty table.
+    The file is opened per read, since the writes replace it.
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        touch(path, create_dirs=True)
+        self.path = path
+
+    def read(self):
+        with open(self.path, 'r') as file:
+            content = file.read()
+        return json.loads(content) if content else None
+
+    def write(self, data):
+        write_atomic(self.path, data)
+
+class WriteBehindStorage(Storage):
+    """
+    In-memory-first TinyDB storage.
+
+    The file is read once and all the reads and the writes are served from memory.
+    The mutations are persisted in a batch by flush(), which is called
+    by the flusher of Database every DB_FLUSH_INTERVAL seconds
+    or right away once `flush_threshold` writes are pending.
+    The file is replaced atomically with write_atomic(), so it never holds a partial table.
+
+    `lock` is the table lock of Database, which is held by TinyDB operations
+    while they mutate the in-memory data, so flush() takes it too.
+    """
+    def __init__(self, path: str, lock, flush_threshold: int = 100):
+        super().__init__()
+        touch(path, create_dirs=True)
+        self.path = path
+        self.lock = lock
+        self.flush_threshold = flush_threshold
+        self.dirty = 0
+        self.data = self.read_file()
+
+    def read_file(self):
+        with open(self.path, 'r') as file:
+            content = file.read()
+        return json.loads(content) if content else None
+
+    def reload(self) -> bool:
+        # re-reads the file, unless the memory has the changes not flushed yet
+        with self.lock:
+            if self.dirty:
+                logger.warning(f'{self.path} is not reloaded, it has {self.dirty} pending write(s)')
+                return False
+            self.data = self.read_file()
+            return True
+
+    def read(self):
+        return self.data
+
+    def write(self, data):
+        self.data = data
+        self.dirty += 1
+        if self.dirty >= self.flush_threshold:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty == 0:
+                return
+            try:
+                write_atomic(self.path, self.data)
+            except Exception as e:
+                logger.error(f'Flushing {self.path} failed: {e}')
+                return
+            logger.debug(f'Flushed {self.dirty} write(s) to {self.path}')
+            self.dirty = 0
+
+    def close(self):
+        self.flush()
@@ -1,3 +1,5 @@
 from models.config_vars import ConfigVar
-from models.apps import IOTApp, NewIOTApp, MemberDevice
-from models.devices import Device, NewDevice, FirmwareInfo
\ No newline at end of file
+from models.apps import IOTApp, IOTAppListItem, NewIOTApp, MemberDevice, DeviceApp
+from models.devices import Device, DeviceListItem, OnlineDevice, NewDevice, FirmwareInfo
+from models.mgmt import DeviceSelector, MgmtJobRequest, RolloutRequest, JobProgress, RolloutProgress, RolloutFailure
+from models.reconcile import Mismatch, ReconcileReport
\ No newline at end of file
@@ -24,6 +24,10 @@ class IOTApp(BaseModel):
         name = "apps"
 
 
+class IOTAppListItem(IOTApp):
+    toFix: Optional[str]            # the side to fix in the broken list, dynsec or tinydb
+
+
 class NewIOTApp(IOTApp):
     password: str
 
@@ -53,4 +57,10 @@ class MemberDevice(BaseModel):
                 "evt": "true",
                 "cmd": "true",
             }
-        }
\ No newline at end of file
+        }
+
+class DeviceApp(BaseModel):
+    # a restricted app the device is a member of
+    appId: str
+    evt: bool
+    cmd: bool
@@ -34,6 +34,15 @@ class Device(BaseModel):
         name = "devices"
 
 
+class DeviceListItem(Device):
+    toFix: Optional[str]            # the side to fix in the broken list, dynsec or tinydb
+
+
+class OnlineDevice(BaseModel):
+    devId: str
+    lastSeen: float                 # epoch seconds
+
+
 class NewDevice(Device):
     password: str
 
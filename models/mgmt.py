@@ -0,0 +1,93 @@
+from typing import Optional, List
+from datetime import datetime
+from pydantic import BaseModel
+
+class DeviceSelector(BaseModel):
+    # the given criteria are combined with AND
+    devIds: Optional[List[str]]
+    type: Optional[str]
+    gateway: Optional[str]          # the gateway and its edge devices
+    createdBy: Optional[str]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "devIds": ["str"],
+                "type": "str",
+                "gateway": "str",
+                "createdBy": "str"
+            }
+        }
+
+
+class MgmtJobRequest(BaseModel):
+    selector: DeviceSelector
+    action: str                     # reboot, reset, updateMeta or upgrade
+    params: dict = {}               # eg. {"fw_url": "..."} for upgrade, {"meta": {"metadata": {...}}} for updateMeta
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "selector": {"type": "device"},
+                "action": "upgrade",
+                "params": {"fw_url": "https://firmware.host/fw.bin"}
+            }
+        }
+
+
+class RolloutRequest(BaseModel):
+    selector: DeviceSelector
+    fw_url: str
+    fw_version: Optional[str]               # the version the devices report in meta after the upgrade
+    waves: List[float] = [1, 10, 100]       # cumulative percentages of the selected devices
+    max_inflight: Optional[int]             # defaults to ROLLOUT_MAX_INFLIGHT
+    failure_threshold: Optional[float]      # defaults to ROLLOUT_FAILURE_THRESHOLD
+    ack_timeout: Optional[float]            # defaults to ROLLOUT_ACK_TIMEOUT
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "selector": {"type": "device"},
+                "fw_url": "https://firmware.host/fw.bin",
+                "fw_version": "1.0.1",
+                "waves": [1, 10, 100]
+            }
+        }
+
+
+class JobProgress(BaseModel):
+    jobId: str
+    action: str
+    state: str                      # queued, running, done, cancelled or failed
+    total: int
+    published: int
+    acked: int
+    failed: int
+    inflight: int
+    created: datetime
+    started: Optional[datetime]
+    finished: Optional[datetime]
+    errors: List[str] = []          # the recent ones
+
+
+class RolloutFailure(BaseModel):
+    devId: str
+    reason: str
+
+
+class RolloutProgress(BaseModel):
+    rolloutId: str
+    state: str                      # running, done, halted, cancelled or failed
+    reason: Optional[str]
+    fw_url: str
+    fw_version: Optional[str]
+    waves: List[float]
+    wave: int
+    total: int
+    requested: int
+    inflight: int
+    succeeded: int
+    failed: int
+    failures: List[RolloutFailure] = []     # the recent ones
+    created: datetime
+    finished: Optional[datetime]
@@ -0,0 +1,25 @@
+from typing import Optional, List, Dict
+from datetime import datetime
+from pydantic import BaseModel
+
+class Mismatch(BaseModel):
+    kind: str                       # device, edge, app or role
+    id: str
+    issue: str                      # eg. missing_in_dynsec, missing_in_tinydb, missing_role, missing_gateway_binding
+    toFix: str                      # the side to fix, dynsec or tinydb
+    repairable: bool                # can be repaired without more information(eg. the password)
+    detail: Optional[str]
+
+
+class ReconcileReport(BaseModel):
+    started: datetime
+    runtime_ms: float
+    counts: Dict[str, int]
+    mismatches: List[Mismatch] = []
+    repair: bool = False
+    repaired: int = 0
+    dynsec_commands: int = 0
+    tinydb_writes: int = 0
+
+    def of_kind(self, *kinds: str) -> List[Mismatch]:
+        return [m for m in self.mismatches if m.kind in kinds]
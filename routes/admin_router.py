@@ -0,0 +1,84 @@
+from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from secutils import authenticate
+from environments import profiling, run_io
+from models import ReconcileReport
+from dynsec import reconcile
+
+router = APIRouter(tags=['Admin'])
+
+@router.get('/profiles', response_model=List[dict])
+async def get_profiles(limit: int = None, jwt: str = Depends(authenticate)) -> List[dict]:
+    """
+    Retrieve the latest request profile reports.
+
+    A report is recorded for the sampled requests(PROFILE_SAMPLE_RATE) with the cProfile stats,
+    and for the requests slower than PROFILE_SLOW_MS with the named spans only.
+    The spans show where the time went, eg. load_dynsec, Database.getAll(devices), mqtt.publish or bcrypt.verify.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - Profiling is disabled unless PROFILE_SAMPLE_RATE or PROFILE_SLOW_MS is set
+    - Only the last PROFILE_KEEP reports are kept in memory
+
+    Parameters:
+    - limit: Optional maximum number of the reports to return
+
+    Returns:
+    - A list of the profile reports, the newest first
+    """
+    return profiling.get_reports(limit)
+
+@router.get('/reconcile', response_model=ReconcileReport)
+async def run_reconcile(jwt: str = Depends(authenticate)) -> ReconcileReport:
+    """
+    Compare the devices and apps registry(TinyDB) with the dynamic security clients and roles.
+
+    The comparison is done in one pass over both sides, and reports every mismatch with
+    the side to fix(toFix) and whether it can be repaired automatically.
+    Nothing is changed, use POST /admin/reconcile/repair to repair the mismatches.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - The clients missing in dynsec can't be repaired since the password is not kept,
+      update the device or the app with a new password instead
+    - The unused roles are only reported
+
+    Returns:
+    - The reconciliation report
+    """
+    return await run_io(reconcile.reconcile, False)
+
+@router.post('/reconcile/repair', response_model=ReconcileReport)
+async def repair_reconcile(jwt: str = Depends(authenticate)) -> ReconcileReport:
+    """
+    Reconcile the devices and apps registry(TinyDB) with the dynamic security clients and roles,
+    and repair the repairable mismatches.
+
+    The mismatches are found as with GET /admin/reconcile, and the repairable ones are fixed
+    with one dynsec command array and one write per table.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - The clients missing in dynsec can't be repaired since the password is not kept,
+      update the device or the app with a new password instead
+    - The unused roles are only reported, not deleted
+
+    Returns:
+    - The reconciliation report, with the number of the repaired mismatches
+    """
+    return await run_io(reconcile.reconcile, True)
+
+@router.get('/reconcile/last', response_model=ReconcileReport)
+async def last_reconcile(jwt: str = Depends(authenticate)) -> ReconcileReport:
+    """
+    Retrieve the report of the last reconciliation, periodic(RECONCILE_INTERVAL) or on demand.
+    Authentication is required to access this endpoint.
+
+    Returns:
+    - The last reconciliation report
+    """
+    if reconcile.last_report is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No reconciliation has run yet")
+    return reconcile.last_report
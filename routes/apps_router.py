@@ -1,19 +1,42 @@
 from typing import List
-from fastapi import APIRouter, HTTPException, status, Depends, Body
+from fastapi import APIRouter, HTTPException, status, Depends, Body, Request, Response
 from datetime import timezone, timedelta, datetime
 
-from models import IOTApp, NewIOTApp, MemberDevice, Device
+from models import IOTApp, IOTAppListItem, NewIOTApp, MemberDevice, Device
 from secutils import authenticate
-from environments import Database, dynsec_get_client_role, dynsec_get_appId, dynsec_all_appIds
+from environments import AsyncDatabase, run_io, dynsec_get_client_role, dynsec_get_appId, dynsec_all_appIds
+from environments import FastJSONResponse, ResponseCache, dynsec_mirror, etag, not_modified
 from dynsec.apps_dynsec import add_dynsec_app, delete_dynsec_app, add_dynsec_member, remove_dynsec_member, update_dynsec_members
 from dynsec.roles_dynsec import delete_dynsec_role
 
-apps_db = Database(IOTApp.Settings.name)
-devices_db = Database(Device.Settings.name)
+apps_db = AsyncDatabase(IOTApp.Settings.name)
+devices_db = AsyncDatabase(Device.Settings.name)
 router = APIRouter(tags=['Apps'])
+# the serialised app list, dropped when the apps table or dynsec(toFix) changes
+app_list_cache = ResponseCache([apps_db.sync], stamp=lambda: dynsec_mirror.generation)
 
-@router.get('/', response_model=List[dict])
-async def get_apps(broken:bool = False, jwt: str = Depends(authenticate)) -> dict:
+def list_apps(broken: bool) -> List[dict]:
+    # reads both TinyDB and dynsec, so it is run on the io executor as a whole
+    dynsec_apps = set(dynsec_all_appIds())
+    app_list = []
+    db_appIds = set()
+    for db_app in apps_db.sync.getAll():          # the documents are copies already
+        db_appIds.add(db_app['appId'])
+        if db_app['appId'] not in dynsec_apps:
+            db_app['toFix'] = 'dynsec'
+        if not broken or 'toFix' in db_app:
+            app_list.append(db_app)
+    if broken:
+        # the dynsec apps missing in TinyDB
+        for appId in dynsec_apps - db_appIds:
+            db_a = IOTApp(appId=appId).dict()
+            db_a['toFix'] = 'tinydb'
+            app_list.append(db_a)
+    return app_list
+
+# Returns IOTApp objects with 'toFix' attribute, served as they are by FastJSONResponse, the model is for the schema
+@router.get('/', response_model=List[IOTAppListItem], response_class=FastJSONResponse)
+async def get_apps(request: Request, broken:bool = False, jwt: str = Depends(authenticate)) -> List[IOTAppListItem]:
     """
     Retrieve a list of all registered IOT application IDs.
     
@@ -26,38 +49,19 @@ async def get_apps(broken:bool = False, jwt: str = Depends(authenticate)) -> dic
     - AppId metadata is stored in the TinyDB database
     - Inconsistencies between these two data sources can result in broken device states
     - Use `?broken=true` to retrieve only AppId with database/MQTT configuration mismatches
+    - The broken AppIds are the ones missing on either side(toFix: dynsec or tinydb), GET /admin/reconcile also checks the roles and the restricted flags
+    - The response has an ETag, and If-None-Match with it gets 304 Not Modified while nothing has changed
     
     Returns:
     - A list of IOTApp objects containing application details
     """
+    dynsec_mirror.ensure_loaded()      # seeded before the tag, the seeding changes the generation
+    tag = etag(apps_db.tag(), dynsec_mirror.generation, 'broken' if broken else 'all')
+    if response := not_modified(request, tag):
+        return response
     if broken:
-        dynsec_apps = dynsec_all_appIds()
-        db_apps = apps_db.getAll()
-        mal_dynsec_apps = []
-        mal_db_apps = []
-        for dyn_app in dynsec_apps:
-            a = apps_db.getOne(apps_db.qry.appId == dyn_app)
-            if a is None:
-                db_a = IOTApp(appId = dyn_app).dict()
-                db_a['toFix'] = 'tinydb'
-                mal_dynsec_apps.append(db_a)
-        for db_app in db_apps:
-            a = dynsec_get_appId(db_app['appId'])
-            if a is None:
-                db_a = dict(db_app)
-                db_a['toFix'] = 'dynsec'
-                mal_db_apps.append(db_a)
-        return(mal_db_apps + mal_dynsec_apps)
-    else:
-        app_list = []
-        db_apps = apps_db.getAll()
-        for db_app in db_apps:
-            a = dynsec_get_appId(db_app['appId'])
-            db_a = dict(db_app)
-            if a is None:
-                db_a['toFix'] = 'dynsec'
-            app_list.append(db_a)
-        return app_list
+        return FastJSONResponse(await run_io(list_apps, True), headers={'ETag': tag})
+    return FastJSONResponse(await run_io(app_list_cache.get, 'all', lambda: list_apps(False)), headers={'ETag': tag})
 
 @router.post('/')
 async def add_app(newApp: NewIOTApp, jwt: str = Depends(authenticate)) -> IOTApp:
@@ -80,8 +84,8 @@ async def add_app(newApp: NewIOTApp, jwt: str = Depends(authenticate)) -> IOTApp
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail = f"The Id({newApp.appId}) can not be registered for AppId."
         )
-    qryApp = apps_db.getOne(apps_db.qry.appId == newApp.appId)
-    qryDevice = devices_db.getOne(devices_db.qry.devId == newApp.appId)
+    qryApp = await apps_db.getOne(apps_db.qry.appId == newApp.appId)
+    qryDevice = await devices_db.getOne(devices_db.qry.devId == newApp.appId)
     if qryApp or qryDevice:
         if qryApp:
             detail = f"The Id({newApp.appId}) is already registered for AppId."
@@ -95,15 +99,16 @@ async def add_app(newApp: NewIOTApp, jwt: str = Depends(authenticate)) -> IOTApp
     newApp.createdDate = newApp.createdDate.replace(tzinfo=timezone.utc)
     newApp.createdDate = str(newApp.createdDate.strftime('%Y-%m-%d %H:%M:%S'))
     add_dynsec_app(newApp)
-    apps_db.insert(newApp)
+    await apps_db.insert(newApp)
     return newApp.dict()
 
 @router.get('/{appId}', response_model=IOTApp)
-async def get_application(appId: str, jwt: str = Depends(authenticate)) -> IOTApp:
+async def get_application(appId: str, request: Request, response: Response, jwt: str = Depends(authenticate)) -> IOTApp:
     """
     Retrieve details for a specific IOT application ID.
     
     This endpoint returns the application details for the specified appId.
+    The response has an ETag, and If-None-Match with it gets 304 Not Modified while the application is unchanged.
     Authentication is required to access this endpoint.
     
     Parameters:
@@ -112,12 +117,16 @@ async def get_application(appId: str, jwt: str = Depends(authenticate)) -> IOTAp
     Returns:
     - An IOTApp object containing the application details
     """
-    app = apps_db.getOne(apps_db.qry.appId == appId)
+    tag = etag(apps_db.tag(appId))
+    if not_modified_response := not_modified(request, tag):
+        return not_modified_response
+    app = await apps_db.getOne(apps_db.qry.appId == appId)
     if not app:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"AppID({appId}) does not exist"
         )
+    response.headers['ETag'] = tag
     return app
 
 @router.delete('/{appId}')
@@ -139,7 +148,7 @@ async def del_appId(appId: str, jwt: str = Depends(authenticate)) -> dict:
     Returns:
     - A confirmation message with the deleted application ID
     """
-    app = apps_db.getOne(apps_db.qry.appId == appId)
+    app = await apps_db.getOne(apps_db.qry.appId == appId)
     if not app:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -149,7 +158,7 @@ async def del_appId(appId: str, jwt: str = Depends(authenticate)) -> dict:
     if app.get('restricted', None):
         delete_dynsec_role(f'$apps_{appId}')
     delete_dynsec_app(appId)
-    apps_db.delete(apps_db.qry.appId == appId)
+    await apps_db.delete(apps_db.qry.appId == appId)
     return {"message": "AppId deleted successfully", "appId": appId}
 
 @router.put('/{appId}/addMembers')
@@ -188,12 +197,12 @@ async def addMembers(appId: str, members: List[MemberDevice], jwt: str = Depends
     Returns:
     - Confirmation message with application and device IDs
     """
-    if dynsec_get_appId(appId) is None:
+    if await run_io(dynsec_get_appId, appId) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"AppId({appId}) does not exist"
         )
-    app = apps_db.getOne(apps_db.qry.appId == appId)
+    app = await apps_db.getOne(apps_db.qry.appId == appId)
     if app and app.get('restricted', None) in [False, None]:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -228,12 +237,12 @@ async def removeMembers(appId: str, members: list, jwt: str = Depends(authentica
     Returns:
     - Confirmation message with application and device IDs
     """
-    if dynsec_get_appId(appId) is None:
+    if await run_io(dynsec_get_appId, appId) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"AppId({appId}) does not exist"
         )
-    app = apps_db.getOne(apps_db.qry.appId == appId)
+    app = await apps_db.getOne(apps_db.qry.appId == appId)
     if app and app.get('restricted', None) in [False, None]:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -268,34 +277,39 @@ async def get_app_members(appId: str, detail: bool = False, jwt: str = Depends(a
     - If detail=True is passed, the result has the role information for the application including
       all device access control lists with their permissions
     """
-    if dynsec_get_appId(appId) is None:
+    if await run_io(dynsec_get_appId, appId) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"AppId(appId:{appId}) does not exist"
         )
-    app = apps_db.getOne(apps_db.qry.appId == appId)
+    app = await apps_db.getOne(apps_db.qry.appId == appId)
     if app and app.get('restricted', None) in [False, None]:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail = f"The AppId({appId}) doesn't have members."
         )
 
-    return dynsec_get_client_role(appId, detail=detail)
+    return await run_io(dynsec_get_client_role, appId, detail=detail)
 
 @router.put('/{appId}/updateMembers')
-async def updateMembers(appId: str, members: List[MemberDevice], jwt: str = Depends(authenticate)) -> dict:
+async def updateMembers(appId: str, members: List[MemberDevice], reconnect: bool = True,
+                        jwt: str = Depends(authenticate)) -> dict:
     """
     Update all member devices for an application with a single operation.
     
     This endpoint replaces the existing device memberships with the provided list.
+    Only the differences are sent to the broker, in one command message.
     
     Caution:
     - This is a complete replacement operation
     - Any device not included in the new list will lose access
+    - The application is disconnected to get the new list reflected, unless reconnect is false
+      and the members are only added. Removed or changed members always disconnect it
     - Authentication is required to access this endpoint
     
     Parameters:
     - appId: Application ID to update memberships for
+    - reconnect: Optional, false to keep the application connected when the members are only added
     - members: Complete list of desired device memberships with access permissions
     ```
     [
@@ -315,20 +329,20 @@ async def updateMembers(appId: str, members: List[MemberDevice], jwt: str = Depe
     Returns:
     - Confirmation message with the updated application ID
     """
-    if dynsec_get_appId(appId) is None:
+    if await run_io(dynsec_get_appId, appId) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"AppId(appId:{appId}) does not exist"
         )
-    app = apps_db.getOne(apps_db.qry.appId == appId)
+    app = await apps_db.getOne(apps_db.qry.appId == appId)
     if app and app.get('restricted', None) in [False, None]:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail = f"The AppId({appId}) doesn't have members."
         )
 
-    update_dynsec_members(appId, members)
-    return {"message": "Members are updated successfully", "appId": appId}
+    changes = await run_io(update_dynsec_members, appId, members, reconnect)
+    return {"message": "Members are updated successfully", "appId": appId, **changes}
 
 
 @router.patch('/{appId}/update')
@@ -368,8 +382,8 @@ async def update_apps(
             detail = f"The Id({appId}) cannot be registered for AppId."
         )
 
-    db_app = apps_db.getOne(apps_db.qry.appId == appId)
-    dyn_app = dynsec_get_appId(appId)
+    db_app = await apps_db.getOne(apps_db.qry.appId == appId)
+    dyn_app = await run_io(dynsec_get_appId, appId)
     if db_app: 
         if dyn_app:
             # Both db_app & dyn_app found; update the information in TinyDB 
@@ -389,7 +403,7 @@ async def update_apps(
                 theApp.appId=appId
                 theApp.createdBy='admin'
                 theApp.createdDate = str(theApp.createdDate.strftime('%Y-%m-%d %H:%M:%S'))
-                apps_db.insert(theApp)
+                await apps_db.insert(theApp)
                 return theApp
         elif 'password' in updateData:
             # No dyn_app found; create dyn_app
@@ -410,5 +424,5 @@ async def update_apps(
         updateData['createdDate'] = datetime.now(timezone.utc)
         theApp = IOTApp(**updateData)
         theApp.createdDate = str(theApp.createdDate.strftime('%Y-%m-%d %H:%M:%S'))
-        apps_db.insert(theApp)
+        await apps_db.insert(theApp)
         return theApp
\ No newline at end of file
@@ -1,31 +1,38 @@
 from typing import List
-from fastapi import APIRouter, HTTPException, Body, Depends, status
+from fastapi import APIRouter, HTTPException, Body, Depends, status, Request, Response
 
 from models import ConfigVar
 from secutils import authenticate
-from environments import Database, set_fieldset, set_monitored, config_db
+from environments import AsyncDatabase, run_io, set_fieldset, set_monitored, etag, not_modified
 
 router = APIRouter(tags=['Config'])
+config_db = AsyncDatabase(ConfigVar.Settings.name)
 
 @router.get('/', response_model=List[ConfigVar])
-async def get_configs(jwt: str = Depends(authenticate)) -> List[ConfigVar]:
+async def get_configs(request: Request, response: Response, jwt: str = Depends(authenticate)) -> List[ConfigVar]:
     """
     Retrieve all configuration variables.
     
     This endpoint returns the io7 platform configuration variables.
+    The response has an ETag, and If-None-Match with it gets 304 Not Modified while nothing has changed.
     Authentication is required to access this endpoint.
     
     Returns:
     - A list of all customizable configuration variables.
     """
-    return config_db.getAll()
+    tag = etag(config_db.tag())
+    if not_modified_response := not_modified(request, tag):
+        return not_modified_response
+    response.headers['ETag'] = tag
+    return await config_db.getAll()
 
 @router.get('/{key}')
-async def get_var(key: str, jwt: str = Depends(authenticate)) -> ConfigVar:
+async def get_var(key: str, request: Request, response: Response, jwt: str = Depends(authenticate)) -> ConfigVar:
     """
     Retrieve a configuration variable.
     
     This endpoint returns the io7 platform configuration variable requested by key.
+    The response has an ETag, and If-None-Match with it gets 304 Not Modified while the variable is unchanged.
     Authentication is required to access this endpoint.
     
     Parameters:
@@ -34,12 +41,16 @@ async def get_var(key: str, jwt: str = Depends(authenticate)) -> ConfigVar:
     Returns:
     - The configuration variable value
     """
-    value =  config_db.getOne(config_db.qry.key == key)
+    tag = etag(config_db.tag(key))
+    if not_modified_response := not_modified(request, tag):
+        return not_modified_response
+    value =  await config_db.getOne(config_db.qry.key == key)
     if not value:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"There is no configuration variable ({key})"
     )
+    response.headers['ETag'] = tag
     return value 
 
 @router.post('/')
@@ -59,12 +70,8 @@ async def set_configs(vars: List[ConfigVar], jwt: str = Depends(authenticate)) -
     Returns:
     - A JSON object with processing status.
     """ 
-    all_vars = config_db.getAll()
-    for var in all_vars:
-        config_db.delete(config_db.qry.key == var['key'])
     try:
-        for var in vars:
-            config_db.insert(ConfigVar(key=var.key, value=var.value))
+        await config_db.replace_all([ConfigVar(key=var.key, value=var.value) for var in vars])
         return {"status":"ok"}
     except Exception as e:
         return {"status":"error", "Exception": type(e).__name__}
@@ -93,7 +100,7 @@ async def set_monitored_fields(
     - A JSON object with processing status.
     """ 
     try:
-        newSets = set_fieldset(fields=fields['fieldsets'])
+        newSets = await run_io(set_fieldset, fields=fields['fieldsets'])
         return {"status":"ok", "newSets":newSets}
     except Exception as e:
         return {"status":"error", "Exception": type(e).__name__}
@@ -122,7 +129,7 @@ async def set_monitored_devices(
     - A JSON object with processing status.
     """
     try:
-        monitored = set_monitored(devices=devices['devices'])
+        monitored = await run_io(set_monitored, devices=devices['devices'])
         return {"status":"ok", "monitored" : monitored}
     except Exception as e:
         return {"status":"error", "Exception": type(e).__name__}
@@ -145,8 +152,7 @@ async def update_configs(vars: List[ConfigVar], jwt: str = Depends(authenticate)
     - A JSON object with processing status.
     """
     try:
-        for var in vars:
-            config_db.insert(ConfigVar(key=var.key, value=var.value))
+        await config_db.upsert_many([ConfigVar(key=var.key, value=var.value) for var in vars])
         return {"status":"ok"}
     except Exception as e:
         return {"status":"error", "Exception": type(e).__name__}
@@ -179,7 +185,7 @@ async def update_var(
             detail="Missing 'value' field in request body"
         )
     try:
-        config_db.insert(ConfigVar(key=key, value=var['value']))
+        await config_db.insert(ConfigVar(key=key, value=var['value']))
         return {"status":"ok"}
     except Exception as e:
         return {"status":"error", "Exception": type(e).__name__}
@@ -202,14 +208,14 @@ async def del_var(key: str, jwt: str = Depends(authenticate)) -> dict:
     Returns:
     - A confirmation message with the processing status
     """
-    value = config_db.getOne(config_db.qry.key == key)
+    value = await config_db.getOne(config_db.qry.key == key)
     if not value:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"There is no configuration variable ({key})"
         )
     try:
-        config_db.delete(config_db.qry.key == key)
+        await config_db.delete(config_db.qry.key == key)
         return {"status":"ok"}
     except Exception as e:
         return {"status":"error", "Exception": type(e).__name__}
\ No newline at end of file
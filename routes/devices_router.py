@@ -1,21 +1,58 @@
 from typing import List
 import logging
-from fastapi import APIRouter, HTTPException, status, Depends, Body
+from fastapi import APIRouter, HTTPException, status, Depends, Body, Request, Response
 from datetime import timezone, timedelta, datetime
 from secutils import authenticate
-from models import Device, NewDevice, IOTApp, FirmwareInfo
-from dynsec.devices_dynsec import add_dynsec_device, delete_dynsec_device
-from dynsec.roles_dynsec import delete_dynsec_role
+from models import Device, DeviceListItem, OnlineDevice, NewDevice, IOTApp, DeviceApp, FirmwareInfo
+from dynsec.devices_dynsec import add_dynsec_device, plan_device_delete, execute_device_delete
 from dynsec.devices_actions import reboot_device_action, reset_device_action, update_metadata_action, upgrade_firmware_action
-from environments import Settings, Database, dynsec_all_devices, dynsec_get_device
+from environments import Settings, AsyncDatabase, run_io, dynsec_all_devices, dynsec_get_device, dynsec_get_device_apps, gateway_index, presence
+from environments import FastJSONResponse, ResponseCache, dynsec_mirror, etag, not_modified
 
 settings = Settings()
 logger = logging.getLogger("uvicorn")
 logger.setLevel(settings.LOG_LEVEL)
 
-device_db = Database(Device.Settings.name)
-apps_db = Database(IOTApp.Settings.name)
+device_db = AsyncDatabase(Device.Settings.name)
+apps_db = AsyncDatabase(IOTApp.Settings.name)
 router = APIRouter(tags=['Devices'])
+# the serialised device list, dropped when the devices table or dynsec(toFix) changes
+device_list_cache = ResponseCache([device_db.sync], stamp=lambda: dynsec_mirror.generation)
+
+# declared before /{devId}, which would take 'online' as a devId otherwise
+@router.get('/online', response_model=List[OnlineDevice])
+async def get_online_devices(type: str = None, gateway: str = None, jwt: str = Depends(authenticate)) -> List[OnlineDevice]:
+    """
+    Retrieve the devices which are online.
+
+    The presence is tracked from the connection events(iot3/<devId>/evt/connection) of the devices.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - The presence is as of the last connection event, a device which lost the connection
+      without the will message being delivered is shown online
+    - After a restart, the presence is restored from the last snapshot in Redis
+
+    Parameters:
+    - type: Optional device type(gateway, edge or device) to filter
+    - gateway: Optional gateway, to get its online edge devices
+
+    Returns:
+    - A list of {devId, lastSeen(epoch seconds)}
+    """
+    return presence.get_online(type, gateway)
+
+@router.get('/online/counts')
+async def get_online_counts(jwt: str = Depends(authenticate)) -> dict:
+    """
+    Retrieve the number of the online devices.
+
+    Authentication is required to access this endpoint.
+
+    Returns:
+    - {"total": n, "type": {"<type>": n, ...}, "gateway": {"<gateway>": online edges, ...}}
+    """
+    return presence.counts()
 
 @router.get('/{devId}/reboot')
 async def reboot_device(devId: str, jwt: str = Depends(authenticate)) -> dict:
@@ -36,7 +73,7 @@ async def reboot_device(devId: str, jwt: str = Depends(authenticate)) -> dict:
     Returns:
     - Confirmation message of the reboot command
     """
-    device = device_db.getOne(device_db.qry.devId == devId)
+    device = await device_db.getOne(device_db.qry.devId == devId)
     if not device:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -65,7 +102,7 @@ async def reset_device(devId: str, jwt: str = Depends(authenticate)) -> dict:
     Returns:
     - Confirmation message of the reset command
     """
-    device = device_db.getOne(device_db.qry.devId == devId)
+    device = await device_db.getOne(device_db.qry.devId == devId)
     if not device:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -93,7 +130,7 @@ async def update_metadata(devId: str, metaData: dict, jwt: str = Depends(authent
     Returns:
     - Confirmation message of the metadata update command
     """
-    qryDevice = device_db.getOne(device_db.qry.devId == devId)
+    qryDevice = await device_db.getOne(device_db.qry.devId == devId)
     if not qryDevice:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -124,7 +161,7 @@ async def upgrade_firmware(devId: str, fwInfo: FirmwareInfo, jwt: str = Depends(
     Returns:
     - Confirmation message of the firmware upgrade command
     """
-    qryDevice = device_db.getOne(device_db.qry.devId == devId)
+    qryDevice = await device_db.getOne(device_db.qry.devId == devId)
     if not qryDevice:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -133,12 +170,38 @@ async def upgrade_firmware(devId: str, fwInfo: FirmwareInfo, jwt: str = Depends(
     upgrade_firmware_action(devId, fwInfo.fw_url)
     return {"message": "Firmware being upgraded", "devId": devId}
 
+@router.get('/{devId}/apps', response_model=List[DeviceApp])
+async def get_device_apps(devId: str, jwt: str = Depends(authenticate)) -> List[DeviceApp]:
+    """
+    Retrieve the restricted applications which have the device as a member.
+
+    The list comes from the member index kept with the dynsec state, so it doesn't go through the app roles.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - The unrestricted applications can access all the devices, so they are not listed
+
+    Parameters:
+    - devId: The unique identifier of the device
+
+    Returns:
+    - A list of {appId, evt, cmd}, evt and cmd being the access to the events and the commands of the device
+    """
+    qryDevice = await device_db.getOne(device_db.qry.devId == devId)
+    if not qryDevice:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Device(devId:{devId}) does not exist"
+        )
+    return dynsec_get_device_apps(devId)
+
 @router.get('/{devId}', response_model=Device)
-async def get_device(devId: str, jwt: str = Depends(authenticate)) -> Device:
+async def get_device(devId: str, request: Request, response: Response, jwt: str = Depends(authenticate)) -> Device:
     """
     Retrieve details for a specific device by ID.
     
     This endpoint returns all information about the device with the specified ID.
+    The response has an ETag, and If-None-Match with it gets 304 Not Modified while the device is unchanged.
     Authentication is required to access this endpoint.
     
     Parameters:
@@ -147,12 +210,16 @@ async def get_device(devId: str, jwt: str = Depends(authenticate)) -> Device:
     Returns:
     - A Device object containing all device details
     """
-    device = device_db.getOne(device_db.qry.devId == devId)
+    tag = etag(device_db.tag(devId))
+    if not_modified_response := not_modified(request, tag):
+        return not_modified_response
+    device = await device_db.getOne(device_db.qry.devId == devId)
     if not device:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Device(devId:{devId}) does not exist"
         )
+    response.headers['ETag'] = tag
     return device
 
 @router.delete('/{devId}')
@@ -177,30 +244,42 @@ async def del_device(devId: str, jwt: str = Depends(authenticate)) -> dict:
     Returns:
     - Confirmation message with the deleted device ID
     """
-    device  = device_db.getOne(device_db.qry.devId == devId)    # this should come before deletion
-    doc_ids = device_db.delete(device_db.qry.devId == devId)
-    if not doc_ids or len(doc_ids) == 0:
+    device = await device_db.getOne(device_db.qry.devId == devId)
+    if not device:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Device(devId:{devId}) does not exist"
         )
-    if device['type'] == 'gateway':
-        edges = device_db.get(device_db.qry.createdBy == devId)
-        for edge in edges:
-            device_db.delete(device_db.qry.devId == edge['devId'])
-            delete_dynsec_role(edge['devId'])       # edge roles; edge devices consist of roles only
-        delete_dynsec_role(devId)                   # gateway role
-        delete_dynsec_device(devId)                 # gateway device
-    elif device['type'] == 'edge':
-        delete_dynsec_role(devId)
-    else:
-        delete_dynsec_device(devId)
-        delete_dynsec_role(devId)
+    # the device, the edges of a gateway and their member ACLs in the apps, in one write and a few dynsec messages
+    plan = await run_io(plan_device_delete, device)
+    await device_db.delete_many('devId', plan['devIds'])
+    await run_io(execute_device_delete, plan)
+    gateway_index.remove(plan['devIds'])
+    presence.remove(plan['devIds'])
     return {"message": "Device deleted successfully", "devId": devId}
 
-# Returns Device objects with 'toFix' attribute, so return type is List[dict] instead of List[Device]
-@router.get('/', response_model=List[dict])
-async def get_devices(broken:bool = False, jwt: str = Depends(authenticate)) -> List[dict]:
+def list_devices(broken: bool) -> List[dict]:
+    # reads both TinyDB and dynsec, so it is run on the io executor as a whole
+    dynsec_devices = set(dynsec_all_devices())
+    device_list = []
+    db_devIds = set()
+    for db_device in device_db.sync.getAll():     # the documents are copies already
+        db_devIds.add(db_device['devId'])
+        if db_device['devId'] not in dynsec_devices and (broken or db_device['type'] != 'edge'):
+            db_device['toFix'] = 'dynsec'
+        if not broken or 'toFix' in db_device:
+            device_list.append(db_device)
+    if broken:
+        # the dynsec devices missing in TinyDB
+        for devId in dynsec_devices - db_devIds - {'admin'}:
+            db_d = Device(devId=devId).dict()
+            db_d['toFix'] = 'tinydb'
+            device_list.append(db_d)
+    return device_list
+
+# Returns Device objects with 'toFix' attribute, served as they are by FastJSONResponse, the model is for the schema
+@router.get('/', response_model=List[DeviceListItem], response_class=FastJSONResponse)
+async def get_devices(request: Request, broken:bool = False, jwt: str = Depends(authenticate)) -> List[DeviceListItem]:
     """
     Retrieve a list of all registered devices.
     
@@ -212,6 +291,8 @@ async def get_devices(broken:bool = False, jwt: str = Depends(authenticate)) ->
     - Device metadata is stored in the TinyDB database
     - Inconsistencies between these two data sources can result in broken device states
     - Use `?broken=true` to retrieve only devices with database/MQTT configuration mismatches
+    - The broken devices are the ones missing on either side(toFix: dynsec or tinydb), GET /admin/reconcile also checks the roles and the edge bindings
+    - The response has an ETag, and If-None-Match with it gets 304 Not Modified while nothing has changed
     
     Parameters:
     - broken: Optional argument to get the broken devices
@@ -219,34 +300,13 @@ async def get_devices(broken:bool = False, jwt: str = Depends(authenticate)) ->
     Returns:
     - A list of Device objects containing device details
     """
+    dynsec_mirror.ensure_loaded()      # seeded before the tag, the seeding changes the generation
+    tag = etag(device_db.tag(), dynsec_mirror.generation, 'broken' if broken else 'all')
+    if response := not_modified(request, tag):
+        return response
     if broken:
-        dynsec_devices = dynsec_all_devices()
-        db_devices = device_db.getAll()
-        mal_dynsec_devices = []
-        mal_db_devices = []
-        for dyn_device in dynsec_devices:
-            d = device_db.getOne(device_db.qry.devId == dyn_device)
-            if d is None:
-                db_d = Device(devId = dyn_device).dict()
-                db_d['toFix'] = 'tinydb'
-                mal_dynsec_devices.append(db_d)
-        for db_device in db_devices:
-            d = dynsec_get_device(db_device['devId'])
-            if d is None:
-                db_d = dict(db_device)
-                db_d['toFix'] = 'dynsec'
-                mal_db_devices.append(db_d)
-        return(mal_db_devices + mal_dynsec_devices)
-    else:
-        device_list = []
-        db_devices = device_db.getAll()
-        for db_device in db_devices:
-            d = dynsec_get_device(db_device['devId'])
-            db_d = dict(db_device)
-            if d is None and db_d['type'] != 'edge':
-                db_d['toFix'] = 'dynsec'
-            device_list.append(db_d)
-        return device_list
+        return FastJSONResponse(await run_io(list_devices, True), headers={'ETag': tag})
+    return FastJSONResponse(await run_io(device_list_cache.get, 'all', lambda: list_devices(False)), headers={'ETag': tag})
 
 @router.post('/')
 async def add_device(newDevice: NewDevice, jwt: str = Depends(authenticate)) -> Device:
@@ -279,8 +339,8 @@ async def add_device(newDevice: NewDevice, jwt: str = Depends(authenticate)) ->
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Invalid Device Type({newDevice.type})"
         )
-    qryDevice = device_db.getOne(device_db.qry.devId == newDevice.devId)
-    qryApp = apps_db.getOne(apps_db.qry.appId == newDevice.devId)
+    qryDevice = await device_db.getOne(device_db.qry.devId == newDevice.devId)
+    qryApp = await apps_db.getOne(apps_db.qry.appId == newDevice.devId)
     if qryDevice or qryApp:
         if qryApp:
             detail = f"The Id({newDevice.devId}) is already registered for AppId."
@@ -298,7 +358,7 @@ async def add_device(newDevice: NewDevice, jwt: str = Depends(authenticate)) ->
             return          # the device name for edge is already taken
 
     if newDevice.type == 'edge':
-        gw = device_db.getOne(device_db.qry.devId == newDevice.createdBy)
+        gw = await device_db.getOne(device_db.qry.devId == newDevice.createdBy)
         if not gw or gw['type'] != 'gateway':
             raise HTTPException(
                 status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -306,7 +366,8 @@ async def add_device(newDevice: NewDevice, jwt: str = Depends(authenticate)) ->
             )
     newDevice.createdDate = newDevice.createdDate.replace(tzinfo=timezone.utc)
     newDevice.createdDate = str(newDevice.createdDate.strftime('%Y-%m-%d %H:%M:%S'))
-    device_db.insert(newDevice)
+    await device_db.insert(newDevice)
+    gateway_index.set_device(newDevice.dict())
     add_dynsec_device(newDevice)
     return newDevice.dict()
 
@@ -358,8 +419,8 @@ async def update_device(
             detail=f"Invalid Device Type({updateData['type']})"
         )
 
-    db_device = device_db.getOne(device_db.qry.devId == devId)
-    dyn_device = dynsec_get_device(devId)
+    db_device = await device_db.getOne(device_db.qry.devId == devId)
+    dyn_device = await run_io(dynsec_get_device, devId)
     if db_device: 
         if dyn_device:
             # Both db_device & dyn_device found; update the information in TinyDB 
@@ -377,7 +438,8 @@ async def update_device(
                 theDevice = Device(**db_device)
                 theDevice.devId=devId
                 theDevice.createdDate = str(theDevice.createdDate.strftime('%Y-%m-%d %H:%M:%S'))
-                device_db.insert(theDevice)
+                await device_db.insert(theDevice)
+                gateway_index.set_device(theDevice.dict())
                 return theDevice
         elif 'password' in updateData:
             # No dyn_device found; create dyn_device
@@ -398,5 +460,6 @@ async def update_device(
         updateData['createdDate'] = datetime.now(timezone.utc)
         theDevice = Device(**updateData)
         theDevice.createdDate = str(theDevice.createdDate.strftime('%Y-%m-%d %H:%M:%S'))
-        device_db.insert(theDevice)
+        await device_db.insert(theDevice)
+        gateway_index.set_device(theDevice.dict())
         return theDevice
\ No newline at end of file
@@ -0,0 +1,248 @@
+from typing import List
+from fastapi import APIRouter, HTTPException, status, Depends
+
+from secutils import authenticate
+from models import MgmtJobRequest, RolloutRequest, JobProgress, RolloutProgress
+from dynsec.devices_actions import mgmt_messages
+from dynsec.mgmt_jobs import select_devices, start_job, job_progress, cancel_job as cancel_mgmt_job, list_jobs
+from dynsec.rollouts import start_rollout, rollout_progress, request_rollout, list_rollouts
+from environments import run_io
+
+router = APIRouter(tags=['Management'])
+
+@router.post('/jobs')
+async def create_job(jobRequest: MgmtJobRequest, jwt: str = Depends(authenticate)) -> dict:
+    """
+    Start a bulk management job on the selected devices.
+
+    The management message of the action is published to every device matching the selector,
+    paced by MGMT_RATE(messages per second) and MGMT_WINDOW(messages awaiting the broker's ack),
+    so a fleet wide action does not flood the broker.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - reset is a destructive operation that cannot be undone on any of the selected devices
+    - The devices which are offline will not receive the messages
+    - The job runs in the background, check its progress with GET /mgmt/jobs/{jobId}
+
+    Parameters:
+    - selector: devIds, type, gateway(the gateway and its edges) and/or createdBy, combined with AND
+    - action: reboot, reset, updateMeta or upgrade
+    - params: {"fw_url": "..."} for upgrade, {"meta": {"metadata": {...}}} for updateMeta
+
+    Returns:
+    - The job id and the number of the selected devices
+    """
+    if jobRequest.action not in mgmt_messages:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Invalid action({jobRequest.action}), one of {', '.join(mgmt_messages)}"
+        )
+    try:
+        mgmt_messages[jobRequest.action]('check', **jobRequest.params)
+    except (TypeError, KeyError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Invalid params for {jobRequest.action}: {e}"
+        )
+    devIds = await run_io(select_devices, jobRequest.selector)
+    if not devIds:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No device matches the selector"
+        )
+    job = start_job(jobRequest.action, jobRequest.params, devIds)
+    return {"jobId": job.id, "total": len(devIds)}
+
+@router.get('/jobs', response_model=List[JobProgress])
+async def get_jobs(jwt: str = Depends(authenticate)) -> List[JobProgress]:
+    """
+    Retrieve the progress of the bulk management jobs.
+
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - Only the last MGMT_JOBS_KEEP finished jobs are kept in memory, and the jobs are lost on restart
+    - With several workers, the jobs of the other workers are listed with the progress they shared in Redis(every second)
+
+    Returns:
+    - A list of the job progresses, the newest first
+    """
+    return await run_io(list_jobs)
+
+@router.get('/jobs/{jobId}', response_model=JobProgress)
+async def get_job_progress(jobId: str, jwt: str = Depends(authenticate)) -> JobProgress:
+    """
+    Retrieve the progress of a bulk management job.
+
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - With several workers, the job may run on another worker, and its progress is the one shared in Redis(every second)
+
+    Parameters:
+    - jobId: The job id returned when the job was started
+
+    Returns:
+    - state(queued, running, done, cancelled or failed), total, published, acked, failed, inflight and the recent errors
+    """
+    progress = await run_io(job_progress, jobId)
+    if not progress:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job({jobId}) does not exist"
+        )
+    return progress
+
+@router.delete('/jobs/{jobId}')
+async def cancel_job(jobId: str, jwt: str = Depends(authenticate)) -> dict:
+    """
+    Cancel a bulk management job.
+
+    The messages already published are not recalled, the rest are not sent.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - With several workers, the cancel is forwarded to the worker running the job, and the progress returned is the last shared one
+
+    Parameters:
+    - jobId: The job id returned when the job was started
+
+    Returns:
+    - The progress of the job
+    """
+    progress = await run_io(cancel_mgmt_job, jobId)
+    if not progress:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job({jobId}) does not exist"
+        )
+    return progress
+
+@router.post('/rollouts')
+async def create_rollout(rolloutRequest: RolloutRequest, jwt: str = Depends(authenticate)) -> dict:
+    """
+    Start a staged firmware rollout on the selected devices.
+
+    The devices are upgraded in waves of cumulative percentages, eg. [1, 10, 100] upgrades 1% of them first,
+    then up to 10% and then the rest, each wave starting when the previous one has finished.
+    A device has finished when it reports the result on mgmt/device/status, or fw_version on mgmt/device/meta,
+    and it's counted failed on a failure report or when it does not report in ack_timeout seconds.
+    The status report is {"d": {"status": "<result>"}}(or "result"), eg. "upgraded"/"success"/"done" or "failed"/"error".
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - Ensure the firmware URL is secure (HTTPS) and trusted, and the firmware is compatible with all the selected devices
+    - At most max_inflight devices download the firmware at once, size it for the firmware host
+    - The rollout halts when the failed fraction exceeds failure_threshold, check the failures before resuming it
+    - The rollouts are kept in memory and lost on restart
+
+    Parameters:
+    - selector: devIds, type, gateway(the gateway and its edges) and/or createdBy, combined with AND
+    - fw_url: The URL of the firmware
+    - fw_version: Optional firmware version the devices report in meta after the upgrade
+    - waves: Cumulative percentages of the selected devices per wave, [1, 10, 100] by default
+    - max_inflight, failure_threshold, ack_timeout: Optional, ROLLOUT_* settings by default
+
+    Returns:
+    - The rollout id and the number of the selected devices
+    """
+    if any(w <= 0 or w > 100 for w in rolloutRequest.waves):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="The waves must be percentages between 0 and 100"
+        )
+    devIds = await run_io(select_devices, rolloutRequest.selector)
+    if not devIds:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No device matches the selector"
+        )
+    rollout = start_rollout(devIds, rolloutRequest.fw_url, rolloutRequest.fw_version, rolloutRequest.waves,
+                            rolloutRequest.max_inflight, rolloutRequest.failure_threshold, rolloutRequest.ack_timeout)
+    return {"rolloutId": rollout.id, "total": len(devIds)}
+
+@router.get('/rollouts', response_model=List[RolloutProgress])
+async def get_rollouts(jwt: str = Depends(authenticate)) -> List[RolloutProgress]:
+    """
+    Retrieve the progress of the firmware rollouts.
+
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - With several workers, the rollouts of the other workers are listed with the progress they shared in Redis(every second)
+
+    Returns:
+    - A list of the rollout progresses, the newest first
+    """
+    return await run_io(list_rollouts)
+
+async def find_rollout(rolloutId: str) -> dict:
+    progress = await run_io(rollout_progress, rolloutId)
+    if not progress:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Rollout({rolloutId}) does not exist"
+        )
+    return progress
+
+@router.get('/rollouts/{rolloutId}', response_model=RolloutProgress)
+async def get_rollout_progress(rolloutId: str, jwt: str = Depends(authenticate)) -> RolloutProgress:
+    """
+    Retrieve the progress of a firmware rollout.
+
+    Authentication is required to access this endpoint.
+
+    Parameters:
+    - rolloutId: The rollout id returned when the rollout was started
+
+    Returns:
+    - state(running, done, halted, cancelled or failed), the current wave, the counts and the recent failures
+    """
+    return await find_rollout(rolloutId)
+
+@router.put('/rollouts/{rolloutId}/resume')
+async def resume_rollout(rolloutId: str, jwt: str = Depends(authenticate)) -> dict:
+    """
+    Resume a halted or cancelled firmware rollout.
+
+    The failures so far are accepted, and the failure threshold applies to the rest of the devices.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - With several workers, the resume is forwarded to the worker running the rollout, and the progress returned is the last shared one
+
+    Parameters:
+    - rolloutId: The rollout id returned when the rollout was started
+
+    Returns:
+    - The progress of the rollout
+    """
+    progress = await find_rollout(rolloutId)
+    if progress['state'] not in ['halted', 'cancelled']:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Rollout({rolloutId}) is {progress['state']}"
+        )
+    # resuming waits for the stopped thread, off the event loop
+    return await run_io(request_rollout, rolloutId, 'resume')
+
+@router.delete('/rollouts/{rolloutId}')
+async def cancel_rollout(rolloutId: str, jwt: str = Depends(authenticate)) -> dict:
+    """
+    Cancel a firmware rollout.
+
+    The devices already requested keep upgrading, the rest are not requested.
+    Authentication is required to access this endpoint.
+
+    Caution:
+    - With several workers, the cancel is forwarded to the worker running the rollout, and the progress returned is the last shared one
+
+    Parameters:
+    - rolloutId: The rollout id returned when the rollout was started
+
+    Returns:
+    - The progress of the rollout
+    """
+    await find_rollout(rolloutId)
+    return await run_io(request_rollout, rolloutId, 'cancel')
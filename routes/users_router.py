@@ -1,12 +1,14 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Request
 from models.users import User, NewUser, TokenResponse
 from secutils import create_access_token
-from secutils import authenticate, create_hash, verify_hash
-from environments import Database
+from secutils import authenticate, acreate_hash, averify_and_update_hash, ConcurrencyLimiter
+from environments import Settings, AsyncDatabase
 import json
 
+settings = Settings()
 router = APIRouter(tags=['Users'])
-db = Database(User.Settings.name)
+db = AsyncDatabase(User.Settings.name)
+login_limiter = ConcurrencyLimiter(settings.LOGIN_CONCURRENCY)
 
 @router.get('/validate_token')
 async def valid_token(jwt: str = Depends(authenticate)) -> dict:
@@ -41,7 +43,7 @@ async def add_user(user: NewUser) -> dict:
     - Confirmation message with the created user email
     """
     # check if admin user exists and reject if exists
-    users = db.getAll()
+    users = await db.getAll()
     if len(users) > 0:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
@@ -52,14 +54,14 @@ async def add_user(user: NewUser) -> dict:
             status_code=status.HTTP_411_LENGTH_REQUIRED,
             detail=f"Password is too short"
         )
-    user.password = create_hash(user.password)
-    db.insert(user)
+    user.password = await acreate_hash(user.password)
+    await db.insert(user)
     return {
         "message": f"User({user.email}) created successfully"
     }
 
 @router.post("/login", response_model=TokenResponse)
-async def login(user: User) -> dict:
+async def login(user: User, request: Request) -> dict:
     """
     Authenticate a user and generate an access token.
     
@@ -70,17 +72,25 @@ async def login(user: User) -> dict:
     - Ensure proper password security when sending credentials
     - Do not share your access token
     - The token has an expiration time
+    - Concurrent login attempts from the same client or for the same email are limited(429)
     
     Returns:
     - Access token and token type for use in subsequent authenticated requests
     """
-    qryUser = db.getOne(db.qry.email == user.email)
+    qryUser = await db.getOne(db.qry.email == user.email)
     if not qryUser:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"User(email:{user.email}) does not exist."
         )
-    if verify_hash(user.password, qryUser['password']):
+    client_ip = f'ip:{request.client.host}' if request.client else None
+    async with login_limiter.acquire(client_ip, f'email:{user.email}'):
+        verified, new_hash = await averify_and_update_hash(user.password, qryUser['password'])
+    if verified:
+        if new_hash:
+            # the bcrypt cost has changed, so store the password with the new cost
+            qryUser['password'] = new_hash
+            await db.insert(User(**qryUser))
         access_token = create_access_token(qryUser['email'])
         return {
             "access_token": access_token,
@@ -1,2 +1,3 @@
-from secutils.jwt_handler import create_access_token, verify_access_token, authenticate
-from secutils.hash_password import create_hash, verify_hash
\ No newline at end of file
+from secutils.jwt_handler import create_access_token, verify_access_token, authenticate, token_subject
+from secutils.hash_password import create_hash, verify_hash, acreate_hash, averify_and_update_hash
+from secutils.limits import ConcurrencyLimiter, TokenBucketLimiter, AdmissionMiddleware
@@ -1,9 +1,44 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
+from environments import Settings
+from environments.profiling import record_span
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+settings = Settings()
+
+# bcrypt hashes whose cost differs from BCRYPT_ROUNDS are reported as needing an update
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+# bcrypt takes a few hundred milliseconds per call, so it runs on its own bounded pool
+# to keep the event loop and the other executors free
+hash_executor = ThreadPoolExecutor(max_workers=settings.HASH_WORKERS, thread_name_prefix='io7-hash')
 
 def create_hash(password: str):
     return pwd_context.hash(password)
 
 def verify_hash(plain_password: str, hashed_password: str):
     return pwd_context.verify(plain_password, hashed_password)
+
+def verify_and_update_hash(plain_password: str, hashed_password: str):
+    """
+    returns (verified, new_hash) where new_hash is not None
+    when the stored hash should be replaced(eg. BCRYPT_ROUNDS has changed)
+    """
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+async def acreate_hash(password: str):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(hash_executor, create_hash, password)
+    finally:
+        record_span('bcrypt.hash', time.perf_counter() - start)
+
+async def averify_and_update_hash(plain_password: str, hashed_password: str):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(hash_executor, verify_and_update_hash, plain_password, hashed_password)
+    finally:
+        record_span('bcrypt.verify', time.perf_counter() - start)
@@ -1,13 +1,45 @@
+import os
 import time
+import tempfile
 from datetime import datetime
 from jose import jwt, JWTError
 from fastapi import HTTPException, status, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from environments import Settings
+from environments import Settings, shared_state
 
 security = Security(HTTPBearer())
 
 settings = Settings()
+signing_key = None
+
+def get_signing_key() -> str:
+    """
+    SECRET_KEY if configured, otherwise the key generated at the startup.
+    The generated key differs per process, so in the shared state mode the first worker
+    saves it in DATABASE_DIR and the others use that one. Replicas on different hosts
+    must be given the same SECRET_KEY.
+    """
+    global signing_key
+    if signing_key is None:
+        if 'SECRET_KEY' in settings.__fields_set__ or not shared_state.enabled():
+            signing_key = settings.SECRET_KEY
+        else:
+            signing_key = shared_secret_key(os.path.join(settings.DATABASE_DIR, '.secret_key'))
+    return signing_key
+
+def shared_secret_key(path: str) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(settings.SECRET_KEY)
+        os.link(tmp, path)      # fails if another worker was first, and never exposes a partial file
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+    with open(path) as file:
+        return file.read().strip()
 
 def create_access_token(user: str):
     payload = {
@@ -15,12 +47,12 @@ def create_access_token(user: str):
         "expires": time.time() + 36000
     }
 
-    token = jwt.encode(payload, settings.SECRET_KEY, algorithm="HS256")
+    token = jwt.encode(payload, get_signing_key(), algorithm="HS256")
     return token
 
 def verify_access_token(token: str):
     try:
-        data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+        data = jwt.decode(token, get_signing_key(), algorithms=["HS256"])
 
         expire = data.get("expires")
         if expire is None:
@@ -41,5 +73,16 @@ def verify_access_token(token: str):
             detail="Invalid token"
         )
 
+def token_subject(authorization: str) -> str:
+    # the user of a valid `Bearer <token>` Authorization header, None otherwise(no exceptions, for the rate limiter)
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    try:
+        data = jwt.decode(token.strip(), get_signing_key(), algorithms=["HS256"])
+    except JWTError:
+        return None
+    return data.get("user") if time.time() <= data.get("expires", 0) else None
+
 def authenticate(jwt: HTTPAuthorizationCredentials = security) -> dict:
     return verify_access_token(jwt.credentials)
\ No newline at end of file
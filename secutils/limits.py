@@ -0,0 +1,141 @@
+import math
+import time
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+from environments import metrics
+
+rejected_requests = metrics.Counter('io7_http_rejected_total', 'Requests refused by the rate limits and the concurrency caps',
+                                    ('reason',))
+
+class ConcurrencyLimiter:
+    """
+    Limits the number of in-flight operations per key(eg. client IP or email).
+    It is meant to be used from the event loop only, so no lock is needed.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = {}
+
+    @asynccontextmanager
+    async def acquire(self, *keys):
+        keys = [k for k in keys if k]
+        for key in keys:
+            if self.active.get(key, 0) >= self.limit:
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Too many concurrent requests.",
+                    headers={"Retry-After": "1"}
+                )
+        for key in keys:
+            self.active[key] = self.active.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            for key in keys:
+                if self.active[key] <= 1:
+                    del self.active[key]
+                else:
+                    self.active[key] -= 1
+
+class TokenBucketLimiter:
+    """
+    Token bucket per key(eg. JWT subject or client IP), refilled with `rate` tokens a second up to `burst`.
+    A request takes its cost from the buckets of all its keys, or from none of them.
+    It is meant to be used from the event loop only, so no lock is needed.
+    """
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}           # key -> [tokens, time of the last refill]
+
+    def take(self, cost: float, *keys) -> float:
+        # 0 if taken, otherwise the seconds until the tokens are there
+        now = time.monotonic()
+        cost = min(cost, self.burst)
+        keys = [k for k in keys if k]
+        if len(self.buckets) + len(keys) > self.max_keys:
+            # before the buckets of this request are fetched, so none of them is dropped before it's charged
+            self.prune(now)
+        buckets = []
+        wait = 0
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < cost:
+                wait = max(wait, (cost - bucket[0]) / self.rate)
+            buckets.append(bucket)
+        if wait:
+            return wait
+        for bucket in buckets:
+            bucket[0] -= cost
+        return 0
+
+    def prune(self, now: float):
+        # the buckets refilled since their last use are the same as new ones
+        self.buckets = {k: b for k, b in self.buckets.items() if b[0] + (now - b[1]) * self.rate < self.burst}
+
+class AdmissionMiddleware:
+    """
+    Admission control of the REST API, before the request reaches the routes.
+
+    - classify(method, path, query_string) gives the route class(eg. read, write, expensive) of a request,
+      `costs` the tokens each class takes from the rate limiter buckets of the client IP and the JWT subject.
+      Over the rate, the request is refused with 429 and Retry-After.
+    - over max_concurrency in-flight requests, or max_class_concurrency in-flight requests of a class,
+      the request is refused with 503 and Retry-After, so the overload doesn't slow down everything else.
+    The paths in `exempt`(eg. /metrics) are not limited.
+    """
+    def __init__(self, app: ASGIApp, classify, costs: dict, limiter: TokenBucketLimiter = None, subject=None,
+                 max_concurrency: int = 0, max_class_concurrency: dict = None, exempt: tuple = ()):
+        self.app = app
+        self.classify = classify
+        self.costs = costs
+        self.limiter = limiter
+        self.subject = subject
+        self.max_concurrency = max_concurrency
+        self.max_class_concurrency = max_class_concurrency or {}
+        self.exempt = set(exempt)
+        self.active = 0
+        self.active_class = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['path'] in self.exempt:
+            await self.app(scope, receive, send)
+            return
+        kind = self.classify(scope['method'], scope['path'], scope.get('query_string', b''))
+        class_limit = self.max_class_concurrency.get(kind, 0)
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            await self.reject(scope, receive, send, 503, 'concurrency', 'Server busy, retry later.', 1)
+            return
+        if class_limit and self.active_class.get(kind, 0) >= class_limit:
+            await self.reject(scope, receive, send, 503, kind, f'Too many {kind} requests in progress, retry later.', 1)
+            return
+        if self.limiter:
+            client = scope.get('client')
+            subject = self.subject(Headers(scope=scope).get('authorization')) if self.subject else None
+            wait = self.limiter.take(self.costs.get(kind, 1), f'ip:{client[0]}' if client else None,
+                                     f'sub:{subject}' if subject else None)
+            if wait:
+                await self.reject(scope, receive, send, 429, 'rate', 'Rate limit exceeded.', math.ceil(wait))
+                return
+        self.active += 1
+        self.active_class[kind] = self.active_class.get(kind, 0) + 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.active -= 1
+            self.active_class[kind] -= 1
+
+    @staticmethod
+    async def reject(scope: Scope, receive: Receive, send: Send, status_code: int, reason: str, detail: str, retry_after: int):
+        rejected_requests.labels(reason).inc()
+        response = JSONResponse({'detail': detail}, status_code=status_code, headers={'Retry-After': str(retry_after)})
+        await response(scope, receive, send)
@@ -0,0 +1,86 @@
+"""
+Memory of the in-memory registry representations.
+
+    python tests/bench/bench_memory.py --devices 100000 --out memory.json
+
+It generates a synthetic registry, loads the devices table and measures with tracemalloc
+what holding the rows costs as
+- docs: the TinyDB documents(what getAll() returns, copied per caller)
+- slim_dicts: dicts of the fields the caches use(devId, type, createdBy)
+- records: the slotted, interned DeviceRecords of the device registry
+and what the indexes built on the registry(gateway_index, presence) add on top.
+The report is JSON like run_bench.py.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, REPO_DIR)
+
+def measure(build) -> tuple:
+    # bytes allocated and kept by build(), and the seconds it took
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = build()
+    seconds = time.perf_counter() - start
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return kept, size, seconds
+
+def main():
+    parser = argparse.ArgumentParser(description='io7 API server registry memory benchmark')
+    parser.add_argument('--devices', type=int, default=100000, help='number of devices in the synthetic registry')
+    parser.add_argument('--out', help='write the JSON report to this file as well as stdout')
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix='io7-bench-')
+    # Settings are read at import time, so these have to be set before importing the server modules
+    os.environ['DATABASE_DIR'] = os.path.join(base_dir, 'db')
+    os.environ['DynSecPath'] = os.path.join(base_dir, 'dynamic-security.json')
+    os.environ['BCRYPT_ROUNDS'] = '4'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from fixtures import generate
+    generate(base_dir, args.devices, n_apps=10, members=1)
+
+    from environments import Database, DeviceRecord, device_registry, gateway_index, presence
+    rows = Database('devices').getAll()         # the table is read once, outside of the measurements
+    results = {}
+    for name, build in [
+        ('docs', lambda: [dict(doc) for doc in rows]),
+        ('slim_dicts', lambda: {doc['devId']: {'devId': doc['devId'], 'type': doc['type'], 'createdBy': doc['createdBy']}
+                                for doc in rows}),
+        ('records', lambda: {doc['devId']: DeviceRecord.from_doc(doc) for doc in rows}),
+    ]:
+        kept, size, seconds = measure(build)
+        results[name] = {'bytes': size, 'bytes_per_row': round(size / len(rows), 1), 'build_seconds': round(seconds, 3)}
+        del kept
+        print(f'  {name}: {results[name]}', file=sys.stderr)
+
+    _, size, _ = measure(device_registry.all)
+    results['device_registry'] = {'bytes': size, 'bytes_per_row': round(size / len(rows), 1)}
+
+    def indexes():
+        gateway_index.ensure_loaded()
+        for record in list(device_registry.all().values())[::2]:
+            presence.update(record.devId, True)     # half of the devices online
+    _, size, _ = measure(indexes)
+    results['indexes'] = {'bytes': size, 'bytes_per_row': round(size / len(rows), 1)}
+
+    report = {'meta': {'devices': args.devices, 'python': sys.version.split()[0]}, 'memory': results}
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Synthetic registries for the benchmarks.
+
+generate() writes the TinyDB tables(devices, apps, users) and a matching dynsec json
+into `base_dir`, so the API server can be started on them without Mosquitto.
+A few entries are deliberately left out of one side to exercise the ?broken=true paths.
+"""
+import json
+import os
+import random
+
+BENCH_EMAIL = 'bench@io7lab.com'
+BENCH_PASSWORD = 'bench-password'
+
+def device_acls(devId, gateway=False):
+    topics = [
+        ('subscribePattern', f'iot3/{devId}/cmd/+/fmt/+'),
+        ('subscribePattern', f'iot3/{devId}/mgmt/device/update'),
+        ('subscribePattern', f'iot3/{devId}/mgmt/initiate/device/reboot'),
+        ('subscribePattern', f'iot3/{devId}/mgmt/initiate/device/factory_reset'),
+        ('subscribePattern', f'iot3/{devId}/mgmt/initiate/firmware/update'),
+        ('publishClientSend', f'iot3/{devId}/mgmt/device/status'),
+        ('publishClientSend', f'iot3/{devId}/mgmt/device/meta'),
+        ('publishClientSend', f'iot3/{devId}/evt/+/fmt/+'),
+    ]
+    if gateway:
+        topics += [
+            ('publishClientSend', f'iot3/{devId}/gateway/query'),
+            ('publishClientSend', f'iot3/{devId}/gateway/add'),
+            ('subscribePattern', f'iot3/{devId}/gateway/list'),
+        ]
+    return [{'acltype': t, 'topic': topic, 'priority': -1, 'allow': True} for t, topic in topics]
+
+def table(docs):
+    return {'_default': {str(i + 1): doc for i, doc in enumerate(docs)}}
+
+def generate(base_dir: str, n_devices: int = 1000, n_apps: int = 100, members: int = 10, seed: int = 7) -> dict:
+    """
+    returns the ids generated, eg. {'devices': [...], 'gateways': [...], 'edges': [...], 'apps': [...]}
+    """
+    from secutils.hash_password import create_hash
+
+    rnd = random.Random(seed)
+    db_dir = os.path.join(base_dir, 'db')
+    os.makedirs(db_dir, exist_ok=True)
+    created = '2024-01-01 00:00:00'
+
+    n_gateways = max(1, n_devices // 50)
+    n_edges = n_devices // 10
+    gateways = [f'gw{i}' for i in range(n_gateways)]
+    edges = [f'edge{i}' for i in range(n_edges)]
+    devices = [f'dev{i}' for i in range(n_devices - n_gateways - n_edges)]
+    apps = [f'app{i}' for i in range(n_apps)]
+
+    db_devices = [{'devId': d, 'type': 'device', 'createdBy': 'admin', 'createdDate': created} for d in devices]
+    db_devices += [{'devId': g, 'type': 'gateway', 'createdBy': 'admin', 'createdDate': created} for g in gateways]
+    db_devices += [{'devId': e, 'type': 'edge', 'createdBy': gateways[i % n_gateways], 'createdDate': created}
+                   for i, e in enumerate(edges)]
+    for doc in db_devices:
+        doc.update({'devDesc': f"{doc['type']} {doc['devId']}", 'devMaker': 'io7lab', 'devSerial': None,
+                    'devModel': 'bench', 'devHwVer': '1.0', 'devFwVer': '1.0.0'})
+    db_apps = [{'appId': a, 'createdBy': 'admin', 'createdDate': created, 'appDesc': f'app {a}',
+                'restricted': i % 2 == 0} for i, a in enumerate(apps)]
+
+    clients = [{'username': 'admin', 'roles': [{'rolename': 'admin'}]}]
+    roles = [{'rolename': 'admin', 'acls': []}, {'rolename': '$apps', 'acls': []}, {'rolename': '$io7_adm', 'acls': []}]
+    # the last device is missing in dynsec and the first dynsec-only device is missing in TinyDB
+    for d in devices[:-1] + ['orphan0']:
+        clients.append({'username': d, 'roles': [{'rolename': d, 'priority': -1}]})
+        roles.append({'rolename': d, 'acls': device_acls(d)})
+    for g in gateways:
+        gw_edges = [e['devId'] for e in db_devices if e['type'] == 'edge' and e['createdBy'] == g]
+        clients.append({'username': g, 'roles': [{'rolename': g, 'priority': -1}] + [{'rolename': e} for e in gw_edges]})
+        roles.append({'rolename': g, 'acls': device_acls(g, gateway=True)})
+        roles += [{'rolename': e, 'acls': device_acls(e)} for e in gw_edges]
+    for app in db_apps:
+        if app['restricted']:
+            rolename = f"$apps_{app['appId']}"
+            acls = []
+            for d in rnd.sample(devices, min(members, len(devices))):
+                acls.append({'acltype': 'subscribePattern', 'topic': f'iot3/{d}/evt/#', 'priority': -1, 'allow': True})
+                acls.append({'acltype': 'publishClientSend', 'topic': f'iot3/{d}/cmd/#', 'priority': -1,
+                             'allow': rnd.random() < 0.5})
+            roles.append({'rolename': rolename, 'acls': acls})
+        else:
+            rolename = '$apps'
+        clients.append({'username': app['appId'], 'roles': [{'rolename': rolename, 'priority': -1}]})
+
+    users = [{'email': BENCH_EMAIL, 'password': create_hash(BENCH_PASSWORD), 'username': 'bench'}]
+
+    for name, docs in [('devices', db_devices), ('apps', db_apps), ('users', users), ('config_var', [])]:
+        with open(os.path.join(db_dir, f'{name}.json'), 'w') as file:
+            json.dump(table(docs), file)
+    with open(os.path.join(base_dir, 'dynamic-security.json'), 'w') as file:
+        json.dump({'clients': clients, 'roles': roles, 'groups': [],
+                   'defaultACLAccess': {'publishClientSend': False, 'subscribe': False}}, file)
+
+    return {'devices': devices, 'gateways': gateways, 'edges': edges, 'apps': apps}
@@ -0,0 +1,218 @@
+"""
+Benchmarks of the REST and MQTT paths of the API server.
+
+    python tests/bench/run_bench.py --devices 10000 --apps 500 --out bench.json
+
+It generates a synthetic registry and dynsec json in a temporary directory,
+drives the FastAPI app in-process with an ASGI client(no network),
+replays synthetic `iot3/<dev>/evt` and gateway query traffic into on_message
+with local stand-ins for Mosquitto, Redis and InfluxDB,
+and reports the throughput and the latency percentiles as JSON, so the releases can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, REPO_DIR)
+
+def summarize(samples: list, wall: float) -> dict:
+    samples = sorted(samples)
+    count = len(samples)
+    if count == 0:
+        return {'count': 0}
+    pick = lambda p: samples[min(count - 1, int(p * count))] * 1000
+    return {
+        'count': count,
+        'mean_ms': round(sum(samples) / count * 1000, 3),
+        'p50_ms': round(pick(0.50), 3),
+        'p90_ms': round(pick(0.90), 3),
+        'p99_ms': round(pick(0.99), 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+        'throughput_per_sec': round(count / wall, 1) if wall > 0 else None
+    }
+
+def setup_env(base_dir: str):
+    # Settings are read at import time, so these have to be set before importing the server modules
+    os.environ['DATABASE_DIR'] = os.path.join(base_dir, 'db')
+    os.environ['DynSecPath'] = os.path.join(base_dir, 'dynamic-security.json')
+    os.environ['BCRYPT_ROUNDS'] = '4'
+    os.environ['CONFIG_WATCH_INTERVAL'] = '0'
+    os.environ['RATE_LIMIT'] = '0'             # the benchmark is one client hammering the API
+    os.environ['MAX_CONCURRENCY'] = '0'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+async def run_scenario(client, name: str, count: int, concurrency: int, make_request) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            samples.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    wall = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(count)])
+    result = summarize(samples, time.perf_counter() - wall)
+    result['errors'] = errors
+    print(f'  {name}: {result}', file=sys.stderr)
+    return result
+
+async def bench_rest(app, ids: dict, args) -> dict:
+    import httpx
+    from fixtures import BENCH_EMAIL, BENCH_PASSWORD
+
+    rnd = random.Random(1)
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        response = await client.post('/users/login', json={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+        client.headers['Authorization'] = f"Bearer {response.json()['access_token']}"
+        config_vars = [{'key': f'var{i}', 'value': str(i)} for i in range(args.config_vars)]
+
+        scenarios = [
+            ('list_devices', args.list_requests, lambda c, i: c.get('/devices/')),
+            ('list_devices_broken', args.broken_requests, lambda c, i: c.get('/devices/?broken=true')),
+            ('list_apps', args.list_requests, lambda c, i: c.get('/app-ids/')),
+            ('list_apps_broken', args.broken_requests, lambda c, i: c.get('/app-ids/?broken=true')),
+            ('get_device', args.requests, lambda c, i: c.get(f"/devices/{rnd.choice(ids['devices'])}")),
+            ('get_app', args.requests, lambda c, i: c.get(f"/app-ids/{rnd.choice(ids['apps'])}")),
+            ('get_app_members', args.requests, lambda c, i: c.get(f"/app-ids/{ids['apps'][0]}/members")),
+            ('create_device', args.requests, lambda c, i: c.post('/devices/', json={'devId': f'bench{i}', 'password': 'x'})),
+            ('set_configs_bulk', args.bulk_requests, lambda c, i: c.post('/config/', json=config_vars)),
+            ('update_configs_bulk', args.bulk_requests, lambda c, i: c.patch('/config/', json=config_vars)),
+            ('get_configs', args.requests, lambda c, i: c.get('/config/')),
+        ]
+        for name, count, make_request in scenarios:
+            if count > 0:
+                results[name] = await run_scenario(client, name, count, args.concurrency, make_request)
+    return results
+
+def bench_mqtt(ids: dict, args, fake_influx) -> dict:
+    from stubs import FakeMessage
+    from dynsec import mqtt_conn
+    from environments import set_fieldset, set_monitored
+
+    set_monitored('*')
+    set_fieldset('temperature, humidity')
+    rnd = random.Random(2)
+    results = {}
+
+    messages = [FakeMessage(f"iot3/{rnd.choice(ids['devices'])}/evt/status/fmt/json",
+                            json.dumps({'d': {'temperature': 20 + i % 10, 'humidity': 50, 'label': 'x'}}).encode())
+                for i in range(args.events)]
+    samples = []
+    wall = time.perf_counter()
+    for msg in messages:
+        start = time.perf_counter()
+        mqtt_conn.on_message(mqtt_conn.mqClient, None, msg)
+        samples.append(time.perf_counter() - start)
+    dispatched = time.perf_counter() - wall
+    drained = fake_influx.wait_for(args.events)
+    end_to_end = time.perf_counter() - wall
+    results['evt_dispatch'] = summarize(samples, dispatched)
+    results['evt_end_to_end'] = {
+        'count': args.events,
+        'drained': drained,
+        'seconds': round(end_to_end, 3),
+        'throughput_per_sec': round(args.events / end_to_end, 1)
+    }
+
+    samples = []
+    wall = time.perf_counter()
+    for i in range(args.queries):
+        msg = FakeMessage(f"iot3/{ids['gateways'][i % len(ids['gateways'])]}/gateway/query", b'{"d":{"devices":"*"}}')
+        start = time.perf_counter()
+        mqtt_conn.on_message(mqtt_conn.mqClient, None, msg)
+        samples.append(time.perf_counter() - start)
+    results['gateway_query'] = summarize(samples, time.perf_counter() - wall)
+    for name in results:
+        print(f'  {name}: {results[name]}', file=sys.stderr)
+    return results
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='io7 API server benchmarks')
+    parser.add_argument('--devices', type=int, default=1000, help='number of devices in the synthetic registry')
+    parser.add_argument('--apps', type=int, default=100, help='number of app ids in the synthetic registry')
+    parser.add_argument('--members', type=int, default=10, help='member devices per restricted app')
+    parser.add_argument('--requests', type=int, default=200, help='requests per single-entity scenario')
+    parser.add_argument('--list-requests', type=int, default=20, help='requests per list scenario')
+    parser.add_argument('--broken-requests', type=int, default=1, help='requests per ?broken=true scenario')
+    parser.add_argument('--bulk-requests', type=int, default=20, help='requests per bulk config scenario')
+    parser.add_argument('--config-vars', type=int, default=100, help='config variables per bulk request')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent REST requests')
+    parser.add_argument('--events', type=int, default=10000, help='device events replayed into on_message')
+    parser.add_argument('--queries', type=int, default=200, help='gateway queries replayed into on_message')
+    parser.add_argument('--skip-rest', action='store_true')
+    parser.add_argument('--skip-mqtt', action='store_true')
+    parser.add_argument('--out', help='write the JSON report to this file as well as stdout')
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix='io7-bench-')
+    setup_env(base_dir)
+    from stubs import FakeMQTT, FakeRedis, FakeInflux
+    from fixtures import generate
+
+    start = time.perf_counter()
+    ids = generate(base_dir, args.devices, args.apps, args.members)
+    print(f'Generated the registry in {time.perf_counter() - start:.2f}s at {base_dir}', file=sys.stderr)
+
+    start = time.perf_counter()
+    import api
+    from dynsec import mqtt_conn, event_shadow
+    from environments import config_cache
+    import_seconds = time.perf_counter() - start
+    config_cache.load()         # the lifespan of the app is not run, since MQTT and Redis are stand-ins
+
+    fake_mqtt, fake_influx = FakeMQTT(), FakeInflux()
+    mqtt_conn.mqClient.publish = fake_mqtt.publish
+    event_shadow.redisClient = FakeRedis()
+    event_shadow.requests.post = fake_influx.post
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'devices': args.devices,
+            'apps': args.apps,
+            'concurrency': args.concurrency,
+            'import_seconds': round(import_seconds, 3)
+        }
+    }
+    if not args.skip_rest:
+        print('REST', file=sys.stderr)
+        report['rest'] = asyncio.run(bench_rest(api.app, ids, args))
+    if not args.skip_mqtt:
+        print('MQTT', file=sys.stderr)
+        report['mqtt'] = bench_mqtt(ids, args, fake_influx)
+    report['mqtt_published'] = len(fake_mqtt.published)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write(output)
+
+if __name__ == '__main__':
+    main()
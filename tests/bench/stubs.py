@@ -0,0 +1,60 @@
+"""
+Local stand-ins for Mosquitto, Redis and InfluxDB used by the benchmarks.
+They only record what they receive, so the measurements are the API server's own cost.
+"""
+import threading
+
+class FakeMQTT:
+    """ replaces mqClient.publish """
+    def __init__(self):
+        self.published = []
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        with self.lock:
+            self.published.append((topic, payload))
+
+    def subscribe(self, *args, **kwargs):
+        return (0, 1)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value, *args, **kwargs):
+        self.data[key] = value
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+
+class FakeInfluxResponse:
+    status_code = 204
+
+
+class FakeInflux:
+    """ replaces requests.post of the influx writer """
+    def __init__(self):
+        self.lines = 0
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+
+    def post(self, url=None, data=None, headers=None, verify=None, **kwargs):
+        with self.lock:
+            self.lines += 1
+            self.done.notify_all()
+        return FakeInfluxResponse()
+
+    def wait_for(self, count: int, timeout: float = 60):
+        with self.lock:
+            return self.done.wait_for(lambda: self.lines >= count, timeout)
+
+
+class FakeMessage:
+    """ paho MQTTMessage lookalike """
+    __slots__ = ('topic', 'payload')
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+# Getting the device list twice, the second time with If-None-Match, which should be 304 Not Modified
+pw=${io7pw:-strong!!!}    # it uses the environment variable io7pw, so set it to your io7 password
+token=$(curl -X POST 'http://localhost:2009/users/login' -H 'Content-Type: application/json' -d "{ \"email\": \"io7@io7lab.com\", \"password\": \"$pw\" }"|jq '.access_token'|tr -d '"') 2>/dev/null
+
+etag=$(curl -s -D - -o /dev/null 'http://localhost:2009/devices/' -H "Authorization: Bearer $token" | grep -i '^etag:' | cut -d' ' -f2- | tr -d '\r')
+echo "ETag: $etag"
+curl -s -o /dev/null -w '%{http_code}\n' 'http://localhost:2009/devices/' -H "Authorization: Bearer $token" -H "If-None-Match: $etag"
@@ -0,0 +1,19 @@
+#!/usr/bin/env bash
+# staged firmware rollout to all the devices of type 'device', see t_upgrade_firmware.sh for serving the firmware
+pw=${io7pw:-strong!!!}    # it uses the environment variable io7pw, so set it to your io7 password
+token=$(curl -X POST 'http://localhost:2009/users/login' -H 'Content-Type: application/json' -d "{ \"email\": \"io7@io7lab.com\", \"password\": \"$pw\" }"|jq '.access_token'|tr -d '"') 2>/dev/null
+
+rollout=$(curl -s -X 'POST' 'http://localhost:2009/mgmt/rollouts' \
+  -H 'accept: application/json' \
+  -H "Authorization: Bearer $token" \
+  -H 'Content-Type: application/json' \
+  -d '{
+  "selector": { "type": "device" },
+  "fw_url": "http://localhost:8000/thermo.js",
+  "waves": [10, 50, 100],
+  "max_inflight": 5,
+  "ack_timeout": 120
+}' | jq -r '.rolloutId')
+echo "rollout $rollout"
+sleep 5
+curl -s "http://localhost:2009/mgmt/rollouts/$rollout" -H "Authorization: Bearer $token" | jq
@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+# Run right after (re)starting the server: the very first ETags of the lists, sent back with If-None-Match,
+# should be 304 Not Modified(the lists haven't changed in between)
+pw=${io7pw:-strong!!!}    # it uses the environment variable io7pw, so set it to your io7 password
+token=$(curl -X POST 'http://localhost:2009/users/login' -H 'Content-Type: application/json' -d "{ \"email\": \"io7@io7lab.com\", \"password\": \"$pw\" }"|jq '.access_token'|tr -d '"') 2>/dev/null
+
+for url in 'devices/' 'devices/?broken=true' 'app-ids/' 'app-ids/?broken=true'; do
+    etag=$(curl -s -D - -o /dev/null "http://localhost:2009/$url" -H "Authorization: Bearer $token" | grep -i '^etag:' | cut -d' ' -f2- | tr -d '\r')
+    echo "$url $etag $(curl -s -o /dev/null -w '%{http_code}' "http://localhost:2009/$url" -H "Authorization: Bearer $token" -H "If-None-Match: $etag")"
+done
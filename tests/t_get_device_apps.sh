@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+# Getting the restricted appIds which have the device as a member
+if [ $# -lt 1 ] ; then
+    echo Please Provide the devId
+    exit 1
+fi
+
+pw=${io7pw:-strong!!!}    # it uses the environment variable io7pw, so set it to your io7 password
+token=$(curl -X POST 'http://localhost:2009/users/login' -H 'Content-Type: application/json' -d "{ \"email\": \"io7@io7lab.com\", \"password\": \"$pw\" }"|jq '.access_token'|tr -d '"') 2>/dev/null
+
+curl -X 'GET'  "http://localhost:2009/devices/$1/apps" -H 'accept: application/json' -H "Authorization: Bearer $token" | jq .
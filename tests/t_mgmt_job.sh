@@ -0,0 +1,18 @@
+#!/usr/bin/env bash
+# rebooting all the devices of a gateway with a bulk management job
+pw=${io7pw:-strong!!!}    # it uses the environment variable io7pw, so set it to your io7 password
+gw=${1:-gw1}
+token=$(curl -X POST 'http://localhost:2009/users/login' -H 'Content-Type: application/json' -d "{ \"email\": \"io7@io7lab.com\", \"password\": \"$pw\" }"|jq '.access_token'|tr -d '"') 2>/dev/null
+
+job=$(curl -s -X 'POST' 'http://localhost:2009/mgmt/jobs' \
+  -H 'accept: application/json' \
+  -H "Authorization: Bearer $token" \
+  -H 'Content-Type: application/json' \
+  -d "{
+  \"selector\": { \"gateway\": \"$gw\" },
+  \"action\": \"reboot\",
+  \"params\": {}
+}" | jq -r '.jobId')
+echo "job $job"
+sleep 2
+curl -s "http://localhost:2009/mgmt/jobs/$job" -H "Authorization: Bearer $token" | jq
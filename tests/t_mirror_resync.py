@@ -0,0 +1,30 @@
+# The dynsec responses go to every worker, so a resync response of another worker must not be taken for ours.
+# Runs without the broker: python tests/t_mirror_resync.py
+import json
+import os
+import sys
+os.environ['DynSecPath'] = ''        # the mirror starts empty, not from the file
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from environments.dynsec_mirror import DynsecMirror
+
+def response(correlation, clients, roles):
+    return json.dumps({'responses': [
+        {'command': 'listClients', 'correlationData': correlation, 'data': {'clients': clients}},
+        {'command': 'listRoles', 'correlationData': correlation, 'data': {'roles': roles}}
+    ]}).encode()
+
+ours, theirs = DynsecMirror(), DynsecMirror()
+ours.resync_commands()
+correlation = theirs.resync_commands()[0]['correlationData']
+assert correlation != ours.resync_commands()[0]['correlationData']
+
+# the other worker's snapshot misses dev1, which we created meanwhile
+ours.apply([{'command': 'createClient', 'username': 'dev1', 'roles': [{'rolename': 'dev1'}]}])
+ours.on_response(response(correlation, [{'username': 'admin', 'roles': [{'rolename': 'admin'}]}], []))
+assert ours.pending is not None, 'another worker resync response was taken'
+assert ours.get_client('dev1') is not None
+
+ours.on_response(response(ours.resync_correlation(), [{'username': 'admin', 'roles': [{'rolename': 'admin'}]},
+                                                        {'username': 'dev1', 'roles': [{'rolename': 'dev1'}]}], []))
+assert ours.pending is None and set(ours.clients) == {'admin', 'dev1'}
+print('ok')
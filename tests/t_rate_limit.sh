@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+# Getting the device list more times than RATE_BURST allows, the last ones should be 429 Too Many Requests with Retry-After
+# The rate limits are off by default, start the server with eg. RATE_LIMIT=20 RATE_BURST=100
+pw=${io7pw:-strong!!!}    # it uses the environment variable io7pw, so set it to your io7 password
+token=$(curl -X POST 'http://localhost:2009/users/login' -H 'Content-Type: application/json' -d "{ \"email\": \"io7@io7lab.com\", \"password\": \"$pw\" }"|jq '.access_token'|tr -d '"') 2>/dev/null
+
+for i in $(seq 1 ${1:-120}); do
+    curl -s -o /dev/null -w '%{http_code}\n' 'http://localhost:2009/devices/' -H "Authorization: Bearer $token"
+done | sort | uniq -c
+curl -s -D - -o /dev/null 'http://localhost:2009/devices/' -H "Authorization: Bearer $token" | grep -i '^retry-after:'
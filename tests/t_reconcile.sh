@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+# checking the devices/apps registry against dynsec, add repair(t_reconcile.sh repair) to fix what can be fixed
+pw=${io7pw:-strong!!!}    # it uses the environment variable io7pw, so set it to your io7 password
+token=$(curl -X POST 'http://localhost:2009/users/login' -H 'Content-Type: application/json' -d "{ \"email\": \"io7@io7lab.com\", \"password\": \"$pw\" }"|jq '.access_token'|tr -d '"') 2>/dev/null
+
+if [ "$1" = "repair" ]; then
+    curl -s -X POST 'http://localhost:2009/admin/reconcile/repair' -H "Authorization: Bearer $token" | jq
+else
+    curl -s 'http://localhost:2009/admin/reconcile' -H "Authorization: Bearer $token" | jq
+fi
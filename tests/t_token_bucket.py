@@ -0,0 +1,16 @@
+# The token buckets pruned at max_keys, a request with a full bucket and a new one must still be charged on both.
+# Runs without the server: python tests/t_token_bucket.py
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from secutils.limits import TokenBucketLimiter
+
+limiter = TokenBucketLimiter(rate=0.01, burst=1, max_keys=1)
+limiter.buckets['ip:a'] = [1, time.monotonic() - 10]       # full and idle, prunable
+assert limiter.take(1, 'ip:a', 'sub:b') == 0
+assert limiter.take(1, 'ip:a') > 0, 'the bucket of ip:a was pruned before it was charged'
+assert limiter.take(1, 'sub:b') > 0
+assert limiter.take(1, 'ip:c') == 0                         # the others are not full, kept over max_keys
+assert len(limiter.buckets) == 3
+print('ok')
@@ -0,0 +1,27 @@
+# The upgrade result of the rollouts from the device reports, the ordinary reports must not count as failures.
+# Runs without the broker: python tests/t_upgrade_result.py
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dynsec.rollouts import upgrade_result
+
+cases = [
+    ('status', '{"d":{"status":"upgraded"}}', True),
+    ('status', '{"d":{"result":"Success"}}', True),
+    ('status', '{"d":{"status":"failed"}}', False),
+    ('status', '{"d":{"result":"error"}}', False),
+    ('status', '{"d":{"status":"upgraded","errors":0}}', True),
+    ('status', '{"d":{"error":null}}', None),
+    ('status', '{"d":{"failover":"enabled"}}', None),
+    ('status', '{"d":{"status":"incomplete"}}', None),
+    ('status', '{"d":{"status":"downloading"}}', None),
+    ('status', '{"d":{"message":"upgrade failed"}}', None),
+    ('status', '{"d":"failed"}', None),
+    ('status', 'not json', None),
+    ('meta', '{"d":{"metadata":{"devFwVer":"1.2"}}}', True),
+    ('meta', '{"d":{"devFwVer":"1.1"}}', None),
+]
+for kind, payload, expected in cases:
+    result = upgrade_result(kind, payload.encode(), '1.2')
+    assert result is expected, f'{kind} {payload}: {result}, expected {expected}'
+print('ok')